@@ -0,0 +1,157 @@
+import numpy as np
+import pandas as pd
+
+# 年化使用的每年 K 棒數 (加密貨幣全年交易)
+BARS_PER_YEAR = {'Stock': 252, 'Forex': 252, 'Crypto': 365}
+
+#區間最大/最小值查詢表 (sparse table)：建表 O(n log n)，之後任意區間查詢 O(1) 且可一次查詢多個區間
+def build_sparse_table(values: np.ndarray, op) -> list:
+    table = [np.asarray(values, dtype=float)]
+    span = 1
+    while span * 2 <= len(values):
+        prev = table[-1]
+        table.append(op(prev[:-span], prev[span:]))
+        span *= 2
+    return table
+
+#一次查詢多個閉區間 [starts[i], ends[i]] 的最大/最小值
+def range_query(table: list, starts: np.ndarray, ends: np.ndarray, op) -> np.ndarray:
+    lengths = ends - starts + 1
+    levels = np.floor(np.log2(lengths)).astype(int)
+    out = np.empty(len(starts))
+    for level in np.unique(levels):
+        mask = levels == level
+        row = table[level]
+        out[mask] = op(row[starts[mask]], row[ends[mask] - (1 << level) + 1])
+    return out
+
+#每筆平倉紀錄 (含部分平倉) 對應一段持倉，計算持倉期間的最大有利/不利偏移 (MFE/MAE)
+def trade_excursions(ledger: pd.DataFrame, high: np.ndarray, low: np.ndarray) -> pd.DataFrame:
+    # 同一倉位可能分多筆成交 (成交量限制)：開倉 K 棒取第一筆，進場價取數量加權平均
+    # 持有成本紀錄 (股數為 0) 不屬於任何一筆成交
+    opens = ledger[ledger['損益'].isna() & (ledger['股數'] != 0)].assign(_w=lambda df: df['股數'].abs().astype(float))
+    opens = opens.assign(_pw=opens['價格'].astype(float) * opens['_w']).groupby('pos_id', sort=False).agg(
+        bar=('bar', 'min'), _pw=('_pw', 'sum'), _w=('_w', 'sum'))
+    opens['價格'] = opens['_pw'] / opens['_w']
+    closes = ledger[ledger['損益'].notna() & ledger['pos_id'].isin(opens.index)]
+    if closes.empty:
+        return pd.DataFrame(columns=['pos_id', '模式', 'open_bar', 'close_bar', 'qty', 'entry', 'exit', 'pnl', 'mfe_pct', 'mae_pct', 'mfe', 'mae'])
+
+    open_bar = opens.loc[closes['pos_id'], 'bar'].to_numpy(dtype=int)
+    close_bar = closes['bar'].to_numpy(dtype=int)
+    qty = -closes['股數'].to_numpy(dtype=float) # 平倉股數為負
+    entry = opens.loc[closes['pos_id'], '價格'].to_numpy(dtype=float)
+    is_short = (closes['模式'] == '融券').to_numpy()
+
+    high_table = build_sparse_table(high, np.maximum)
+    low_table = build_sparse_table(low, np.minimum)
+    highest = range_query(high_table, open_bar, close_bar, np.maximum)
+    lowest = range_query(low_table, open_bar, close_bar, np.minimum)
+
+    # 多頭：有利 = 最高價，不利 = 最低價；空頭相反
+    mfe_pct = np.where(is_short, entry - lowest, highest - entry) / entry * 100
+    mae_pct = np.where(is_short, entry - highest, lowest - entry) / entry * 100
+
+    return pd.DataFrame({
+        'pos_id': closes['pos_id'].to_numpy(),
+        '模式': closes['模式'].to_numpy(),
+        'open_bar': open_bar,
+        'close_bar': close_bar,
+        'qty': qty,
+        'entry': entry,
+        'exit': closes['價格'].to_numpy(dtype=float),
+        'pnl': closes['損益'].to_numpy(dtype=float),
+        'mfe_pct': mfe_pct,
+        'mae_pct': mae_pct,
+        'mfe': mfe_pct / 100 * entry * qty,
+        'mae': mae_pct / 100 * entry * qty,
+    })
+
+#持倉時間比例：任一倉位持有中的 K 棒數 / 模擬 K 棒數 (以差分陣列累加區間)
+def time_in_market(excursions: pd.DataFrame, start_idx: int, end_idx: int) -> float:
+    n_bars = end_idx - start_idx + 1
+    if n_bars <= 0 or excursions.empty:
+        return 0.0
+    spans = excursions.groupby('pos_id').agg(open_bar=('open_bar', 'min'), close_bar=('close_bar', 'max'))
+    delta = np.zeros(n_bars + 1)
+    np.add.at(delta, np.clip(spans['open_bar'].to_numpy() - start_idx, 0, n_bars), 1)
+    np.add.at(delta, np.clip(spans['close_bar'].to_numpy() - start_idx + 1, 0, n_bars), -1)
+    return float((np.cumsum(delta[:-1]) > 0).mean())
+
+#買進持有：起始 K 棒開盤全數買入現貨，最後一根收盤賣出 (含現貨手續費)
+def buy_and_hold_return(open_: np.ndarray, close: np.ndarray, start_idx: int, end_idx: int, fee_rate: float) -> float:
+    entry = open_[start_idx] * (1 + fee_rate)
+    exit_ = close[end_idx] * (1 - fee_rate)
+    return float(exit_ / entry - 1)
+
+#完美後見之明：每段上漲都持有現貨 (多空皆可時也做空每段下跌)，每次進出場都支付手續費
+def perfect_hindsight_return(close: np.ndarray, start_idx: int, end_idx: int, fee_rate: float, allow_short: bool) -> float:
+    returns = np.diff(close[start_idx:end_idx + 1]) / close[start_idx:end_idx]
+    if len(returns) == 0:
+        return 0.0
+
+    if allow_short:
+        gross = np.prod(1 + np.abs(returns))
+        # 方向改變一次等於平倉再反向開倉
+        n_trades = 1 + np.count_nonzero(np.diff(np.sign(returns)) != 0)
+    else:
+        gross = np.prod(np.maximum(1 + returns, 1.0))
+        up = returns > 0
+        n_trades = np.count_nonzero(up[1:] & ~up[:-1]) + int(up[0])
+    return float(gross * (1 - fee_rate) ** (2 * n_trades) - 1)
+
+#權益曲線的年化夏普值 (無風險利率視為 0) 與最大回撤
+def equity_stats(equity: np.ndarray, bars_per_year: int) -> dict:
+    if len(equity) < 3 or np.any(equity[:-1] <= 0):
+        return {'sharpe': np.nan, 'max_drawdown_pct': np.nan, 'volatility_pct': np.nan}
+    returns = np.diff(equity) / equity[:-1]
+    std = returns.std(ddof=1)
+    peak = np.maximum.accumulate(equity)
+    return {
+        'sharpe': float(returns.mean() / std * np.sqrt(bars_per_year)) if std > 0 else np.nan,
+        'max_drawdown_pct': float(((equity - peak) / peak).min() * 100),
+        'volatility_pct': float(std * np.sqrt(bars_per_year) * 100),
+    }
+
+#回測結算報告 (所有計算皆為向量化，數百筆交易也只需數毫秒)
+def compute_report(core_data: pd.DataFrame, transactions: list, equity_curve: list,
+                   start_idx: int, end_idx: int, initial_capital: float,
+                   fee_rate: float, leverage_fee_rate: float, asset_type: str = 'Stock') -> dict:
+    open_ = core_data['Open'].to_numpy(dtype=float)
+    high = core_data['High'].to_numpy(dtype=float)
+    low = core_data['Low'].to_numpy(dtype=float)
+    close = core_data['Close'].to_numpy(dtype=float)
+    end_idx = min(end_idx, len(close) - 1)
+
+    equity = np.asarray(equity_curve, dtype=float)
+    final_equity = float(equity[-1]) if len(equity) else initial_capital
+
+    ledger = pd.DataFrame(transactions)
+    if ledger.empty or 'pos_id' not in ledger:
+        ledger = pd.DataFrame(columns=['pos_id', 'bar', '模式', '股數', '價格', '損益', '手續費'])
+    excursions = trade_excursions(ledger, high, low)
+
+    fees = ledger['手續費'].astype(float)
+    is_leverage = ledger['模式'].isin(['融資', '融券'])
+    total_fees = float(fees.sum())
+    financing = float(ledger['財務成本'].astype(float).sum()) if '財務成本' in ledger else 0.0
+    pnl = excursions['pnl']
+
+    return {
+        'final_equity': final_equity,
+        'total_return_pct': (final_equity / initial_capital - 1) * 100,
+        'buy_and_hold_pct': buy_and_hold_return(open_, close, start_idx, end_idx, fee_rate) * 100,
+        'perfect_long_pct': perfect_hindsight_return(close, start_idx, end_idx, fee_rate, allow_short=False) * 100,
+        'perfect_long_short_pct': perfect_hindsight_return(close, start_idx, end_idx, leverage_fee_rate, allow_short=True) * 100,
+        'n_trades': len(excursions),
+        'win_rate_pct': float((pnl > 0).mean() * 100) if len(pnl) else np.nan,
+        'time_in_market_pct': time_in_market(excursions, start_idx, end_idx) * 100,
+        'fees_total': total_fees,
+        'fees_spot': float(fees[~is_leverage].sum()),
+        'fees_leverage': float(fees[is_leverage].sum()),
+        'fee_drag_pct': total_fees / initial_capital * 100,
+        'financing_total': financing,
+        'financing_drag_pct': financing / initial_capital * 100,
+        **equity_stats(equity, BARS_PER_YEAR.get(asset_type, 252)),
+        'excursions': excursions,
+    }
@@ -1,663 +1,242 @@
 import streamlit as st
 import pandas as pd
-import plotly.graph_objects as go
-from plotly.subplots import make_subplots
-import numpy as np 
-import uuid 
-from datetime import datetime
-import random 
+import uuid
 
 #導入data_manager
 # 假設 data_manager.py 檔已存在且內容如預期
 from data_manager import (
-    fetch_historical_data, 
-    select_random_start_index, 
     get_price_info_by_index, 
-    VIEW_DAYS,             
-    MIN_SIMULATION_DAYS, 
-    MA_PERIODS
+    VIEW_DAYS
 )
-
-#初始化狀態與常數
-DEFAULT_TICKER = "TSLA" 
-INITIAL_CAPITAL = 100000.0
-MA_COLORS = {5: 'lightgray', 10: 'gray', 20: 'red', 60: 'blue', 120: 'white'}
-
-# --- 交易/槓桿常數 (Req 3: 修正手續費率) ---
-FEE_RATE = 0.005
-LEVERAGE_FEE_RATE = 0.01 
-MIN_MARGIN_RATE = 0.05 # 最小保證金比例 5% (用於計算強制平倉價，即最大槓桿 20倍)
-
-# --- 資產類型與單位映射 ---
-ASSET_CONFIGS = {
-    'Stock': {'unit': '股', 'mode_long': '現貨買', 'mode_short': '現貨空', 'mode_margin_long': '融資多', 'mode_margin_short': '融券空', 'default_qty': 1000.0, 'min_qty': 1.0}, 
-    # Req: 匯率調整為 100 點
-    'Forex': {'unit': '點', 'mode_long': '現貨買', 'mode_short': '現貨空', 'mode_margin_long': '保證金多', 'mode_margin_short': '保證金空', 'default_qty': 100.0, 'min_qty': 100.0}, 
-    'Crypto': {'unit': '顆', 'mode_long': '現貨買', 'mode_short': '現貨空', 'mode_margin_long': '合約多', 'mode_margin_short': '合約空', 'default_qty': 1.0, 'min_qty': 0.001}
-}
-# --- 交易模式映射 ---
-TRADE_MODE_MAP = {
-    'Spot_Buy': {'mode_type': 'Spot', 'position_type': '多頭', 'trans_type': '現貨買入開倉', 'pos_mode': '現貨'},
-    'Margin_Long': {'mode_type': 'Margin', 'position_type': '多頭', 'trans_type': '槓桿買入開倉', 'pos_mode': '融資'},
-    'Margin_Short': {'mode_type': 'Margin', 'position_type': '空頭', 'trans_type': '槓桿賣出開倉', 'pos_mode': '融券'},
-}
+#導入交易規則 (常數、倉位、推進與結算邏輯)
+from trade_engine import (
+    ASSET_CONFIGS,
+    TRADE_MODE_MAP,
+    FEE_RATE,
+    LEVERAGE_FEE_RATE,
+    INITIAL_CAPITAL,
+    init_session_state,
+    get_current_asset_value,
+    get_total_unrealized_pnl,
+    get_spot_summary,
+    settle_portfolio,
+    reset_state,
+    start_with_data,
+    start_window,
+    close_position_lot,
+    next_day,
+    next_ten_days,
+    volume_left,
+    slipped_price,
+    cancel_pending_orders,
+    execute_trade,
+    account_liquidation_price,
+    maintenance_margin,
+    open_returns,
+    bump_state_version,
+    MARGIN_MODES
+)
+from chart_manager import get_session_figure, update_overlays, position_levels, build_payoff_figure
+from chart_component import CHART_RENDERERS, DEFAULT_CHART_RENDERER, render_lite_chart
+from table_manager import get_transactions_table, get_positions_table, style_transactions_page, TX_PAGE_SIZE
+from perf_monitor import (
+    start_rerun,
+    finish_rerun,
+    timed,
+    count,
+    append_jsonl,
+    render_panel,
+    PROFILE_DEFAULT_ENABLED
+)
+from session_manager import touch_session, account_session, get_registry
+from data_loader import get_loader, job_progress
+from scanner import SCAN_UNIVERSE, get_scan_cache, refresh_scan
+from risk import VAR_CONFIDENCE, portfolio_risk, liquidation_table, book_arrays, payoff_ladder, payoff_at
+from analytics import compute_report
+from results_store import get_writer, build_record, leaderboard, outcome_stats
+from rooms import get_rooms, ROOM_RULE_KEYS
+from intrabar import INTRABAR_MODELS
+from fill_model import FILL_MODELS
+
+#閒置過久的 session 會被移出記憶體，互動時先從檢查點還原
+touch_session()
 
 #Session State 初始化
-st.session_state.setdefault('ticker', DEFAULT_TICKER)
-st.session_state.setdefault('asset_type', 'Stock') 
-st.session_state.setdefault('initialized', False)
-st.session_state.setdefault('core_data', None)
-st.session_state.setdefault('start_view_index', 0)
-st.session_state.setdefault('current_sim_index', 0)
-st.session_state.setdefault('max_sim_index', 0)
-st.session_state.setdefault('sim_active', True)
-st.session_state.setdefault('end_sim_index_on_settle', None) 
-st.session_state.setdefault('balance', INITIAL_CAPITAL)
+init_session_state()
 st.session_state.setdefault('plot_layout', None) # 用於保存 Plotly 佈局/縮放狀態 (Req 2)
+st.session_state.setdefault('chart_cache', {}) # 快取的基礎圖表 (推進時只追加新 K 棒)
+st.session_state.setdefault('chart_renderer', DEFAULT_CHART_RENDERER) # Plotly 或輕量 K 線元件
+st.session_state.setdefault('chart_stream', {}) # 輕量 K 線元件已傳送到前端的範圍
+st.session_state.setdefault('tx_table_cache', {}) # 快取已格式化的交易紀錄表格
+st.session_state.setdefault('positions_table_cache', {}) # 快取倉位表格
+st.session_state.setdefault('risk_cache', {}) # 風險面板的倉位陣列 (倉位變動時才重建)
+st.session_state.setdefault('payoff_cache', {}) # 假設價格損益表 (倉位變動時才重算)
+st.session_state.setdefault('render_cache', {}) # 以模擬狀態版本快取的衍生輸出 (指標、圖表、表格)
+st.session_state.setdefault('settle_report', {}) # 快取的回測結算報告
+st.session_state.setdefault('result_saved', False) # 本場結果是否已寫入紀錄庫
+st.session_state.setdefault('player_id', uuid.uuid4().hex[:8]) # 對戰房間中的玩家識別
+st.session_state.setdefault('player_name', f"玩家-{st.session_state.player_id[:4]}")
+st.session_state.setdefault('room_code', None) # 目前所在的對戰房間
+st.session_state.setdefault('pending_load', None) # 等待背景載入完成的回測設定 {'ticker', 'asset_type'}
+st.session_state.setdefault('scan_tickers', None) # 市場掃描的代碼清單 (按下掃描後設定)
+
+# 效能分析 (預設關閉，可由側邊欄或環境變數 KSIM_PROFILE=1 開啟)
+st.session_state.setdefault('profiling_enabled', PROFILE_DEFAULT_ENABLED)
+st.session_state.setdefault('profile_to_jsonl', False)
+start_rerun()
+
+#效能分析開關 (側邊欄)
+def profiling_controls():
+    st.markdown("---")
+    st.checkbox("🔧 效能分析 (Debug)", key='profiling_enabled', help="記錄每次重跑各區段的耗時。")
+    if st.session_state.profiling_enabled:
+        st.checkbox("寫入 JSONL", key='profile_to_jsonl', help="將每次重跑的紀錄附加到本機 JSON-lines 檔案。")
+
+#結束本次效能分析紀錄並顯示面板 (同時記錄本 session 的記憶體用量，超過伺服器預算時移出閒置 session)
+def finish_profiling():
+    session_bytes = account_session()
+    result = finish_rerun({
+        'ticker': st.session_state.ticker,
+        'initialized': st.session_state.initialized,
+        'current_sim_index': st.session_state.current_sim_index,
+        'n_positions': len(st.session_state.positions),
+        'n_transactions': len(st.session_state.transactions),
+        'session_kb': session_bytes / 1024,
+        'server_sessions': get_registry().stats(),
+    })
+    if result is not None and st.session_state.profile_to_jsonl:
+        append_jsonl(result)
+    render_panel(result)
 
-st.session_state.setdefault('positions', []) 
-st.session_state.setdefault('transactions', [])
-st.session_state.setdefault('start_date', None) 
-
-#計算當前總資產(現金+所有倉位的未實現市值/淨值)
-def get_current_asset_value(core_data, current_idx):
-    if st.session_state.core_data is None or st.session_state.core_data.empty:
-         return st.session_state.balance
-         
-    if st.session_state.sim_active and current_idx < len(core_data):
-        price = core_data['Open'].iloc[current_idx].item() if 'Open' in core_data.columns else 0.0
-    else:
-        # 模擬結束後，使用最後的現金餘額作為總資產
-        return st.session_state.balance
-    
-    # 總部位淨值計算
-    total_position_net_value = 0.0
-    
-    for pos in st.session_state.positions:
-        qty = pos['qty']
-        cost = pos['cost']
-        pos_mode = pos['pos_mode']
-        
-        # 現貨 (Spot): 市值 (Value)
-        if pos_mode == '現貨':
-             # 現貨部位的本金已從 balance 扣除，所以這裡計算市值來加入總資產
-             total_position_net_value += (qty * price)
-             
-        # 融資/融券 (Margin/Leveraged): 原始保證金 + 未實現損益
-        elif pos_mode in ['融資', '融券']:
-             # 原始保證金
-             initial_cost = pos['initial_cost'] 
-             leverage = pos['leverage']
-             margin_required = initial_cost / leverage
-             
-             # 未實現損益 (PnL)
-             if pos_mode == '融資':
-                 unrealized_pnl = (qty * price) - (qty * cost)
-             else: # 融券/合約空
-                 unrealized_pnl = (qty * cost) - (qty * price)
-                 
-             # 淨值 = 保證金 + 未實現損益
-             total_position_net_value += (margin_required + unrealized_pnl)
-            
-    # 總資產 = 可用現金(餘額) + 所有部位的淨值
-    return st.session_state.balance + total_position_net_value
-
-#計算所有倉位的總未實現損益 (包含現貨與槓桿)
-def get_total_unrealized_pnl(price):
-    total_pnl = 0.0
-    for pos in st.session_state.positions:
-        qty = pos['qty']
-        cost = pos['cost']
-        
-        # 多頭 (現貨/融資)
-        if pos['pos_mode'] in ['現貨', '融資']:
-            total_pnl += (qty * price) - (qty * cost)
-        # 空頭 (融券)
-        elif pos['pos_mode'] in ['融券']:
-            total_pnl += (qty * cost) - (qty * price)
-            
-    return total_pnl
-
-# --- 現貨部位彙總 ---
-def get_spot_summary(core_data, current_idx):
-    if not st.session_state.sim_active or core_data is None or current_idx >= len(core_data):
-        return {'qty': 0.0, 'avg_cost': 0.0, 'unrealized_pnl': 0.0}
-
-    price = core_data['Open'].iloc[current_idx].item()
-    
-    spot_positions = [pos for pos in st.session_state.positions if pos['pos_mode'] == '現貨']
-    
-    if not spot_positions:
-        return {'qty': 0.0, 'avg_cost': 0.0, 'unrealized_pnl': 0.0}
-
-    # Aggregate quantities and total cost for average calculation
-    total_qty = sum(pos['qty'] for pos in spot_positions)
-    total_cost = sum(pos['qty'] * pos['cost'] for pos in spot_positions)
-    
-    avg_cost = total_cost / total_qty if total_qty > 0 else 0.0
-    
-    # Calculate unrealized PnL
-    unrealized_pnl = sum((pos['qty'] * price) - (pos['qty'] * pos['cost']) for pos in spot_positions)
-    
-    return {
-        'qty': total_qty, 
-        'avg_cost': avg_cost, 
-        'unrealized_pnl': unrealized_pnl
-    }
 
-#資產歸零或為負時，結束模擬
-def check_and_end_simulation(asset_value):
-    if asset_value <= 0:
-        # 如果已經在結束狀態，就不重複報錯
-        if st.session_state.sim_active: 
-            st.session_state.sim_active = False
-            st.error("🚨風險控制警告！總資產已歸零或為負，模擬強制結束！")
-        return True
-    return False
-
-# --- 結算所有倉位 ---
-def settle_portfolio(force_end=False):
-    """
-    結算所有持倉部位。
-    如果 force_end=True (提早結算)，則結束模擬並使用收盤價結算。
-    如果 force_end=False (平倉所有倉位按鈕)，則繼續模擬並使用開盤價結算。
-    """
-    if not st.session_state.sim_active and not force_end:
-        return st.warning("模擬已結束。")
-
-    # 1. 決定結算價格
-    current_idx = st.session_state.current_sim_index
-    core_data = st.session_state.core_data
-
-    if core_data is None or core_data.empty:
-        return st.warning("無數據可供結算。")
-
-    if current_idx >= len(core_data):
-        # 處理索引超出範圍的情況 (例如 next_ten_days 跑到最後一天)
-        settle_price = core_data['Close'].iloc[-1].item() if not core_data.empty else 0.0
-    elif force_end:
-        # 提早結算，使用收盤價
-        settle_price = core_data['Close'].iloc[current_idx].item()
-    else:
-        # 手動平倉所有，使用開盤價
-        settle_price = core_data['Open'].iloc[current_idx].item()
-
-    if settle_price <= 0:
-        st.error("結算失敗：無法取得有效的結算價格。")
-        if force_end:
-             st.session_state.sim_active = False # 強制結束
-             st.session_state.end_sim_index_on_settle = current_idx
+#加入對戰房間：共用房間的回測視窗，只建立自己的倉位與交易紀錄
+def join_room(code):
+    room = get_rooms().get(code)
+    if room is None:
+        st.error(f"找不到房間 {code}，請確認房間代碼。")
         return
 
-    positions_to_close = list(st.session_state.positions) # 複製列表以迭代
-
-    if not positions_to_close:
-        if force_end:
-            st.info("模擬結束，沒有持倉部位需要結算。")
-    else:
-        if force_end:
-            st.info(f"開始結算 {len(positions_to_close)} 個持倉部位 (強制結束)，結算價格: ${settle_price:,.2f}")
-        else:
-             st.info(f"開始平倉 {len(positions_to_close)} 個持倉部位 (繼續模擬)，平倉價格: ${settle_price:,.2f}")
-             
-        for pos in positions_to_close:
-            # 必須檢查 pos 是否仍在 session_state.positions 內，
-            # 避免在迭代過程中被 close_position_lot 移除
-            if pos in st.session_state.positions: 
-                trade_type = '自動結算賣出平倉' if pos['pos_mode'] in ['現貨', '融資'] else '自動結算買回平倉'
-                
-                # close_position_lot 會更新 positions 列表
-                close_position_lot(pos['id'], pos['qty'], settle_price, trade_type, pos['pos_mode'], mode='自動結算')
-
-    # 2. 決定是否結束模擬狀態
-    if force_end:
-        st.session_state.sim_active = False
-        st.session_state.end_sim_index_on_settle = current_idx
-        
-        final_asset = get_current_asset_value(core_data, current_idx)
-        
-        # 避免重複顯示 "總資產已歸零" 的錯誤
-        if final_asset > 0:
-            st.success(f"所有部位結算完成！最終總資產: ${final_asset:,.2f}")
-    
-#重新開始回測前初始化
-def reset_state():
-    st.session_state.initialized = False
-    st.session_state.core_data = None
-    st.session_state.start_view_index = 0
-    st.session_state.current_sim_index = 0
-    st.session_state.max_sim_index = 0
-    st.session_state.sim_active = True
-    st.session_state.balance = INITIAL_CAPITAL
-    st.session_state.transactions = []
-    st.session_state.start_date = None
-    st.session_state.end_sim_index_on_settle = None 
-    st.session_state.positions = []
-    st.session_state.plot_layout = None # 重置圖表布局狀態
-
-#設定回測起始點 
-def initialize_data_and_simulation(asset_type):
-    # Req 4: 使用輸入的 ticker 抓數據，並使用選取的 asset_type 來定義交易規則。
-    ticker = st.session_state.ticker.upper()
-    
-    data = fetch_historical_data(ticker) 
+    reset_state()
+    st.session_state.ticker = room.ticker
+    st.session_state.update(room.rules) # 套用房間的交易規則 (不沿用自己在設定畫面的選擇)
+    start_window(room.data, room.offset, room.asset_type)
+    st.session_state.room_code = room.code
+    room.join(st.session_state.player_id, st.session_state.player_name, st.session_state.balance)
+    st.success(f"已加入房間 **{room.code}**：{room.ticker} ({room.asset_type})，共 {len(room.players)} 位玩家。")
+
+#建立對戰房間 (使用目前的代碼、資產類型與交易規則，數據只載入一次並由所有玩家共用)
+#數據與開始回測相同，經由 pending_load 在背景載入 (顯示進度，不阻塞頁面)，載入完成後才由 open_room 建立房間
+def create_room(asset_type):
+    st.session_state.pending_load = {
+        'ticker': st.session_state.ticker, 'asset_type': asset_type,
+        'room_rules': {k: st.session_state[k] for k in ROOM_RULE_KEYS},
+    }
 
-    if data is None: 
+#以載入完成的數據建立房間並加入
+def open_room(data, asset_type, rules):
+    if data is None:
         st.error(f"無法載入 {st.session_state.ticker} 的數據，請確認代碼是否正確。")
         return
-        
-    st.session_state.core_data = data
-    
-    total_days = len(data)
-    required_days = VIEW_DAYS + MIN_SIMULATION_DAYS
-    
-    if total_days < required_days:
-        st.warning(f"注意：{st.session_state.ticker} 有效數據 ({total_days} 天) 少於回測所需最低天數 ({required_days} 天)。回測將從最早數據開始，且長度不足 720 根。")
-            
-    st.success(f"{st.session_state.ticker} 數據載入成功！共 {total_days} 筆有效數據。")
-
-    start_indices = select_random_start_index(st.session_state.core_data)
-    if start_indices is not None:
-        start_view_idx, _ = start_indices
-        
-        data_end_idx = start_view_idx + required_days
-        truncated_data = st.session_state.core_data.iloc[start_view_idx:data_end_idx].reset_index(drop=True)
 
-        st.session_state.core_data = truncated_data
-        
-        st.session_state.start_view_index = 0
-        st.session_state.current_sim_index = VIEW_DAYS
-        st.session_state.max_sim_index = len(truncated_data) - 1
-        
-        st.session_state.initialized = True
-        st.session_state.sim_active = True
-        st.session_state.asset_type = asset_type
-        
-        date_ts = st.session_state.core_data['Date'].iloc[st.session_state.current_sim_index]
-        st.session_state.start_date = date_ts.to_pydatetime()
+    try:
+        room = get_rooms().create(st.session_state.ticker, asset_type, data, host=st.session_state.player_id, rules=rules)
+    except ValueError as e:
+        st.error(str(e))
+        return
+    join_room(room.code)
 
-        unit = ASSET_CONFIGS[asset_type]['unit']
-        st.success(f"回測已初始化！**{st.session_state.ticker}** 的日線模擬 ({unit}為單位)。")
-        st.info(f"💡 規則依據您選擇的 **{asset_type}** 類型執行。")
+#房間交易規則的說明文字 (房間內的玩家看到的是房間規則，而不是自己的設定選單)
+def room_rules_text(rules):
+    return (f"盤中觸發順序：{INTRABAR_MODELS[rules['intrabar_model']]} ｜ 成交模型：{FILL_MODELS[rules['fill_model']]}"
+            f" ｜ 保證金模式：{MARGIN_MODES[rules['margin_mode']]}")
 
+#對戰房間排行榜 (側邊欄)
+def room_leaderboard(total_asset):
+    room = get_rooms().get(st.session_state.room_code)
+    if room is None:
+        return
 
-#平倉記錄 
-def close_position_lot(pos_id: str, settle_qty: float, settle_price: float, trade_type: str, pos_mode: str, mode: str = '自動'):
-    pos_index = next((i for i, pos in enumerate(st.session_state.positions) if pos['id'] == pos_id), -1)
-    
-    if pos_index == -1: 
-        return False
-    
-    pos = st.session_state.positions[pos_index]
-    
-    # 數量檢查 (現在所有 qty 都是 float，直接比較)
-    if settle_qty <= 0 or settle_qty > pos['qty']: 
-        min_qty = ASSET_CONFIGS[st.session_state.asset_type]['min_qty']
-        st.error(f"平倉失敗：平倉股數 {settle_qty:,.3f} 無效或超過持有股數 {pos['qty']:,.3f}。")
-        return False
+    # 只回報自己的總資產，名次由房間以二分搜尋增量更新
+    room.report(st.session_state.player_id, total_asset, st.session_state.current_sim_index, not st.session_state.sim_active)
+    top, my_rank = room.standings(limit=10, player_id=st.session_state.player_id)
 
-    current_datetime, _, _ = get_price_info_by_index(st.session_state.core_data, st.session_state.current_sim_index)
-    
-    # --- 1. 計算手續費並扣除 (依照模式區分手續費率) ---
-    is_leverage = pos_mode in ['融資', '融券']
-    fee_rate_used = LEVERAGE_FEE_RATE if is_leverage else FEE_RATE
-    
-    close_amount = settle_qty * settle_price
-    close_fee = close_amount * fee_rate_used
-    
-    # 2. 扣除平倉手續費
-    st.session_state.balance -= close_fee
-    
-    # 3. 處理平倉邏輯
-    is_fully_closed = (settle_qty == pos['qty'])
-    
-    # 計算應歸還的保證金比例
-    original_qty = pos['qty']
-    original_initial_cost = pos['initial_cost'] 
-    leverage = pos.get('leverage', 1.0)
-    original_margin = original_initial_cost / leverage 
-    
-    # 按比例歸還保證金或現貨成本
-    if pos_mode == '現貨':
-        return_margin_or_cost = settle_qty * settle_price # 現貨是直接回流資金 (成本+損益)
-        realized_pnl = settle_qty * (settle_price - pos['cost'])
-    
-    # 槓桿部位 (融資/融券)
-    elif pos_mode in ['融資', '融券']: 
-        
-        is_long = (pos_mode == '融資')
-        
-        # PnL 計算
-        if is_long:
-            realized_pnl = settle_qty * (settle_price - pos['cost'])
-        else: # 融券/合約空
-            realized_pnl = settle_qty * (pos['cost'] - settle_price)
-            
-        # 歸還的保證金 (只有槓桿部位需要)
-        return_margin_or_cost = original_margin * (settle_qty / original_qty)
-    
-    else:
-        return False
-
-    # 4. 將 PnL + 歸還的保證金/現貨成本 存入現金
-    if pos_mode == '現貨':
-        # 現貨: 現金回流 = 平倉總額 (包含損益)
-        st.session_state.balance += return_margin_or_cost
+    st.markdown("---")
+    st.markdown(f"**🏆 房間 {room.code} 排行榜** (第 {my_rank} / {len(room.players)} 名)")
+    st.caption(f"房間規則 — {room_rules_text(room.rules)}")
+    st.dataframe(pd.DataFrame([
+        {'名次': p['rank'], '玩家': p['name'] + (' (你)' if p['player_id'] == st.session_state.player_id else ''),
+         '總資產': f"${p['equity']:,.0f}", '進度': '已結算' if p['finished'] else f"第 {p['bar'] - VIEW_DAYS} 天"}
+        for p in top
+    ]), hide_index=True, use_container_width=True)
+
+#背景載入進度 (定時重跑此區塊，載入完成後重跑整個頁面以建立回測)
+@st.fragment(run_every=0.3)
+def load_progress(ticker):
+    job = get_loader().status(ticker)
+    if job is None or job['future'].done():
+        st.rerun()
+    fraction, text = job_progress(job)
+    st.progress(fraction, text=f"📈 {ticker}：{text}")
+
+#以模擬狀態版本快取的衍生輸出：版本不變的重跑 (縮放圖表、切換元件焦點、編輯尚未儲存的 SL/TP) 直接沿用
+#版本改變時整份快取清空，name 可包含影響輸出的介面參數 (例如交易紀錄頁數)
+def versioned(name, compute):
+    cache = st.session_state.render_cache
+    if cache.get('version') != st.session_state.state_version:
+        cache.clear()
+        cache['version'] = st.session_state.state_version
+    if name not in cache:
+        cache[name] = compute()
+        count('render_cache.miss')
     else:
-        # 槓桿: 現金回流 = 歸還的保證金 + 實現損益
-        st.session_state.balance += (return_margin_or_cost + realized_pnl)
-    
-    # 5. 記錄交易紀錄
-    transactions_entry = {
-        '模式': pos_mode, 
-        '類型': trade_type, 
-        '股數': -settle_qty, # 平倉股數永遠是負的
-        '價格': settle_price, 
-        '金額': return_margin_or_cost, 
-        '損益': realized_pnl,
-        '開倉總值': settle_qty * pos['cost'], 
-        '手續費': close_fee,
-        '日期': current_datetime,
-        'leverage': leverage 
-    }
-    st.session_state.transactions.append(transactions_entry)
-    
-    # 6. 更新倉位或移除
-    if is_fully_closed:
-        st.session_state.positions.pop(pos_index)
-        st.info(f"倉位 ID {pos_id[-4:]} 已完全平倉 ({trade_type}) (實現損益: ${realized_pnl:,.2f})。")
-    else: 
-        new_qty = pos['qty'] - settle_qty
-        
-        # 按比例調整 pos 的 'initial_cost'，以計算剩餘部位的保證金
-        pos['initial_cost'] = pos['initial_cost'] * (new_qty / pos['qty'])
-        st.session_state.positions[pos_index]['qty'] = new_qty
-        
-        st.info(f"倉位 ID {pos_id[-4:]} 已部分平倉 {settle_qty:,.3f} {ASSET_CONFIGS[st.session_state.asset_type]['unit']} (剩餘 {new_qty:,.3f} {ASSET_CONFIGS[st.session_state.asset_type]['unit']})。")
-
-    # 7. 平倉後檢查風控
-    total_asset_new = get_current_asset_value(st.session_state.core_data, st.session_state.current_sim_index)
-    check_and_end_simulation(total_asset_new)
-    
-    return True
-    
-#檢查所有獨立倉位的止損/止盈/強制平倉觸發
-def check_sl_tp_trigger(core_data, current_idx):
-    if not st.session_state.sim_active: return
-    if current_idx >= len(core_data): return
-
-    high = core_data['High'].iloc[current_idx].item()
-    low = core_data['Low'].iloc[current_idx].item()
-    
-    positions_to_close_info = [] 
-    
-    for pos in st.session_state.positions:
-        sl = pos['sl']
-        tp = pos['tp']
-        triggered = False
-        settle_price = 0.0
-        close_type = ''
-        
-        # --- 強制平倉檢查 (Liquidation Check) ---
-        liq_price = pos.get('liquidation_price', 0.0)
-        is_margin = pos['pos_mode'] in ['融資', '融券']
-
-        if is_margin and liq_price > 0:
-            if pos['pos_mode'] == '融資': 
-                if low <= liq_price:
-                    settle_price = liq_price 
-                    triggered = True
-                    close_type = '強制平倉多頭'
-            
-            elif pos['pos_mode'] == '融券': 
-                 if high >= liq_price:
-                    settle_price = liq_price 
-                    triggered = True
-                    close_type = '強制平倉空頭'
-        
-        # --- SL/TP 檢查 (如果尚未觸發強制平倉) ---
-        if not triggered:
-            # 多頭 (現貨/融資)
-            if pos['pos_mode'] in ['現貨', '融資'] and pos['qty'] > 0:
-                if sl > 0 and low <= sl: 
-                    settle_price = sl 
-                    triggered = True
-                    close_type = 'SL/TP 賣出平倉'
-                    st.warning(f"🛑 倉位 {pos['id'][-4:]} **多頭停損觸發** 於 ${settle_price:,.2f}！")
-                    
-                elif tp > 0 and high >= tp: 
-                    settle_price = tp 
-                    triggered = True
-                    close_type = 'SL/TP 賣出平倉'
-                    st.success(f"✅ 倉位 {pos['id'][-4:]} **多頭停利觸發** 於 ${settle_price:,.2f}！")
-
-            # 空頭 (融券)
-            elif pos['pos_mode'] in ['融券'] and pos['qty'] > 0:
-                if sl > 0 and high >= sl: 
-                    settle_price = sl 
-                    triggered = True
-                    close_type = 'SL/TP 買回平倉'
-                    st.error(f"❌ 倉位 {pos['id'][-4:]} **空頭停損觸發** 於 ${settle_price:,.2f}！")
-                    
-                elif tp > 0 and low <= tp: 
-                    settle_price = tp 
-                    triggered = True
-                    close_type = 'SL/TP 買回平倉'
-                    st.success(f"✅ 倉位 {pos['id'][-4:]} **空頭停利觸發** 於 ${settle_price:,.2f}！")
-        
-        
-        if triggered and settle_price > 0:
-            positions_to_close_info.append({
-                'id': pos['id'], 
-                'qty': pos['qty'], 
-                'price': settle_price,
-                'type': close_type,
-                'pos_mode': pos['pos_mode']
-            })
-
-    #處理所有觸發的平倉
-    for close_info in positions_to_close_info:
-        close_position_lot(close_info['id'], close_info['qty'], close_info['price'], close_info['type'], close_info['pos_mode'], mode='自動')
-
-#執行單一交易日的模擬推進邏輯
-def _advance_one_day():
-    if not st.session_state.sim_active: return False
+        count('render_cache.hit')
+    return cache[name]
+
+#市場掃描結果表 (指標快照)
+def scan_results(tickers):
+    cache = get_scan_cache()
+    table = cache.table(tickers)
+    failed = [t for t in tickers if t in cache.failed]
+    if failed:
+        st.caption(f"載入失敗：{', '.join(failed)}")
+    if table.empty:
+        return table
+    st.dataframe(table, hide_index=True, use_container_width=True, column_config={
+        '收盤': st.column_config.NumberColumn(format="%.4f"),
+        'RSI': st.column_config.NumberColumn(format="%.1f"),
+        '年化波動 (%)': st.column_config.NumberColumn(format="%.1f"),
+    })
+    return table
 
-    if st.session_state.current_sim_index < st.session_state.max_sim_index:
-        st.session_state.current_sim_index += 1
+#掃描進度 (定時重跑此區塊，逐步顯示已完成的代碼，全部完成後重跑整個頁面)
+@st.fragment(run_every=0.5)
+def scan_progress(tickers):
+    pending = refresh_scan(get_scan_cache(), get_loader(), tickers)
+    if not pending:
+        st.rerun()
+    st.progress(1 - pending / len(tickers), text=f"🔎 掃描中… 已完成 {len(tickers) - pending} / {len(tickers)}")
+    scan_results(tickers)
 
-        #檢查SL/TP/Liq觸發
-        check_sl_tp_trigger(st.session_state.core_data, st.session_state.current_sim_index)
-        
-        # 檢查風控
-        total_asset_new = get_current_asset_value(st.session_state.core_data, st.session_state.current_sim_index)
-        return not check_and_end_simulation(total_asset_new)
-    else:
-        # 如果是最後一天，且沒有手動結束，則自動結算
-        settle_portfolio(force_end=True)
-        return False
-
-#模擬進入下一天
-def next_day():
-    if not st.session_state.sim_active: 
-        return st.warning("模擬已結束。")
-    
-    total_asset = get_current_asset_value(st.session_state.core_data, st.session_state.current_sim_index)
-    if check_and_end_simulation(total_asset): 
-        return
-    
-    _advance_one_day()
+#市場掃描 (設定頁)：代碼清單由背景載入器分批同時載入，已掃描過且數據未變動的代碼直接沿用快照
+def market_scanner():
+    universe = st.text_area("掃描代碼 (以逗號或空白分隔)", value=' '.join(SCAN_UNIVERSE), key='scan_universe_input')
+    if st.button("🔎 開始掃描"):
+        st.session_state.scan_tickers = list(dict.fromkeys(t.upper() for t in universe.replace(',', ' ').split()))
 
-#模擬進入下十天
-def next_ten_days():
-    if not st.session_state.sim_active: 
-        return st.warning("模擬已結束。")
-    
-    total_asset = get_current_asset_value(st.session_state.core_data, st.session_state.current_sim_index)
-    if check_and_end_simulation(total_asset): 
+    tickers = st.session_state.scan_tickers
+    if not tickers:
         return
-
-    days_to_advance = min(10, st.session_state.max_sim_index - st.session_state.current_sim_index)
-    
-    if days_to_advance <= 0:
-        settle_portfolio(force_end=True)
-        st.warning("回測結束：已到達最大模擬日數，已自動平倉。")
+    if refresh_scan(get_scan_cache(), get_loader(), tickers):
+        scan_progress(tickers)
         return
 
-    for _ in range(days_to_advance):
-        if not _advance_one_day():
-            break
-
-    if st.session_state.sim_active and st.session_state.current_sim_index >= st.session_state.max_sim_index:
-        settle_portfolio(force_end=True)
-        actual_sim_days = MIN_SIMULATION_DAYS 
-        st.warning(f"回測結束：已到達最大模擬日數 (共 {actual_sim_days} 根 K 棒)，已自動平倉。")
-
-#買入、賣出、做空功能 
-def execute_trade(trade_mode_key, quantity, price, leverage=1.0):
-    if not st.session_state.sim_active: return st.error("模擬已結束，無法執行交易。")
-    if quantity <= 0: 
-        min_qty = ASSET_CONFIGS[st.session_state.asset_type]['min_qty']
-        return st.error(f"交易數量必須大於或等於最小數量 {min_qty:,.3f}。")
-    if price <= 0: return st.error("價格必須大於0")
-
-    config = TRADE_MODE_MAP.get(trade_mode_key)
-    if not config: return st.error("無效的交易模式。")
-    
-    pos_mode_label = config['pos_mode']
-    trans_type_label = config['trans_type']
-    
-    cost_amount = quantity * price
-    
-    # 判斷是否為槓桿交易
-    is_leverage = trade_mode_key in ['Margin_Long', 'Margin_Short']
-    
-    # --- 1. 槓桿交易單向單倉位檢查 ---
-    if is_leverage:
-        # 檢查是否有同方向的槓桿倉位存在
-        existing_leverage_pos = [p for p in st.session_state.positions if p['pos_mode'] == pos_mode_label]
-        if existing_leverage_pos:
-            return st.error(f"🚨 槓桿交易限制：您已持有一個 {pos_mode_label} 的倉位 (ID: {existing_leverage_pos[0]['id'][-4:]})，請先平倉後再開新倉。")
-
-    # --- 2. 計算手續費並扣除 (依照模式區分手續費率) ---
-    fee_rate_used = LEVERAGE_FEE_RATE if is_leverage else FEE_RATE
-    fee = cost_amount * fee_rate_used
-    
-    st.session_state.balance -= fee
-    
-    if check_and_end_simulation(get_current_asset_value(st.session_state.core_data, st.session_state.current_sim_index)):
+    table = scan_results(tickers)
+    if table.empty:
         return
-
-    current_datetime, _, _ = get_price_info_by_index(st.session_state.core_data, st.session_state.current_sim_index)
-    
-    
-    # 現貨買入 & 槓桿買入 (多頭部位，資金流出)
-    if trade_mode_key in ['Spot_Buy', 'Margin_Long']:
-        
-        if trade_mode_key == 'Spot_Buy':
-            leverage = 1.0
-            margin_required = cost_amount 
-            liquidation_price = 0.0 
-        else: # Margin_Long
-            margin_required = cost_amount / leverage
-            
-            # 強制平倉價 (Long: Liq Price = Open Price * (1 - (1 / Leverage)))
-            liquidation_price = price * (1.0 - (1.0 / leverage))
-            
-        # 保證金檢查: 現金餘額必須覆蓋所需保證金
-        if st.session_state.balance < margin_required:
-             # 回補手續費，因為交易失敗
-             st.session_state.balance += fee
-             return st.error(f"[{pos_mode_label}]買入：現金餘額 (${st.session_state.balance:,.2f}) 不足支付所需的保證金/成本 (${margin_required:,.2f})！(已退還手續費)")
-        
-        unique_id = str(uuid.uuid4())[:8] 
-        
-        new_position = {
-            'id': unique_id,
-            'open_date': current_datetime,
-            'pos_mode': pos_mode_label, 
-            'qty': quantity, # float
-            'cost': price,
-            'initial_cost': cost_amount, 
-            'leverage': leverage,        
-            'liquidation_price': liquidation_price, 
-            'sl': 0.0,
-            'tp': 0.0
-        }
-        
-        # 資金扣除: 扣除保證金/現貨成本
-        st.session_state.balance -= margin_required
-        
-        st.success(f"[{pos_mode_label}] 成功開多 {quantity:,.3f} {ASSET_CONFIGS[st.session_state.asset_type]['unit']} @ ${price:,.2f} (槓桿: {leverage}x, 保證金: ${margin_required:,.2f})。")
-            
-        st.session_state.transactions.append({
-            '日期': current_datetime,
-            '模式': pos_mode_label, 
-            '類型': trans_type_label, 
-            '股數': quantity, 
-            '價格': price, 
-            '金額': -margin_required, 
-            '損益': np.nan,
-            '開倉總值': cost_amount, 
-            '手續費': fee,
-            'leverage': leverage 
-        })
-        
-        st.session_state.positions.append(new_position)
-        
-    # 槓桿賣出 (空頭部位)
-    elif trade_mode_key == 'Margin_Short':
-        
-        margin_required = cost_amount / leverage
-        
-        # 強制平倉價 (Short: Liq Price = Open Price * (1 + (1 / Leverage)))
-        liquidation_price = price * (1.0 + (1.0 / leverage))
-
-        # 保證金檢查
-        if st.session_state.balance < margin_required:
-             # 回補手續費
-             st.session_state.balance += fee
-             return st.error(f"[{pos_mode_label}]賣出：現金餘額 (${st.session_state.balance:,.2f}) 不足支付所需的保證金 (${margin_required:,.2f})！(已退還手續費)")
-
-        unique_id = str(uuid.uuid4())[:8] 
-        
-        new_position = {
-            'id': unique_id,
-            'open_date': current_datetime,
-            'pos_mode': pos_mode_label, 
-            'qty': quantity, # float
-            'cost': price,
-            'initial_cost': cost_amount, 
-            'leverage': leverage,        
-            'liquidation_price': liquidation_price, 
-            'sl': 0.0,
-            'tp': 0.0
-        }
-        
-        # 資金處理: 扣除保證金
-        st.session_state.balance -= margin_required
-        
-        st.success(f"[{pos_mode_label}] 成功開空 {quantity:,.3f} {ASSET_CONFIGS[st.session_state.asset_type]['unit']} @ ${price:,.2f} (槓桿: {leverage}x, 保證金: ${margin_required:,.2f})。")
-
-        st.session_state.transactions.append({ 
-            '日期': current_datetime,
-            '模式': pos_mode_label, 
-            '類型': trans_type_label, 
-            '股數': -quantity, 
-            '價格': price, 
-            '金額': -margin_required, 
-            '損益': np.nan,
-            '開倉總值': cost_amount, 
-            '手續費': fee,
-            'leverage': leverage 
-        })
-        
-        st.session_state.positions.append(new_position)
-    
-    #交易後檢查風控
-    total_asset_new = get_current_asset_value(st.session_state.core_data, st.session_state.current_sim_index)
-    check_and_end_simulation(total_asset_new)
-
+    choices = table.loc[table['可完整回測'], '代碼'].tolist()
+    if choices:
+        pick = st.selectbox("選擇代碼", choices, key='scan_pick')
+        st.button("使用此代碼回測", on_click=lambda: st.session_state.update(ticker=pick))
 
 #GUI
 st.set_page_config(layout="wide")
@@ -674,19 +253,112 @@ if not st.session_state.initialized:
             format_func=lambda x: {'Stock': '📈 股票', 'Forex': '💱 匯率', 'Crypto': '₿ 加密貨幣'}[x]
         )
         
+        # 輸入的房間代碼存在時，加入後套用房間的交易規則，因此只顯示房間規則而不顯示設定選單
+        joining_room = get_rooms().get(st.session_state.get('room_code_input'))
+        if joining_room is None:
+            # 同一根 K 棒同時碰到停損/停利/強平價時的判斷方式
+            st.session_state.intrabar_model = st.selectbox(
+                "盤中觸發順序",
+                list(INTRABAR_MODELS),
+                index=list(INTRABAR_MODELS).index(st.session_state.intrabar_model),
+                format_func=INTRABAR_MODELS.get,
+                help="保守：強平與停損優先，以觸發價成交。開盤跳空：開盤已越過的價位以開盤價成交。路徑推估/布朗橋：依盤中價格路徑判斷先碰到哪個價位。例外：逐倉強制平倉在所有模型下都以強平價成交 (不以跳空開盤價成交，也不支付滑價)。"
+            )
+            st.session_state.fill_model = st.selectbox(
+                "成交模型",
+                list(FILL_MODELS),
+                index=list(FILL_MODELS).index(st.session_state.fill_model),
+                format_func=FILL_MODELS.get,
+                help="成交量限制：每根 K 棒最多成交該根成交量的固定比例，其餘委託於之後的 K 棒繼續成交；所有成交 (含停損與全倉強平) 支付價差與衝擊成本；逐倉強制平倉以強平價成交，不支付滑價。"
+            )
+            st.session_state.margin_mode = st.selectbox(
+                "保證金模式",
+                list(MARGIN_MODES),
+                index=list(MARGIN_MODES).index(st.session_state.margin_mode),
+                format_func=MARGIN_MODES.get,
+                help="逐倉：每個槓桿倉位依自己的保證金計算強制平倉價。全倉：所有現金與倉位共同擔保，帳戶權益低於維持保證金 (持倉市值 5%) 時依虧損大小依序強制平倉。"
+            )
+        else:
+            st.info(f"房間 {joining_room.code} 的規則 (加入後套用)：{room_rules_text(joining_room.rules)}")
+        
+        st.session_state.chart_renderer = st.selectbox(
+            "K 線圖元件",
+            list(CHART_RENDERERS),
+            index=list(CHART_RENDERERS).index(st.session_state.chart_renderer),
+            format_func=CHART_RENDERERS.get,
+            help="輕量 K 線元件：K 棒以二進位 float32 傳送並保留在瀏覽器，每次操作只傳送新增的 K 棒與變動的倉位線。"
+        )
+        
         st.session_state.ticker = st.text_input(
             "請輸入代碼 (e.g. TSLA, JPY=X, BTC-USD)",
             value=st.session_state.ticker 
         ).strip().upper() 
         
+        # 輸入代碼後立即在背景預先載入，按下開始時通常已經完成
+        if st.session_state.ticker:
+            get_loader().request([st.session_state.ticker])
+        
         if st.button("🚀點擊開始回測"):
             if st.session_state.ticker:
                 reset_state()
-                initialize_data_and_simulation(selected_asset_type)
+                st.session_state.pending_load = {'ticker': st.session_state.ticker, 'asset_type': selected_asset_type}
             else:
                 st.error("請輸入有效的代碼！")
+        
+        #對戰房間
+        st.markdown("---")
+        st.subheader("👥 對戰房間")
+        st.text_input("玩家名稱", key='player_name')
+        if st.button("建立房間 (使用上方代碼與資產類型)"):
+            if st.session_state.ticker:
+                create_room(selected_asset_type)
+            else:
+                st.error("請輸入有效的代碼！")
+        room_code_input = st.text_input("房間代碼", key='room_code_input').strip().upper()
+        if st.button("加入房間"):
+            join_room(room_code_input)
+        
+        profiling_controls()
+    
+    #歷史戰績 (紀錄庫中已結束的場次)
+    with st.expander(f"📊 歷史戰績：{st.session_state.ticker or '全部'}", expanded=False):
+        stats = outcome_stats(ticker=st.session_state.ticker or None)
+        if stats['sessions'] == 0:
+            st.caption("尚無已結束的場次。")
+        else:
+            outcome_names = {'profit': '獲利', 'loss': '虧損', 'liquidated': '曾被強制平倉', 'bust': '爆倉'}
+            st.dataframe(pd.DataFrame([
+                {'結果': outcome_names.get(k, k), '場次': v['count'], '比例': f"{v['fraction']:.1%}", '平均報酬 (%)': round(v['avg_return_pct'], 2)}
+                for k, v in stats['outcomes'].items()
+            ]), hide_index=True, use_container_width=True)
+            st.markdown("**排行榜**")
+            st.dataframe(pd.DataFrame(leaderboard(ticker=st.session_state.ticker or None, limit=10))[
+                ['finished_at', 'ticker', 'total_return_pct', 'final_equity', 'n_trades', 'max_leverage']
+            ].rename(columns={'finished_at': '時間', 'ticker': '代碼', 'total_return_pct': '報酬 (%)', 'final_equity': '最終總資產', 'n_trades': '交易數', 'max_leverage': '最大槓桿'}),
+                hide_index=True, use_container_width=True)
+    
+    with st.expander("🔎 市場掃描", expanded=st.session_state.scan_tickers is not None):
+        market_scanner()
+    
+    pending = st.session_state.pending_load
+    if pending is not None:
+        job = get_loader().request([pending['ticker']])[pending['ticker']]
+        if job['future'].done():
+            st.session_state.pending_load = None
+            # 按下開始時已預先載入完成 / 需要等待背景載入
+            count('data_loader.waited' if pending.get('waited') else 'data_loader.prefetched')
+            if job['cache'] is not None:
+                count(f"data_loader.{job['cache']}") # 指標數據快取命中/未命中
+            if 'room_rules' in pending:
+                open_room(job['future'].result(), pending['asset_type'], pending['room_rules'])
+            else:
+                start_with_data(job['future'].result(), pending['asset_type'])
+        else:
+            pending['waited'] = True
+            load_progress(pending['ticker'])
     
     st.info(f"請在左側欄選擇資產類型 (定義規則)，輸入代碼 (抓取數據)，並點擊 '🚀點擊開始回測'。目前預設代碼: {st.session_state.ticker}")
+    finish_profiling()
     st.stop()
     
 #獲取當前數據
@@ -811,7 +483,9 @@ with st.sidebar:
         # 預估強制平倉數值
         estimated_liq_price = 0.0
         liq_display = "N/A"
-        if is_margin_trade:
+        if is_margin_trade and st.session_state.margin_mode == 'cross':
+             liq_display = "全倉 (依帳戶強平價)"
+        elif is_margin_trade:
              if trade_mode_option == 'Margin_Long':
                  estimated_liq_price = open_price * (1.0 - (1.0 / leverage))
              elif trade_mode_option == 'Margin_Short':
@@ -821,6 +495,12 @@ with st.sidebar:
                   liq_display = f"${estimated_liq_price:,.2f}"
 
         st.info(f"交易參考價 (開盤價): **${open_price:,.2f}**")
+        if st.session_state.fill_model == 'volume' and final_quantity > 0:
+            # 本根 K 棒可成交的數量與預估滑價 (只用到目前這根 K 棒的成交量)
+            fill_now = min(final_quantity, max(0.0, volume_left(current_idx)))
+            side = 1.0 if trade_mode_option in ['Spot_Buy', 'Margin_Long'] else -1.0
+            slip_pct = (slipped_price(open_price, side, fill_now) / open_price - 1.0) * side * 100 if fill_now > 0 else 0.0
+            st.markdown(f"**本根可成交:** **{fill_now:,.3f}** / {final_quantity:,.3f} {unit_name} (預估滑價 {slip_pct:.3f}%)")
         st.markdown(f"**開倉總值:** **${estimated_cost:,.2f}**")
         st.markdown(f"**預估手續費 ({fee_rate_used_display*100:.2f}%):** **${estimated_fee:,.2f}**")
         if is_margin_trade:
@@ -833,6 +513,13 @@ with st.sidebar:
                 execute_trade(trade_mode_option, final_quantity, open_price, leverage)
             else:
                 st.error(f"{unit_name}數量無效或價格無效，無法執行交易！")
+        
+        #受成交量限制尚未成交的委託
+        if st.session_state.pending_orders:
+            st.markdown("**⏳ 未成交委託**")
+            for order in st.session_state.pending_orders:
+                st.caption(f"{order['id'][-4:]} {asset_config[{'Spot_Buy': 'mode_long', 'Margin_Long': 'mode_margin_long', 'Margin_Short': 'mode_margin_short'}[order['trade_mode']]]}：剩餘 {order['remaining']:,.3f} / {order['qty']:,.3f} {unit_name}")
+            st.button("取消未成交委託", on_click=cancel_pending_orders, use_container_width=True)
     else:
         st.info("模擬已結束。請點擊 '重新開始回測'。")
 
@@ -843,13 +530,55 @@ with st.sidebar:
     
     current_open_price = open_price if open_price > 0 else 0.0
     
-    unrealized_pnl = get_total_unrealized_pnl(current_open_price)
-    total_asset = get_current_asset_value(core_data, current_idx)
-    spot_summary = get_spot_summary(core_data, current_idx) 
+    #帳戶數值 (總資產、未實現損益、全倉維持保證金、風險面板)，只在模擬狀態改變時重算
+    def account_summary():
+        summary = {
+            'unrealized_pnl': get_total_unrealized_pnl(current_open_price),
+            'total_asset': get_current_asset_value(core_data, current_idx),
+            'spot': get_spot_summary(core_data, current_idx),
+            'financing': sum(pos.get('financing', 0.0) for pos in st.session_state.positions),
+            'account_liq': None,
+            'maintenance': None,
+            'risk': None,
+        }
+        if st.session_state.margin_mode == 'cross' and st.session_state.margin_totals['gross'] > 0:
+            summary['account_liq'] = account_liquidation_price()
+            summary['maintenance'] = maintenance_margin(current_open_price)
+        if st.session_state.sim_active and st.session_state.positions:
+            summary['risk'] = portfolio_risk(st.session_state.risk_cache, st.session_state.positions, st.session_state.margin_totals,
+                                             st.session_state.balance, current_open_price, open_returns(core_data), current_idx, summary['account_liq'])
+        return summary
+
+    summary = versioned('account_summary', account_summary)
+    total_asset = summary['total_asset']
+    spot_summary = summary['spot']
+    account_liq = summary['account_liq']
     
     st.metric("總資產 (含未實現)", f"${total_asset:,.2f}")
     st.metric("現金餘額 (可用)", f"${st.session_state.balance:,.2f}")
-    st.metric("當日未實現損益 (開盤價)", f"${unrealized_pnl:,.2f}")
+    st.metric("當日未實現損益 (開盤價)", f"${summary['unrealized_pnl']:,.2f}")
+    if summary['financing'] != 0:
+        st.metric("已計提持有成本 (平倉時支付)", f"${summary['financing']:,.2f}")
+    if summary['maintenance'] is not None:
+        # 全倉：帳戶權益對總維持保證金，以及讓兩者相等的帳戶強制平倉價
+        st.metric("維持保證金 (全倉)", f"${summary['maintenance']:,.2f}")
+        st.metric("帳戶強制平倉價", f"${max(account_liq[0], 0.0):,.2f}" if account_liq is not None else "N/A")
+
+    #風險面板 (曝險、槓桿、強平距離與歷史模擬 VaR/CVaR)
+    risk = summary['risk']
+    if risk is not None:
+        st.markdown("---")
+        st.markdown(f"**⚠️ 風險面板** (最近 {risk['scenarios']} 根 K 棒報酬的歷史模擬)")
+        st.metric("總曝險 / 淨曝險", f"${risk['gross_exposure']:,.0f} / ${risk['net_exposure']:+,.0f}")
+        st.metric("有效槓桿 (總曝險 / 總資產)", f"{risk['leverage']:,.2f}x" if risk['leverage'] is not None else "N/A")
+        st.metric(f"單根 VaR ({VAR_CONFIDENCE:.0%})", f"${risk['var']:,.2f}")
+        st.metric(f"單根 CVaR ({VAR_CONFIDENCE:.0%})", f"${risk['cvar']:,.2f}")
+        liq_table = liquidation_table(risk)
+        if not liq_table.empty:
+            st.dataframe(liq_table, hide_index=True, use_container_width=True, column_config={
+                '強平價': st.column_config.NumberColumn(format="$%.2f"),
+                '距離 (%)': st.column_config.NumberColumn(format="%+.2f%%"),
+            })
 
     st.markdown("---")
     st.markdown("**現貨部位彙總** (現貨模式)")
@@ -857,212 +586,163 @@ with st.sidebar:
     st.metric("現貨均價", f"${spot_summary['avg_cost']:,.2f}")
     st.metric("現貨未實現損益", f"${spot_summary['unrealized_pnl']:,.2f}")
 
+    if st.session_state.room_code:
+        room_leaderboard(total_asset)
 
-#K線圖
-display_start_idx = 0 
-display_end_idx = current_idx + 1
+    profiling_controls()
 
-data_to_display = core_data.iloc[display_start_idx : display_end_idx].copy()
-x_axis_date = data_to_display['Date'] 
 
-fig = make_subplots(
-    rows=3, cols=1, 
-    row_heights=[0.6, 0.2, 0.2], 
-    shared_xaxes=True,
-    vertical_spacing=0.02,
-    subplot_titles=(f"{st.session_state.ticker} 日線 K 棒 (MA $5, 10, 20, 60, 120$)", "成交量", "RSI(14)") 
-)
+#K線圖 (每個 session 快取一份基礎圖表，推進時只追加新 K 棒，倉位線另外更新)
+display_start_idx = 0 
 
-# K線 
-fig.add_trace(go.Candlestick(x=x_axis_date, open=data_to_display['Open'], high=data_to_display['High'],
-                             low=data_to_display['Low'], close=data_to_display['Close'], name='K-Line',
-                             customdata=data_to_display[['Open', 'High', 'Low', 'Close']].values,
-                             hovertemplate = '<b>開盤</b>: $%{customdata[0]:.2f}<br>' +
-                                             '<b>最高</b>: $%{customdata[1]:.2f}<br>' +
-                                             '<b>最低</b>: $%{customdata[2]:.2f}<br>' +
-                                             '<b>收盤</b>: $%{customdata[3]:.2f}<extra>K 線</extra>'), row=1, col=1)
-
-# MA均線
-for p_ma in MA_PERIODS:
-    fig.add_trace(go.Scatter(x=x_axis_date, y=data_to_display[f'MA{p_ma}'], mode='lines', 
-                             name=f'MA{p_ma}', line=dict(color=MA_COLORS[p_ma], width=1),
-                             hovertemplate=f'MA{p_ma}: %{{y:.2f}}<extra></extra>'), row=1, col=1) 
-    
-# --- 🎯 繪製倉位關鍵線 (開倉價, 強制平倉價, SL, TP) 並貼齊價格刻度 (Req 1) ---
-for pos in st.session_state.positions:
-    # 價格資訊 (開倉價, 強制平倉價, SL, TP)
-    lines_to_plot = {
-        '開倉價': {'price': pos['cost'], 'color': 'yellow', 'dash': 'dot'},
+settle_end_idx = None
+if not st.session_state.sim_active and st.session_state.end_sim_index_on_settle is not None:
+    settle_end_idx = st.session_state.end_sim_index_on_settle
+
+saved_range = None
+if st.session_state.plot_layout and 'xaxis.range' in st.session_state.plot_layout:
+    saved_range = st.session_state.plot_layout['xaxis.range']
+
+if st.session_state.chart_renderer == 'lite':
+    # 輕量 K 線元件：只傳送新增的 K 棒與變動的倉位線，縮放/平移範圍同樣存入 plot_layout
+    with timed('figure_serialization'):
+        reported_range = render_lite_chart(st.session_state.chart_stream, core_data, current_idx, st.session_state.ticker,
+                                           st.session_state.positions, settle_end_idx, saved_range)
+    if reported_range is not None:
+        st.session_state.plot_layout = {f'{axis}.range': reported_range for axis in ['xaxis', 'xaxis2', 'xaxis3']} if reported_range else None
+else:
+    # 只有可視範圍 (加上緩衝) 送出完整 K 棒，更早的歷史以聚合資料顯示
+    visible_range = None
+    if st.session_state.plot_layout and 'xaxis.range' in st.session_state.plot_layout:
+        try:
+            visible_range = [float(v) for v in st.session_state.plot_layout['xaxis.range']]
+        except (TypeError, ValueError):
+            visible_range = None
+
+    #基礎圖表與倉位線 (同一狀態版本與可視範圍只建立一次)
+    def session_figure():
+        fig = get_session_figure(st.session_state.chart_cache, core_data, current_idx, st.session_state.ticker, visible_range)
+        update_overlays(st.session_state.chart_cache, st.session_state.positions, settle_end_idx, display_start_idx)
+        return fig
+
+    with timed('figure_build'):
+        fig = versioned(('figure', tuple(visible_range or ())), session_figure)
+
+    # Req 2: 應用上一次儲存的縮放狀態 (在基礎佈局設定之後)
+    if st.session_state.plot_layout:
+        try:
+            if 'xaxis.range' in st.session_state.plot_layout:
+                 # 僅應用 x 軸的範圍設定
+                 fig.update_layout({
+                     'xaxis': {'range': st.session_state.plot_layout['xaxis.range']},
+                     'xaxis2': {'range': st.session_state.plot_layout['xaxis2.range']},
+                     'xaxis3': {'range': st.session_state.plot_layout['xaxis3.range']},
+                 })
+        except Exception as e:
+             # 如果應用失敗，重置狀態
+             st.session_state.plot_layout = None
+             # print(f"Failed to apply previous layout: {e}") 
+        
+    plotly_config = {
+        'displayModeBar': True,  
+        'scrollZoom': True,      
+        'modeBarButtonsToRemove': [
+            'select2d', 
+            'lasso2d', 
+            'zoom2d', 
+            'hoverClosestCartesian', 
+            'hoverCompareCartesian'
+        ],
+        'modeBarButtonsToAdd': ['pan2d', 'zoomIn2d', 'zoomOut2d', 'resetScale2d'] 
     }
-    
-    # 判斷方向
-    is_long_pos = pos['pos_mode'] in ['現貨', '融資']
-    pos_direction = '多' if is_long_pos else '空'
-    
-    # 只有槓桿部位才會有強制平倉價
-    if pos['pos_mode'] in ['融資', '融券']: 
-         lines_to_plot['強制平倉'] = {'price': pos.get('liquidation_price', 0.0), 'color': 'red', 'dash': 'dash'}
-    
-    # 止損/止盈 (如果設定了)
-    if pos['sl'] > 0:
-        lines_to_plot['止損價 (SL)'] = {'price': pos['sl'], 'color': 'red', 'dash': 'dot'}
-    if pos['tp'] > 0:
-        lines_to_plot['止盈價 (TP)'] = {'price': pos['tp'], 'color': 'green', 'dash': 'dot'}
-
-    for name, line_info in lines_to_plot.items():
-        if line_info['price'] > 0:
-            
-            # 簡化標籤名稱
-            short_name = ''
-            if name == '開倉價': short_name = '開'
-            elif '止損' in name: short_name = 'SL'
-            elif '止盈' in name: short_name = 'TP'
-            elif '強制平倉' in name: short_name = 'Liq'
-
-            # Req 1: 標籤格式：[多/空][開/SL/TP] @ $價格
-            annotation_label = f"{pos_direction}{short_name} @ ${line_info['price']:,.2f}"
-            
-            fig.add_hline(
-                y=line_info['price'], 
-                line_width=1, 
-                line_dash=line_info['dash'], 
-                line_color=line_info['color'], 
-                row=1, 
-                col=1,
-                name=f"{name} ({pos['id'][-4:]})",
-                annotation_text=annotation_label, 
-                # 關鍵設定：將標籤貼在右側 Y 軸上
-                annotation_position="right", 
-                annotation_x=1.01,         # 標註的 X 位置 (使用 paper 座標)
-                annotation_xref="paper",   # 使用 paper 座標系統
-                annotation_font_color=line_info['color'],
-                # Req 1: 透明背景
-                annotation_bgcolor='rgba(0,0,0,0)',
-                annotation_bordercolor='rgba(0,0,0,0)',
-            )
-
-# 成交量 
-fig.add_trace(go.Bar(x=x_axis_date, y=data_to_display['Volume'], name='Volume', marker_color='grey',
-                     hovertemplate = '<b>成交量</b>: %{y:,.0f}<extra></extra>'), row=2, col=1)
-
-# RSI 
-fig.add_trace(go.Scatter(x=x_axis_date, y=data_to_display['RSI'], mode='lines', name='RSI(14)', 
-                         line=dict(color='orange', width=2),
-                         hovertemplate = '<b>RSI(14)</b>: %{y:.2f}<extra></extra>'), row=3, col=1)
 
-# RSI 70/30臨界線 
-fig.add_hline(y=70, line_dash="dash", line_color="red", line_width=1, row=3, col=1, name='Overbought')
-fig.add_hline(y=30, line_dash="dash", line_color="green", line_width=1, row=3, col=1, name='Oversold')
-
-# 圖表顯示風格 
-fig.update_xaxes(showticklabels=False, row=1, col=1, type='category')
-fig.update_xaxes(showticklabels=False, row=2, col=1, type='category')
-fig.update_xaxes(showticklabels=False, row=3, col=1, type='category')
-
-# ... VLINE logic ... (保持不變)
-if not st.session_state.sim_active and st.session_state.end_sim_index_on_settle is not None:
-    start_sim_relative_index = VIEW_DAYS 
-    if start_sim_relative_index >= 0: 
-        for r in [1, 2, 3]:
-            fig.add_vline(
-                x=start_sim_relative_index, 
-                line_width=2, 
-                line_dash="dot", 
-                line_color="green", 
-                row=r, 
-                col=1,
-                annotation_text="回測開始日",
-                annotation_position="top left"
-            )
-        
-    end_sim_relative_index = st.session_state.end_sim_index_on_settle - display_start_idx
-    
-    for r in [1, 2, 3]:
-        fig.add_vline(
-            x=end_sim_relative_index, 
-            line_width=2, 
-            line_dash="dot", 
-            line_color="white", 
-            row=r, 
-            col=1,
-            annotation_text="回測結束日",
-            annotation_position="top right"
+    # 圖表序列化 (st.plotly_chart 內部將整張圖轉為 JSON)
+    with timed('figure_serialization'):
+        chart_event = st.plotly_chart(
+            fig, 
+            use_container_width=True, 
+            config=plotly_config,
+            # 新增 key，讓 Streamlit 自動追蹤圖表狀態
+            key="main_candlestick_chart" 
         )
 
-# Req 2: 應用上一次儲存的縮放狀態 (在基礎佈局設定之後)
-if st.session_state.plot_layout:
-    try:
-        if 'xaxis.range' in st.session_state.plot_layout:
-             # 僅應用 x 軸的範圍設定
-             fig.update_layout({
-                 'xaxis': {'range': st.session_state.plot_layout['xaxis.range']},
-                 'xaxis2': {'range': st.session_state.plot_layout['xaxis2.range']},
-                 'xaxis3': {'range': st.session_state.plot_layout['xaxis3.range']},
-             })
-    except Exception as e:
-         # 如果應用失敗，重置狀態
-         st.session_state.plot_layout = None
-         # print(f"Failed to apply previous layout: {e}") 
-        
-fig.update_layout(
-    xaxis_rangeslider_visible=False, 
-    template="plotly_dark", 
-    height=800, 
-    showlegend=True, 
-    dragmode='pan', 
-    legend=dict(orientation="h", yanchor="bottom", y=1.02, xanchor="right", x=1),
-    hovermode='x unified',
-    hoverlabel=dict(bgcolor="rgba(128, 128, 128, 0.7)", font_size=12, font_color="white"),
-    margin=dict(t=50, b=50, l=50, r=100), 
-    
-    xaxis=dict(showspikes=True, spikemode='across', spikesnap='data', spikedash='dot', spikethickness=1, unifiedhovertitle=dict(text='\u200b')),
-    xaxis2=dict(unifiedhovertitle=dict(text='\u200b')), 
-    xaxis3=dict(unifiedhovertitle=dict(text='\u200b')),
-    
-    yaxis=dict(showspikes=True, spikemode='across', spikesnap='data', spikedash='dot', spikethickness=1, side='right', type='log'), 
-    yaxis2=dict(showspikes=True, spikemode='across', spikesnap='data', spikedash='dot', spikethickness=1, side='right'),
-    yaxis3=dict(showspikes=True, spikemode='across', spikesnap='data', spikedash='dot', spikethickness=1, side='right')
-)
-
-plotly_config = {
-    'displayModeBar': True,  
-    'scrollZoom': True,      
-    'modeBarButtonsToRemove': [
-        'select2d', 
-        'lasso2d', 
-        'zoom2d', 
-        'hoverClosestCartesian', 
-        'hoverCompareCartesian'
-    ],
-    'modeBarButtonsToAdd': ['pan2d', 'zoomIn2d', 'zoomOut2d', 'resetScale2d'] 
-}
-
-chart_event = st.plotly_chart(
-    fig, 
-    use_container_width=True, 
-    config=plotly_config,
-    # 新增 key，讓 Streamlit 自動追蹤圖表狀態
-    key="main_candlestick_chart" 
-)
-
-# 捕捉並儲存新的佈局狀態
-# 儲存使用者對 x 軸的縮放和平移 (即 rangeslider.range 和 range)
-if "main_candlestick_chart" in st.session_state and st.session_state.main_candlestick_chart:
-    current_layout = st.session_state.main_candlestick_chart.get('layout', {})
-    
-    if current_layout:
-        saved_layout = {}
-        # 尋找所有 x 軸的 range 資訊
-        for i in [None, 2, 3]:
-            xaxis_key = f'xaxis{i}' if i else 'xaxis'
-            range_key = f'{xaxis_key}.range'
+    # 捕捉並儲存新的佈局狀態
+    # 儲存使用者對 x 軸的縮放和平移 (即 rangeslider.range 和 range)
+    if "main_candlestick_chart" in st.session_state and st.session_state.main_candlestick_chart:
+        current_layout = st.session_state.main_candlestick_chart.get('layout', {})
+    
+        if current_layout:
+            saved_layout = {}
+            # 尋找所有 x 軸的 range 資訊
+            for i in [None, 2, 3]:
+                xaxis_key = f'xaxis{i}' if i else 'xaxis'
+                range_key = f'{xaxis_key}.range'
             
-            # 必須檢查 key 是否存在，避免使用者還沒縮放就報錯
-            if xaxis_key in current_layout and 'range' in current_layout[xaxis_key]:
-                 saved_layout[range_key] = current_layout[xaxis_key]['range']
+                # 必須檢查 key 是否存在，避免使用者還沒縮放就報錯
+                if xaxis_key in current_layout and 'range' in current_layout[xaxis_key]:
+                     saved_layout[range_key] = current_layout[xaxis_key]['range']
                  
-        if saved_layout:
-             st.session_state.plot_layout = saved_layout
+            if saved_layout:
+                 st.session_state.plot_layout = saved_layout
+
+
+#回測結算報告 (模擬結束後顯示，交易紀錄不變時沿用快取)
+if not st.session_state.sim_active:
+    report_key = (len(st.session_state.transactions), len(st.session_state.equity_curve))
+    report_cache = st.session_state.settle_report
+    report_end_idx = st.session_state.end_sim_index_on_settle
+    if report_end_idx is None:
+        report_end_idx = current_idx
+    if report_cache.get('key') != report_key:
+        with timed('settle_report'):
+            report_cache['report'] = compute_report(
+                core_data, st.session_state.transactions, st.session_state.equity_curve,
+                VIEW_DAYS, report_end_idx,
+                INITIAL_CAPITAL, FEE_RATE, LEVERAGE_FEE_RATE, asset_type
+            )
+        report_cache['key'] = report_key
+    report = report_cache['report']
+
+    # 每場只寫入一次，由背景執行緒分批寫入紀錄庫
+    if not st.session_state.result_saved:
+        with timed('results_store.submit'):
+            get_writer().submit(build_record(
+                report, st.session_state.transactions, st.session_state.ticker, asset_type,
+                st.session_state.scenario_offset, VIEW_DAYS, report_end_idx,
+                core_data, INITIAL_CAPITAL,
+                busted=st.session_state.end_sim_index_on_settle is None # 沒有經過結算即結束 = 總資產歸零
+            ))
+        st.session_state.result_saved = True
+
+    st.markdown("---")
+    st.header("🏁 回測成績單")
+
+    col_r1, col_r2, col_r3, col_r4 = st.columns(4)
+    col_r1.metric("最終總資產", f"${report['final_equity']:,.2f}", f"{report['total_return_pct']:+.2f}%")
+    col_r2.metric("買進持有", f"{report['buy_and_hold_pct']:+.2f}%", f"{report['total_return_pct'] - report['buy_and_hold_pct']:+.2f}% (相對)")
+    col_r3.metric("完美後見 (只做多)", f"{report['perfect_long_pct']:+,.1f}%")
+    col_r4.metric("完美後見 (多空)", f"{report['perfect_long_short_pct']:+,.1f}%")
+
+    col_r5, col_r6, col_r7, col_r8 = st.columns(4)
+    col_r5.metric("夏普值 (年化)", f"{report['sharpe']:.2f}" if pd.notna(report['sharpe']) else "—")
+    col_r6.metric("最大回撤", f"{report['max_drawdown_pct']:.2f}%" if pd.notna(report['max_drawdown_pct']) else "—")
+    col_r7.metric("持倉時間", f"{report['time_in_market_pct']:.1f}%", f"{report['n_trades']} 筆平倉", delta_color='off')
+    col_r8.metric("手續費拖累", f"-{report['fee_drag_pct']:.2f}%", f"現貨 ${report['fees_spot']:,.0f} / 槓桿 ${report['fees_leverage']:,.0f}", delta_color='off')
+    if report['financing_total'] != 0:
+        st.caption(f"槓桿持有成本 (融資利息/借券費/資金費用)：${report['financing_total']:,.2f} (占初始資金 {report['financing_drag_pct']:.2f}%)")
+
+    excursions = report['excursions']
+    if not excursions.empty:
+        st.markdown("**每筆交易的最大有利/不利偏移 (MFE / MAE，持倉期間的最高價與最低價)**")
+        df_exc = excursions.assign(
+            模式=excursions['模式'].replace({'現貨': asset_config['mode_long'], '融資': asset_config['mode_margin_long'], '融券': asset_config['mode_margin_short']}),
+            持有K棒=excursions['close_bar'] - excursions['open_bar'],
+        )[['pos_id', '模式', '持有K棒', 'qty', 'entry', 'exit', 'pnl', 'mfe_pct', 'mae_pct', 'mfe', 'mae']]
+        df_exc.columns = ['ID', '模式', '持有K棒', '數量', '開倉價', '平倉價', '損益', 'MFE (%)', 'MAE (%)', 'MFE ($)', 'MAE ($)']
+        st.dataframe(df_exc.style.format({
+            '數量': '{:,.3f}', '開倉價': '${:,.2f}', '平倉價': '${:,.2f}', '損益': '{:+,.2f}',
+            'MFE (%)': '{:+.2f}%', 'MAE (%)': '{:+.2f}%', 'MFE ($)': '{:+,.2f}', 'MAE ($)': '{:+,.2f}'
+        }), use_container_width=True, hide_index=True)
 
 
 #交易倉位GUI
@@ -1116,48 +796,15 @@ def save_edited_positions(edited_df: pd.DataFrame):
 
 if st.session_state.positions:
     
-    #建立DataFrame顯示倉位
-    df_positions_data = []
-    
+    #建立DataFrame顯示倉位 (倉位不變時沿用快取，只重算未實現損益)
     current_open_price = open_price
     
-    for pos in st.session_state.positions:
-        qty = pos['qty']
-        cost = pos['cost']
-        unrealized_pnl = 0.0
-        
-        # PnL 計算
-        if pos['pos_mode'] in ['現貨', '融資']:
-             unrealized_pnl = (qty * current_open_price) - (qty * cost)
-        elif pos['pos_mode'] in ['融券']:
-             unrealized_pnl = (qty * cost) - (qty * current_open_price)
-             
-        # 模式名稱客製化 (Req 4: 根據 asset_config 顯示)
-        mode_label_display = pos['pos_mode']
-        if mode_label_display == '現貨':
-             mode_label_display = asset_config['mode_long'] 
-        elif mode_label_display == '融資':
-             mode_label_display = asset_config['mode_margin_long']
-        elif mode_label_display == '融券':
-             mode_label_display = asset_config['mode_margin_short']
-             
-        df_positions_data.append({
-            'ID': pos['id'],
-            '模式': mode_label_display, 
-            '槓桿': f"{pos.get('leverage', 1.0):.1f}x" if pos.get('leverage', 1.0) > 1.0 else '現貨',
-            '數量': pos['qty'],
-            '開倉價': pos['cost'],
-            '強制平倉價': pos.get('liquidation_price', np.nan),
-            '未實現損益': unrealized_pnl,
-            'SL': pos['sl'],
-            'TP': pos['tp'],
-        })
-        
-    df_positions = pd.DataFrame(df_positions_data)
+    with timed('table_styling'):
+        df_positions = versioned('positions_table', lambda: get_positions_table(st.session_state.positions_table_cache, st.session_state.positions, current_open_price, asset_config))
     
     #倉位GUI
     edited_df_from_state = st.data_editor(
-        df_positions.set_index('ID'),
+        df_positions,
         column_config={
             "模式": st.column_config.TextColumn("模式", disabled=True),
             "槓桿": st.column_config.TextColumn("槓桿", disabled=True),
@@ -1177,6 +824,7 @@ if st.session_state.positions:
     if st.button("💾 儲存 SL/TP 設定", key='save_sltp_button', use_container_width=True):
         changes_made = save_edited_positions(edited_df_from_state)
         if changes_made:
+            bump_state_version()
             st.success("SL/TP 設定已儲存！")
         else:
             st.info("沒有偵測到 SL/TP 變動。")
@@ -1184,6 +832,24 @@ if st.session_state.positions:
         st.rerun()
 
     st.info("💡 提醒：請點擊表格中的 **止損價 (SL)** 和 **止盈價 (TP)** 欄位即可直接輸入價格。")
+
+    #假設價格損益 (設定 SL/TP 前查看各價格全部平倉的損益與總資產)
+    with st.expander("📐 假設價格損益 (What-if)", expanded=False):
+        book = versioned('payoff_book', lambda: book_arrays(st.session_state.risk_cache, st.session_state.positions))
+        whatif_price = st.number_input("假設價格", min_value=0.0, value=None, step=min_qty if min_qty < 1.0 else 0.01, format="%.2f",
+                                       placeholder=f"{current_open_price:,.2f} (目前開盤價)", key='whatif_price')
+        if whatif_price is None:
+            whatif_price = current_open_price
+        whatif_pnl, whatif_total = payoff_at(book, st.session_state.balance, whatif_price)
+        col_pnl, col_total = st.columns(2)
+        col_pnl.metric(f"以 ${whatif_price:,.2f} 全部平倉的損益", f"${whatif_pnl:+,.2f}")
+        col_total.metric("平倉後總資產", f"${whatif_total:,.2f}")
+
+        st.plotly_chart(versioned('payoff_figure', lambda: build_payoff_figure(
+            payoff_ladder(st.session_state.payoff_cache, book, st.session_state.balance), current_open_price,
+            position_levels(st.session_state.positions), account_liq[0] if account_liq is not None else None)), use_container_width=True)
+        st.caption("損益已扣除平倉手續費與已計提持有成本；逐倉倉位越過強制平倉價後以強平價結算。" +
+                   (" 全倉模式下越過帳戶強平價時會依序強制平倉，圖中曲線未反映。" if st.session_state.margin_mode == 'cross' else ""))
     
     
     #平倉操作GUI 
@@ -1281,88 +947,20 @@ st.markdown("---")
 st.header("📝 交易紀錄 (開/平倉紀錄)")
 
 if st.session_state.transactions:
-    df_tx = pd.DataFrame(st.session_state.transactions)
-    
-    # 模式名稱客製化 (Req 4: 根據 asset_config 顯示)
-    df_tx['模式'] = df_tx['模式'].replace({
-        '現貨': asset_config['mode_long'], 
-        '融資': asset_config['mode_margin_long'], 
-        '融券': asset_config['mode_margin_short']
-    })
-    
-    # 計算損益百分比 (槓桿交易以保證金為計算基礎)
-    df_tx['損益 (%)'] = np.nan
-    closed_tx = df_tx['損益'].notna()
-    
-    initial_cost = df_tx['開倉總值'].fillna(0)
-    pnl = df_tx['損益'].fillna(0)
-    leverage = df_tx['leverage'].fillna(1.0)
-    
-    # 計算實際保證金/現貨成本
-    margin_required = initial_cost / leverage 
-
-    # PnL % = PnL / Margin_Required
-    valid_calc = (margin_required != 0) & closed_tx
-    df_tx.loc[valid_calc, '損益 (%)'] = (pnl[valid_calc] / margin_required[valid_calc]) * 100
-
-    
-    def format_trade_table(s):
-        """格式化欄位顏色和數字顯示"""
-        
-        #金額欄位 
-        is_buy_cover = (df_tx['金額'] < 0)
-        is_sell_short = (df_tx['金額'] > 0)
-        amount_styles = np.select(
-            [is_buy_cover, is_sell_short],
-            ['color: red', 'color: green'],
-            default=''
-        )
-        
-        #損益欄位
-        is_profit = (df_tx['損益'] > 0)
-        is_loss = (df_tx['損益'] < 0)
-
-        pnl_styles = np.select(
-            [is_profit, is_loss],
-            ['color: green', 'color: red'], 
-            default=''
-        )
-        
-        #損益 (%) 欄位
-        is_profit_pct = (df_tx['損益 (%)'] > 0)
-        is_loss_pct = (df_tx['損益 (%)'] < 0)
-        pnl_pct_styles = np.select(
-            [is_profit_pct, is_loss_pct],
-            ['color: green', 'color: red'], 
-            default=''
-        )
-        
-        if s.name == '金額':
-            return [f'{style}' for style in amount_styles]
-        elif s.name == '損益':
-            return [f'{style}' for style in pnl_styles]
-        elif s.name == '損益 (%)':
-            return [f'{style}' for style in pnl_pct_styles]
-        
-        return [''] * len(s) 
-        
-    #數字格式化
-    format_mapping = {
-        '股數': '{:,.3f}', # 允許小數顯示
-        '價格': '${:,.2f}',
-        '金額': '${:,.2f}',
-        '損益': '{:+.2f}',
-        '損益 (%)': '{:+.2f}%', 
-        '手續費': '-${:,.2f}' 
-    }
-    
-    # 不顯示日期項目
-    display_columns = ['模式', '類型', '股數', '價格', '金額', '損益', '損益 (%)', '手續費']
-    
-    df_tx_display = df_tx.reindex(columns=display_columns)
-
-    styler = df_tx_display.style.apply(format_trade_table, axis=0).format(format_mapping, subset=['股數', '價格', '金額', '損益', '損益 (%)', '手續費'])
-
-    st.dataframe(styler, use_container_width=True)
+    # 已格式化的表格與顏色快取於 session，只處理新增的交易紀錄
+    with timed('table_styling'):
+        df_tx_display, df_tx_styles = versioned('tx_table', lambda: get_transactions_table(st.session_state.tx_table_cache, st.session_state.transactions, asset_config))
+    
+    # 分頁顯示 (預設最後一頁，即最新的紀錄)
+    total_pages = max(1, -(-len(df_tx_display) // TX_PAGE_SIZE))
+    tx_page = total_pages
+    if total_pages > 1:
+        tx_page = st.number_input(f"頁數 (共 {total_pages} 頁，每頁 {TX_PAGE_SIZE} 筆)", min_value=1, max_value=total_pages, value=total_pages, step=1)
+    
+    with timed('table_styling'):
+        styler = versioned(('tx_page', tx_page), lambda: style_transactions_page(df_tx_display, df_tx_styles, tx_page))
+        st.dataframe(styler, use_container_width=True)
 else:
     st.info("尚無交易紀錄。")
+
+finish_profiling()
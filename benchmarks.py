@@ -0,0 +1,209 @@
+#Ksim 基準測試 (離線，不需網路)
+#以合成價格數據 (synthetic_data.generate_ohlcv) 測量主要熱點路徑的耗時與峰值記憶體：
+#    python benchmarks.py                    # 執行並與 bench_baseline.json 比較
+#    python benchmarks.py --save-baseline    # 將本次結果存為新的基準
+#    python benchmarks.py --positions 50 --bars 5000 --only advance
+import argparse
+import json
+import logging
+import os
+import random
+import statistics
+import time
+import tracemalloc
+
+import streamlit as st
+
+from data_manager import add_indicators, select_random_start_index, VIEW_DAYS
+from synthetic_data import generate_ohlcv
+from trade_engine import (
+    init_session_state,
+    reset_state,
+    start_scenario,
+    execute_trade,
+    close_position_lot,
+    settle_portfolio,
+    _advance_one_day,
+)
+from chart_manager import get_session_figure, update_overlays
+
+# 裸模式 (非 streamlit run) 下 st.success/st.info 等訊息沒有意義，關閉 streamlit 的警告輸出
+logging.disable(logging.WARNING)
+
+DEFAULT_BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bench_baseline.json')
+
+#在裸模式 (非 streamlit run) 下建立一個乾淨的回測狀態
+def _fresh_scenario(data, asset_type='Stock'):
+    st.session_state.clear()
+    init_session_state()
+    reset_state()
+    st.session_state.ticker = 'SYNTH'
+    start_scenario(data, 0, asset_type)
+
+#開 N 個現貨倉位 (數量小，避免資金不足)，SL/TP 設在觸發不到的位置
+def _open_spot_lots(n_positions):
+    price = st.session_state.core_data['Open'].iloc[st.session_state.current_sim_index].item()
+    for _ in range(n_positions):
+        execute_trade('Spot_Buy', 1.0, price)
+    for pos in st.session_state.positions:
+        pos['sl'] = price * 0.01
+        pos['tp'] = price * 100.0
+
+
+# --- 基準測試案例：每個案例回傳 (setup, run)，只有 run 會被計時 ---
+def case_indicators(args):
+    raw = generate_ohlcv(args.bars, seed=args.seed)
+    return (lambda: raw.copy()), add_indicators
+
+def case_select_random_start_index(args):
+    data = add_indicators(generate_ohlcv(args.bars, seed=args.seed))
+    def setup():
+        random.seed(args.seed)
+        return data
+    def run(data):
+        for _ in range(1000):
+            select_random_start_index(data)
+    return setup, run
+
+def case_open_close(args):
+    data = add_indicators(generate_ohlcv(args.bars, seed=args.seed))
+    def setup():
+        _fresh_scenario(data)
+        return st.session_state.core_data['Open'].iloc[VIEW_DAYS].item()
+    def run(price):
+        for _ in range(50):
+            execute_trade('Spot_Buy', 10.0, price)
+            close_position_lot(st.session_state.positions[-1]['id'], 10.0, price, '手動賣出平倉', '現貨', mode='手動')
+            execute_trade('Margin_Long', 10.0, price, leverage=5.0)
+            close_position_lot(st.session_state.positions[-1]['id'], 10.0, price, '手動賣出平倉', '融資', mode='手動')
+    return setup, run
+
+def case_advance(args):
+    data = add_indicators(generate_ohlcv(args.bars, seed=args.seed))
+    def setup():
+        _fresh_scenario(data)
+        _open_spot_lots(args.positions)
+    def run(_):
+        for _ in range(args.steps):
+            _advance_one_day()
+    return setup, run
+
+def case_settle(args):
+    data = add_indicators(generate_ohlcv(args.bars, seed=args.seed))
+    def setup():
+        _fresh_scenario(data)
+        _open_spot_lots(args.positions)
+    def run(_):
+        settle_portfolio(force_end=True)
+    return setup, run
+
+def case_figure_build(args):
+    data = add_indicators(generate_ohlcv(args.bars, seed=args.seed))
+    def setup():
+        _fresh_scenario(data)
+        _open_spot_lots(args.positions)
+        return st.session_state.core_data, st.session_state.max_sim_index
+    def run(setup_result):
+        core_data, end_idx = setup_result
+        cache = {}
+        get_session_figure(cache, core_data, end_idx, 'SYNTH')
+        update_overlays(cache, st.session_state.positions)
+        cache['fig'].to_json()
+    return setup, run
+
+def case_figure_append(args):
+    data = add_indicators(generate_ohlcv(args.bars, seed=args.seed))
+    def setup():
+        _fresh_scenario(data)
+        cache = {}
+        get_session_figure(cache, st.session_state.core_data, VIEW_DAYS, 'SYNTH')
+        return cache
+    def run(cache):
+        core_data = st.session_state.core_data
+        for end_idx in range(VIEW_DAYS + 1, VIEW_DAYS + 1 + args.steps):
+            get_session_figure(cache, core_data, end_idx, 'SYNTH')
+    return setup, run
+
+CASES = {
+    'indicators': case_indicators,
+    'select_random_start_index': case_select_random_start_index,
+    'open_close': case_open_close,
+    'advance': case_advance,
+    'settle': case_settle,
+    'figure_build': case_figure_build,
+    'figure_append': case_figure_append,
+}
+
+#執行單一案例：重複 N 次取中位數/最小值，另外以 tracemalloc 跑一次量測峰值記憶體
+def run_case(name, args) -> dict:
+    setup, run = CASES[name](args)
+
+    timings = []
+    for _ in range(args.repeat):
+        setup_result = setup()
+        t0 = time.perf_counter()
+        run(setup_result)
+        timings.append((time.perf_counter() - t0) * 1000)
+
+    setup_result = setup()
+    tracemalloc.start()
+    run(setup_result)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        'median_ms': statistics.median(timings),
+        'min_ms': min(timings),
+        'peak_kb': peak / 1024,
+    }
+
+def print_report(results: dict, baseline: dict | None):
+    header = f"{'case':<28}{'median ms':>12}{'min ms':>12}{'peak KB':>12}"
+    if baseline:
+        header += f"{'vs base':>10}"
+    print(header)
+    print('-' * len(header))
+    for name, r in results.items():
+        line = f"{name:<28}{r['median_ms']:>12.2f}{r['min_ms']:>12.2f}{r['peak_kb']:>12.1f}"
+        if baseline and name in baseline.get('results', {}):
+            ratio = r['median_ms'] / baseline['results'][name]['median_ms']
+            line += f"{ratio:>9.2f}x"
+        print(line)
+
+def main():
+    parser = argparse.ArgumentParser(description="Ksim 離線基準測試")
+    parser.add_argument('--bars', type=int, default=1500, help="合成數據長度 (K 棒數)")
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--positions', type=int, default=30, help="推進/結算/繪圖案例的倉位數")
+    parser.add_argument('--steps', type=int, default=100, help="推進案例的 K 棒數")
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--only', nargs='*', choices=list(CASES), help="只執行指定案例")
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE_PATH)
+    parser.add_argument('--save-baseline', action='store_true', help="將本次結果寫入基準檔")
+    parser.add_argument('--json', help="另存本次結果為 JSON")
+    args = parser.parse_args()
+
+    results = {name: run_case(name, args) for name in (args.only or CASES)}
+    params = {k: getattr(args, k) for k in ['bars', 'seed', 'positions', 'steps']}
+
+    baseline = None
+    if os.path.exists(args.baseline) and not args.save_baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            baseline = json.load(f)
+        if baseline.get('params') != params:
+            print(f"⚠️ 基準檔參數 {baseline.get('params')} 與本次不同，比例僅供參考。")
+
+    print_report(results, baseline)
+
+    output = {'params': params, 'results': results}
+    if args.save_baseline:
+        with open(args.baseline, 'w', encoding='utf-8') as f:
+            json.dump(output, f, indent=2)
+        print(f"基準已寫入 {args.baseline}")
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(output, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
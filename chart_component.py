@@ -0,0 +1,80 @@
+import base64
+import os
+import uuid
+
+import numpy as np
+import pandas as pd
+import streamlit as st
+import streamlit.components.v1 as components
+
+from data_manager import VIEW_DAYS, MA_PERIODS
+from chart_manager import MA_COLORS, OVERLAY_LINE_STYLES, position_levels
+
+# K 線圖元件：Plotly (預設) 或輕量 K 線元件 (前端保留歷史 K 棒，每次重跑只傳送新增的 K 棒與變動的倉位關鍵線)
+CHART_RENDERERS = {
+    'plotly': 'Plotly 圖表',
+    'lite': '輕量 K 線元件 (增量傳輸)',
+}
+DEFAULT_CHART_RENDERER = os.environ.get('KSIM_CHART_RENDERER', 'plotly')
+LITE_CHART_KEY = 'ksim_lite_chart'
+LITE_CHART_HEIGHT = 800
+
+# 傳送到前端的欄位 (依序，以 little-endian float32 再 base64 編碼)
+STREAM_COLUMNS = ['Open', 'High', 'Low', 'Close', 'Volume'] + [f'MA{p}' for p in MA_PERIODS] + ['RSI']
+
+_component = components.declare_component('ksim_chart', path=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'chart_frontend'))
+
+#數值欄位轉為 base64 的 float32 位元組 (比 JSON 十進位文字小約 3 倍)
+def encode_column(values) -> str:
+    return base64.b64encode(np.ascontiguousarray(values, dtype='<f4').tobytes()).decode('ascii')
+
+#本次重跑要傳送給前端的增量：數據不同、K 棒倒退或前端要求重送 (resync) 時送出完整歷史，否則只送上次之後的新 K 棒
+#倉位關鍵線只在變動時附上，並以版本號讓前端察覺漏收的更新
+#stream 為每個 session 的傳送狀態 {'data', 'token', 'upto', 'overlay_sig', 'overlay_version', 'resync'}
+def chart_delta(stream: dict, data: pd.DataFrame, end_idx: int, positions: list, settle_end_idx: int | None, resync=None) -> dict:
+    if stream.get('data') is not data or end_idx < stream['upto'] or resync != stream.get('resync'):
+        stream.clear()
+        stream.update(data=data, token=uuid.uuid4().hex[:8], upto=-1, overlay_sig=None, overlay_version=0, resync=resync)
+
+    base = stream['upto'] + 1
+    rows = data.iloc[base:end_idx + 1]
+    args = {
+        'token': stream['token'],
+        'base': base,
+        'count': len(rows),
+        'columns': {col: encode_column(rows[col].to_numpy()) for col in STREAM_COLUMNS} if len(rows) else {},
+    }
+    stream['upto'] = max(stream['upto'], end_idx)
+
+    if base == 0:
+        # 完整傳送時附上樣式 (欄位順序、均線顏色、關鍵線樣式)
+        args['style'] = {
+            'columns': STREAM_COLUMNS,
+            'ma': {f'MA{p}': MA_COLORS[p] for p in MA_PERIODS},
+            'lines': {name: {'color': v['color'], 'dash': v['dash']} for name, v in OVERLAY_LINE_STYLES.items()},
+        }
+
+    levels = position_levels(positions)
+    sig = (tuple((level['price'], level['style'], level['label']) for level in levels), settle_end_idx)
+    if sig != stream['overlay_sig'] or base == 0:
+        stream['overlay_sig'] = sig
+        stream['overlay_version'] += 1
+        vlines = []
+        if settle_end_idx is not None:
+            vlines = [{'x': VIEW_DAYS, 'color': 'green', 'label': '回測開始日'}, {'x': settle_end_idx, 'color': 'white', 'label': '回測結束日'}]
+        args['levels'] = levels
+        args['vlines'] = vlines
+    args['overlay_version'] = stream['overlay_version']
+    return args
+
+#繪製輕量 K 線元件，回傳使用者回報的縮放/平移範圍 (雙擊重設為 []，沒有回報時為 None)
+#前端以元件值回報 {'range', 'token', 'resync'}：token 不符 (舊的回測情境) 的範圍不採用
+def render_lite_chart(stream: dict, data: pd.DataFrame, end_idx: int, ticker: str, positions: list,
+                      settle_end_idx: int | None, view: list | None) -> list | None:
+    value = st.session_state.get(LITE_CHART_KEY) or {}
+    args = chart_delta(stream, data, end_idx, positions, settle_end_idx, value.get('resync'))
+    _component(**args, ticker=ticker, view=view, height=LITE_CHART_HEIGHT, key=LITE_CHART_KEY, default=None)
+
+    if value.get('token') != stream['token'] or 'range' not in value:
+        return None
+    return [float(v) for v in value['range'] or []]
@@ -0,0 +1,379 @@
+import numpy as np
+import pandas as pd
+import plotly.graph_objects as go
+
+from data_manager import VIEW_DAYS, MA_PERIODS
+
+MA_COLORS = {5: 'lightgray', 10: 'gray', 20: 'red', 60: 'blue', 120: 'white'}
+
+# 各 trace 需要追加的欄位 (trace 屬性 -> 數據欄位)
+CANDLE_FIELDS = {'open': 'Open', 'high': 'High', 'low': 'Low', 'close': 'Close'}
+
+# --- 可視範圍降採樣設定 ---
+MAX_FULL_DETAIL_BARS = 1000    # 沒有縮放紀錄時，最多送出的完整 K 棒數 (超過的舊 K 棒改送聚合資料)
+DETAIL_MARGIN_BARS = 120       # 可視範圍左側額外保留的完整 K 棒數 (平移時不會立刻看到聚合資料)
+DETAIL_SNAP_BARS = 50          # 完整區段起點對齊的步長，避免小幅平移就重建圖表
+DOWNSAMPLE_TARGET_POINTS = 200 # 完整區段以前的歷史最多保留的點數 (K 棒分組 / LTTB 取樣)
+
+# st.plotly_chart 每次重跑都會送出整張圖 (數值陣列以二進位編碼)：只用於繪製位置的陣列改用 float32 以縮小傳輸量
+# 懸停顯示的數值 (K 棒 customdata、成交量) 維持 float64，顯示的位數不受影響
+PLOT_DTYPE = np.float32
+
+def _compact(values) -> np.ndarray:
+    return np.asarray(values, dtype=PLOT_DTYPE)
+
+#決定完整細節區段的起點 (之前的 K 棒會被降採樣)
+def plan_detail_start(n_bars: int, visible_range: list | None = None) -> int:
+    if visible_range is not None:
+        visible_start = int(np.floor(min(visible_range)))
+    else:
+        visible_start = n_bars - MAX_FULL_DETAIL_BARS
+
+    detail_start = visible_start - DETAIL_MARGIN_BARS
+    detail_start = (detail_start // DETAIL_SNAP_BARS) * DETAIL_SNAP_BARS
+
+    # 聚合的 K 棒不足一組時沒有降採樣的意義
+    if detail_start < DETAIL_SNAP_BARS:
+        return 0
+    return min(detail_start, n_bars)
+
+#OHLC 分組聚合：每組取首開、最高、最低、末收，成交量取平均 (維持與單日量相同的刻度)
+def downsample_ohlc(data: pd.DataFrame, stop: int, n_buckets: int) -> dict:
+    bucket_size = int(np.ceil(stop / n_buckets))
+    starts = np.arange(0, stop, bucket_size)
+    ends = np.append(starts[1:], stop)
+
+    open_ = data['Open'].values[:stop]
+    high = data['High'].values[:stop]
+    low = data['Low'].values[:stop]
+    close = data['Close'].values[:stop]
+    volume = data['Volume'].values[:stop].astype(float)
+
+    return {
+        'x': (starts + ends - 1) / 2.0,
+        'Open': open_[starts],
+        'High': np.maximum.reduceat(high, starts),
+        'Low': np.minimum.reduceat(low, starts),
+        'Close': close[ends - 1],
+        'Volume': np.add.reduceat(volume, starts) / (ends - starts),
+    }
+
+#LTTB (Largest-Triangle-Three-Buckets) 取樣，回傳保留點的索引
+def lttb(y: np.ndarray, n_out: int) -> np.ndarray:
+    n = len(y)
+    if n_out >= n or n_out < 3:
+        return np.arange(n)
+
+    x = np.arange(n, dtype=float)
+    edges = np.linspace(1, n - 1, n_out - 1).astype(int)
+    selected = np.empty(n_out, dtype=int)
+    selected[0] = 0
+    selected[-1] = n - 1
+
+    prev = 0
+    for i in range(n_out - 2):
+        lo, hi = edges[i], edges[i + 1]
+        # 下一組的平均點 (最後一組以終點代替)
+        next_lo, next_hi = hi, edges[i + 2] if i + 2 < len(edges) else n
+        avg_x = x[next_lo:next_hi].mean() if next_hi > next_lo else x[-1]
+        avg_y = y[next_lo:next_hi].mean() if next_hi > next_lo else y[-1]
+
+        # 與前一個選取點、下一組平均點構成的三角形面積最大者
+        area = np.abs((x[prev] - avg_x) * (y[lo:hi] - y[prev]) - (x[prev] - x[lo:hi]) * (avg_y - y[prev]))
+        prev = lo + int(np.argmax(area))
+        selected[i + 1] = prev
+
+    return selected
+
+
+#建立基礎圖表 (K線、均線、成交量、RSI 與版面設定)
+#x 軸使用 K 棒索引：detail_start 以前的歷史改送聚合資料，之後的 K 棒保留完整細節
+def build_base_figure(data: pd.DataFrame, end_idx: int, ticker: str, detail_start: int = 0) -> go.Figure:
+    detail = data.iloc[detail_start:end_idx + 1]
+    detail_x = np.arange(detail_start, end_idx + 1)
+
+    # K 棒與成交量：分組聚合
+    candles = {col: detail[col].values for col in ['Open', 'High', 'Low', 'Close', 'Volume']}
+    candles['x'] = detail_x
+    if detail_start > 0:
+        buckets = downsample_ohlc(data, detail_start, DOWNSAMPLE_TARGET_POINTS)
+        candles = {key: np.concatenate([buckets[key], candles[key]]) for key in candles}
+
+    # 均線與 RSI：LTTB 取樣
+    def line_series(col):
+        if detail_start == 0:
+            return detail_x, detail[col].values
+        history = data[col].values[:detail_start]
+        keep = lttb(history, DOWNSAMPLE_TARGET_POINTS)
+        return np.concatenate([keep, detail_x]), np.concatenate([history[keep], detail[col].values])
+
+    # 子圖模組只在建立圖表時需要，延後匯入以縮短啟動時間
+    from plotly.subplots import make_subplots
+
+    fig = make_subplots(
+        rows=3, cols=1,
+        row_heights=[0.6, 0.2, 0.2],
+        shared_xaxes=True,
+        vertical_spacing=0.02,
+        subplot_titles=(f"{ticker} 日線 K 棒 (MA $5, 10, 20, 60, 120$)", "成交量", "RSI(14)")
+    )
+
+    x = _compact(candles['x'])
+
+    # K線
+    fig.add_trace(go.Candlestick(x=x, open=_compact(candles['Open']), high=_compact(candles['High']),
+                                 low=_compact(candles['Low']), close=_compact(candles['Close']), name='K-Line',
+                                 customdata=np.column_stack([candles['Open'], candles['High'], candles['Low'], candles['Close']]),
+                                 hovertemplate = '<b>開盤</b>: $%{customdata[0]:.2f}<br>' +
+                                                 '<b>最高</b>: $%{customdata[1]:.2f}<br>' +
+                                                 '<b>最低</b>: $%{customdata[2]:.2f}<br>' +
+                                                 '<b>收盤</b>: $%{customdata[3]:.2f}<extra>K 線</extra>'), row=1, col=1)
+
+    # MA均線
+    for p_ma in MA_PERIODS:
+        ma_x, ma_y = line_series(f'MA{p_ma}')
+        fig.add_trace(go.Scatter(x=_compact(ma_x), y=_compact(ma_y), mode='lines',
+                                 name=f'MA{p_ma}', line=dict(color=MA_COLORS[p_ma], width=1),
+                                 hovertemplate=f'MA{p_ma}: %{{y:.2f}}<extra></extra>'), row=1, col=1)
+
+    # 成交量
+    fig.add_trace(go.Bar(x=x, y=candles['Volume'], name='Volume', marker_color='grey',
+                         hovertemplate = '<b>成交量</b>: %{y:,.0f}<extra></extra>'), row=2, col=1)
+
+    # RSI
+    rsi_x, rsi_y = line_series('RSI')
+    fig.add_trace(go.Scatter(x=_compact(rsi_x), y=_compact(rsi_y), mode='lines', name='RSI(14)',
+                             line=dict(color='orange', width=2),
+                             hovertemplate = '<b>RSI(14)</b>: %{y:.2f}<extra></extra>'), row=3, col=1)
+
+    # RSI 70/30臨界線
+    fig.add_hline(y=70, line_dash="dash", line_color="red", line_width=1, row=3, col=1, name='Overbought')
+    fig.add_hline(y=30, line_dash="dash", line_color="green", line_width=1, row=3, col=1, name='Oversold')
+
+    # 圖表顯示風格
+    fig.update_xaxes(showticklabels=False, row=1, col=1, type='linear')
+    fig.update_xaxes(showticklabels=False, row=2, col=1, type='linear')
+    fig.update_xaxes(showticklabels=False, row=3, col=1, type='linear')
+
+    fig.update_layout(
+        xaxis_rangeslider_visible=False,
+        template="plotly_dark",
+        height=800,
+        showlegend=True,
+        dragmode='pan',
+        legend=dict(orientation="h", yanchor="bottom", y=1.02, xanchor="right", x=1),
+        hovermode='x unified',
+        hoverlabel=dict(bgcolor="rgba(128, 128, 128, 0.7)", font_size=12, font_color="white"),
+        margin=dict(t=50, b=50, l=50, r=100),
+
+        xaxis=dict(showspikes=True, spikemode='across', spikesnap='data', spikedash='dot', spikethickness=1, unifiedhovertitle=dict(text='\u200b')),
+        xaxis2=dict(unifiedhovertitle=dict(text='\u200b')),
+        xaxis3=dict(unifiedhovertitle=dict(text='\u200b')),
+
+        yaxis=dict(showspikes=True, spikemode='across', spikesnap='data', spikedash='dot', spikethickness=1, side='right', type='log'),
+        yaxis2=dict(showspikes=True, spikemode='across', spikesnap='data', spikedash='dot', spikethickness=1, side='right'),
+        yaxis3=dict(showspikes=True, spikemode='across', spikesnap='data', spikedash='dot', spikethickness=1, side='right')
+    )
+
+    return fig
+
+#將 data[start_idx : end_idx+1] 的新 K 棒追加到既有圖表 (只處理新增的列)
+def append_bars(fig: go.Figure, data: pd.DataFrame, start_idx: int, end_idx: int):
+    new_rows = data.iloc[start_idx:end_idx + 1]
+    if new_rows.empty:
+        return
+
+    new_x = _compact(np.arange(start_idx, start_idx + len(new_rows)))
+
+    with fig.batch_update():
+        for trace in fig.data:
+            trace.x = np.concatenate([trace.x, new_x])
+
+            if trace.name == 'K-Line':
+                for attr, col in CANDLE_FIELDS.items():
+                    setattr(trace, attr, np.concatenate([getattr(trace, attr), _compact(new_rows[col].values)]))
+                trace.customdata = np.vstack([trace.customdata, new_rows[['Open', 'High', 'Low', 'Close']].values])
+            elif trace.name == 'Volume':
+                trace.y = np.concatenate([trace.y, new_rows['Volume'].values])
+            elif trace.name == 'RSI(14)':
+                trace.y = np.concatenate([trace.y, _compact(new_rows['RSI'].values)])
+            else: # MA均線
+                trace.y = np.concatenate([trace.y, _compact(new_rows[trace.name].values)])
+
+#取得本 session 的圖表：數據與可視範圍不變時沿用快取，推進時只追加新 K 棒
+#可視範圍移動到聚合區段 (平移/縮放) 時，以新的完整細節區段重建
+def get_session_figure(cache: dict, data: pd.DataFrame, end_idx: int, ticker: str, visible_range: list | None = None) -> go.Figure:
+    fig = cache.get('fig')
+    detail_start = plan_detail_start(end_idx + 1, visible_range)
+
+    if (fig is None or cache.get('data') is not data or end_idx < cache['end_idx']
+            or detail_start < cache['detail_start']
+            or detail_start - cache['detail_start'] >= MAX_FULL_DETAIL_BARS):
+        fig = build_base_figure(data, end_idx, ticker, detail_start)
+        cache.clear()
+        cache['fig'] = fig
+        cache['data'] = data
+        cache['end_idx'] = end_idx
+        cache['detail_start'] = detail_start
+        # 記錄基礎圖表的線條/標註 (RSI 臨界線、子圖標題)，疊加層重建時以此為底
+        cache['base_shapes'] = fig.layout.shapes
+        cache['base_annotations'] = fig.layout.annotations
+        cache['overlay_sig'] = None
+    elif end_idx > cache['end_idx']:
+        append_bars(fig, data, cache['end_idx'] + 1, end_idx)
+        cache['end_idx'] = end_idx
+
+    return fig
+
+#倉位關鍵線的簽章，用來判斷疊加層是否需要重建
+def _overlay_signature(positions: list, settle_end_idx: int | None) -> tuple:
+    pos_sig = tuple(
+        (pos['id'], pos['pos_mode'], pos['cost'], pos.get('liquidation_price', 0.0), pos['sl'], pos['tp'])
+        for pos in positions
+    )
+    return pos_sig, settle_end_idx
+
+#更新疊加層 (倉位關鍵線、回測起訖線)，倉位沒有變動時不重建
+#所有線條/標註先組成清單，再一次寫入 layout (不逐條呼叫 add_hline)
+def update_overlays(cache: dict, positions: list, settle_end_idx: int | None = None, display_start_idx: int = 0):
+    fig = cache['fig']
+    sig = _overlay_signature(positions, settle_end_idx)
+    if sig == cache.get('overlay_sig'):
+        return
+
+    shapes, annotations = build_position_overlays(positions)
+    if settle_end_idx is not None:
+        vline_shapes, vline_annotations = build_settle_vlines(settle_end_idx, display_start_idx)
+        shapes += vline_shapes
+        annotations += vline_annotations
+
+    fig.update_layout(
+        shapes=list(cache['base_shapes']) + shapes,
+        annotations=list(cache['base_annotations']) + annotations,
+    )
+
+    cache['overlay_sig'] = sig
+
+# --- 倉位關鍵線樣式 (優先順序高者決定合併後線條的顏色/樣式) ---
+OVERLAY_LINE_STYLES = {
+    'Liq': {'color': 'red', 'dash': 'dash', 'priority': 3},
+    'SL': {'color': 'red', 'dash': 'dot', 'priority': 2},
+    'TP': {'color': 'green', 'dash': 'dot', 'priority': 1},
+    '開': {'color': 'yellow', 'dash': 'dot', 'priority': 0},
+}
+
+# --- 🎯 倉位關鍵線 (開倉價, 強制平倉價, SL, TP) 並貼齊價格刻度 (Req 1) ---
+#相同價位 (取到小數第二位) 的多條線合併成一條，標籤列出所有項目
+#回傳 [{'price', 'style', 'label'}]，Plotly 圖表與輕量 K 線元件共用
+def position_levels(positions: list) -> list:
+    levels = {} # 價位 -> {'price', 'style', 'labels': {標籤: 數量}}
+
+    for pos in positions:
+        # 判斷方向
+        is_long_pos = pos['pos_mode'] in ['現貨', '融資']
+        pos_direction = '多' if is_long_pos else '空'
+
+        lines_to_plot = [('開', pos['cost'])]
+        # 只有槓桿部位才會有強制平倉價
+        if pos['pos_mode'] in ['融資', '融券']:
+            lines_to_plot.append(('Liq', pos.get('liquidation_price', 0.0)))
+        # 止損/止盈 (如果設定了)
+        if pos['sl'] > 0:
+            lines_to_plot.append(('SL', pos['sl']))
+        if pos['tp'] > 0:
+            lines_to_plot.append(('TP', pos['tp']))
+
+        for short_name, price in lines_to_plot:
+            if price <= 0:
+                continue
+
+            level = levels.setdefault(round(price, 2), {'price': price, 'style': short_name, 'labels': {}})
+            if OVERLAY_LINE_STYLES[short_name]['priority'] > OVERLAY_LINE_STYLES[level['style']]['priority']:
+                level['style'] = short_name
+
+            # Req 1: 標籤格式：[多/空][開/SL/TP]
+            label = f"{pos_direction}{short_name}"
+            level['labels'][label] = level['labels'].get(label, 0) + 1
+
+    return [
+        {
+            'price': level['price'],
+            'style': level['style'],
+            'label': ' / '.join(label if count == 1 else f"{label}×{count}" for label, count in level['labels'].items()),
+        }
+        for level in levels.values()
+    ]
+
+def build_position_overlays(positions: list) -> tuple[list, list]:
+    shapes = []
+    annotations = []
+    for level in position_levels(positions):
+        style = OVERLAY_LINE_STYLES[level['style']]
+
+        shapes.append(dict(
+            type='line', xref='x domain', x0=0, x1=1, yref='y', y0=level['price'], y1=level['price'],
+            line=dict(color=style['color'], dash=style['dash'], width=1),
+        ))
+        # 關鍵設定：將標籤貼在右側 Y 軸上，透明背景
+        annotations.append(dict(
+            text=f"{level['label']} @ ${level['price']:,.2f}",
+            xref='x domain', x=1.01, xanchor='left', yref='y', y=level['price'], yanchor='middle',
+            showarrow=False, font=dict(color=style['color']),
+            bgcolor='rgba(0,0,0,0)', bordercolor='rgba(0,0,0,0)',
+        ))
+
+    return shapes, annotations
+
+#回測起訖線 (模擬結束後顯示於三個子圖)
+def build_settle_vlines(settle_end_idx: int, display_start_idx: int) -> tuple[list, list]:
+    shapes = []
+    annotations = []
+
+    vlines = [(settle_end_idx - display_start_idx, 'white', '回測結束日', 'left')]
+    start_sim_relative_index = VIEW_DAYS
+    if start_sim_relative_index >= 0:
+        vlines.insert(0, (start_sim_relative_index, 'green', '回測開始日', 'right'))
+
+    for x, color, text, xanchor in vlines:
+        for r in [1, 2, 3]:
+            axis_suffix = '' if r == 1 else str(r)
+            shapes.append(dict(
+                type='line', xref=f'x{axis_suffix}', x0=x, x1=x, yref=f'y{axis_suffix} domain', y0=0, y1=1,
+                line=dict(color=color, dash='dot', width=2),
+            ))
+            annotations.append(dict(
+                text=text, showarrow=False, xref=f'x{axis_suffix}', x=x, xanchor=xanchor,
+                yref=f'y{axis_suffix} domain', y=1, yanchor='top',
+            ))
+
+    return shapes, annotations
+
+#假設價格損益圖：x 軸為價格，平倉損益與總資產兩條曲線，倉位關鍵價 (開倉/強平/SL/TP) 與目前價格以垂直線標示
+#account_liq 為全倉模式的帳戶強制平倉價 (沒有時為 None)
+def build_payoff_figure(ladder: dict, price: float, levels: list, account_liq: float | None = None) -> go.Figure:
+    fig = go.Figure()
+    fig.add_trace(go.Scatter(x=ladder['價格'], y=ladder['平倉損益'], name='平倉損益', line=dict(color='orange'),
+                             hovertemplate='價格 $%{x:,.2f}<br>平倉損益 $%{y:+,.2f}<extra></extra>'))
+    fig.add_trace(go.Scatter(x=ladder['價格'], y=ladder['總資產'], name='總資產', line=dict(color='deepskyblue'), yaxis='y2',
+                             hovertemplate='價格 $%{x:,.2f}<br>總資產 $%{y:,.2f}<extra></extra>'))
+
+    vlines = [(level['price'], OVERLAY_LINE_STYLES[level['style']], level['label']) for level in levels]
+    if account_liq is not None and 0 < account_liq < np.inf:
+        vlines.append((account_liq, OVERLAY_LINE_STYLES['Liq'], '帳戶強平'))
+    vlines.append((price, {'color': 'white', 'dash': 'solid'}, '目前'))
+
+    fig.update_layout(
+        shapes=[dict(type='line', xref='x', x0=x, x1=x, yref='paper', y0=0, y1=1, line=dict(color=style['color'], dash=style['dash'], width=1))
+                for x, style, _ in vlines],
+        annotations=[dict(text=label, xref='x', x=x, yref='paper', y=1, yanchor='bottom', textangle=-90, showarrow=False, font=dict(color=style['color']))
+                     for x, style, label in vlines],
+        template="plotly_dark",
+        height=360,
+        hovermode='x unified',
+        legend=dict(orientation="h", yanchor="bottom", y=1.02, xanchor="left", x=0),
+        margin=dict(t=60, b=40, l=50, r=60),
+        xaxis=dict(title='價格', range=[ladder['價格'][0], ladder['價格'][-1]]),
+        yaxis=dict(title='平倉損益', zeroline=True, zerolinecolor='gray'),
+        yaxis2=dict(title='總資產', overlaying='y', side='right', showgrid=False),
+    )
+    return fig
@@ -0,0 +1,148 @@
+import os
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import streamlit as st
+
+from data_manager import download_price_histories, data_key, cached_indicators, build_indicators
+from data_store import DATA_STORE_MAX_AGE, content_hash
+from scanner import SCAN_UNIVERSE
+
+LOADER_WORKERS = int(os.environ.get('KSIM_LOADER_WORKERS', '8'))
+# 短時間內陸續送出的代碼合併成一次批次下載 (秒)
+LOADER_BATCH_WINDOW = float(os.environ.get('KSIM_LOADER_BATCH_MS', '50')) / 1000
+# 單次批次下載的代碼上限 (大量代碼時拆成多批，由執行緒池同時下載)
+LOADER_BATCH_SIZE = int(os.environ.get('KSIM_LOADER_BATCH_SIZE', '16'))
+# 記憶體中保留的代碼數 (超過時移除最舊的已完成項目)：至少容納整個掃描清單再加上使用者另外載入的代碼，
+# 掃描一輪不會把目前回測的代碼擠出去 (可用環境變數 KSIM_LOADER_MAX_TICKERS 覆寫)
+LOADER_MAX_TICKERS = int(os.environ.get('KSIM_LOADER_MAX_TICKERS', str(len(SCAN_UNIVERSE) + 32)))
+LOADER_RETRY_SECONDS = 30     # 載入失敗的代碼多久後才會重新嘗試
+
+# 載入階段與對應的進度
+LOAD_STAGES = {
+    'queued': (0.1, "排隊中"),
+    'downloading': (0.4, "下載歷史數據"),
+    'indicators': (0.8, "計算指標 (MA, RSI)"),
+    'done': (1.0, "完成"),
+    'failed': (1.0, "載入失敗"),
+}
+
+#背景數據載入器 (伺服器層級，所有 session 共用)：代碼 -> 載入工作 {'future', 'stage', 'requested', 'finished', 'key', 'cache'}
+#cache 為指標數據快取是否命中 ('hit' / 'miss'，載入失敗為 None)，背景執行緒沒有 session，由取用結果的 session 記入效能計數器
+class DataLoader:
+    def __init__(self, max_workers: int = LOADER_WORKERS, batch_window: float = LOADER_BATCH_WINDOW):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='ksim-loader')
+        self.batch_window = batch_window
+        self.lock = threading.Lock()
+        self.jobs = {}
+        self.pending = []
+        self.timer = None
+
+    #工作是否可沿用 (進行中、仍在有效期內且數據內容未變動的結果、或剛失敗不久)
+    #其他行程更新了本機數據庫時內容鍵會改變，結果立即失效
+    def _usable(self, ticker: str, job: dict, now: float) -> bool:
+        if job['finished'] is None:
+            return True
+        if job['stage'] == 'done' and data_key(ticker) not in (None, job['key']):
+            return False
+        max_age = LOADER_RETRY_SECONDS if job['stage'] == 'failed' else DATA_STORE_MAX_AGE
+        return now - job['finished'] < max_age
+
+    #要求載入 (已在載入或已完成的代碼直接沿用)，回傳 代碼 -> 工作
+    def request(self, tickers: list) -> dict:
+        now = time.time()
+        with self.lock:
+            result = {}
+            for ticker in dict.fromkeys(t.upper() for t in tickers if t):
+                job = self.jobs.get(ticker)
+                if job is None or not self._usable(ticker, job, now):
+                    job = {'future': Future(), 'stage': 'queued', 'requested': now, 'finished': None, 'key': None, 'cache': None}
+                    self.jobs[ticker] = job
+                    self.pending.append(ticker)
+                result[ticker] = job
+
+            if self.pending and self.timer is None:
+                self.timer = threading.Timer(self.batch_window, self._dispatch)
+                self.timer.daemon = True
+                self.timer.start()
+            self._evict()
+        return result
+
+    def status(self, ticker: str) -> dict | None:
+        with self.lock:
+            return self.jobs.get(ticker.upper())
+
+    #移除最舊的已完成工作，限制記憶體中的數據量
+    def _evict(self):
+        finished = sorted((job['finished'], t) for t, job in self.jobs.items() if job['finished'] is not None)
+        for _, ticker in finished[:max(0, len(self.jobs) - LOADER_MAX_TICKERS)]:
+            del self.jobs[ticker]
+
+    #合併等待中的代碼送入執行緒池 (批次內一次下載，不同批次同時進行)
+    def _dispatch(self):
+        with self.lock:
+            pending, self.pending, self.timer = self.pending, [], None
+        for start in range(0, len(pending), LOADER_BATCH_SIZE):
+            self.executor.submit(self._load_batch, pending[start:start + LOADER_BATCH_SIZE])
+
+    def _set_stage(self, jobs: list, stage: str):
+        with self.lock:
+            for job in jobs:
+                job['stage'] = stage
+
+    def _finish(self, job: dict, data, key: str | None, cache: str | None = None):
+        with self.lock:
+            job['stage'] = 'done' if data is not None else 'failed'
+            job['finished'] = time.time()
+            job['key'] = key
+            job['cache'] = cache if data is not None else None
+        job['future'].set_result(data)
+
+    def _load_batch(self, tickers: list):
+        with self.lock:
+            jobs = {t: self.jobs[t] for t in tickers}
+
+        # 數據庫內容未變動的代碼直接取用快取的指標數據 (其他行程算過的也可用)，其餘合併成一次下載
+        missing = []
+        for ticker, job in jobs.items():
+            key = data_key(ticker)
+            data = cached_indicators(ticker, key) if key else None
+            if data is not None:
+                self._finish(job, data, key, 'hit')
+            else:
+                missing.append(ticker)
+        if not missing:
+            return
+
+        self._set_stage([jobs[t] for t in missing], 'downloading')
+        try:
+            raws = download_price_histories(missing)
+        except Exception:
+            raws = {}
+
+        for ticker in missing:
+            job = jobs[ticker]
+            raw = raws.get(ticker)
+            data, key, cache = None, None, 'hit'
+            if raw is not None and not raw.empty:
+                self._set_stage([job], 'indicators')
+                try:
+                    key = data_key(ticker) or content_hash(raw)
+                    data = cached_indicators(ticker, key)
+                    if data is None:
+                        cache = 'miss'
+                        data = build_indicators(ticker, key, raw)
+                except Exception:
+                    data = None
+            self._finish(job, data, key, cache)
+
+@st.cache_resource(show_spinner=False)
+def get_loader() -> DataLoader:
+    return DataLoader()
+
+#工作的進度與說明文字
+def job_progress(job: dict) -> tuple[float, str]:
+    fraction, label = LOAD_STAGES[job['stage']]
+    elapsed = (job['finished'] or time.time()) - job['requested']
+    return fraction, f"{label}… ({elapsed:.1f}s)"
@@ -1,14 +1,41 @@
-import yfinance as yf
 import pandas as pd
-import streamlit as st
 from datetime import datetime
 import random
+import os
+import threading
+import zlib
+
+from synthetic_data import generate_ohlcv
+from data_store import (
+    load_prices, save_prices, load_factors, save_factors, update_factors, adjust_prices, is_current_factors,
+    store_key, content_hash, load_derived, save_derived
+)
 
 #常數設定
 VIEW_DAYS = 250         
 MIN_SIMULATION_DAYS = 720
 MA_PERIODS = [5, 10, 20, 60, 120]
 
+# 數據來源：yfinance (預設) 或 synthetic (離線合成數據，供壓力測試/展示使用，不需網路)
+DATA_SOURCE = os.environ.get('KSIM_DATA_SOURCE', 'yfinance')
+SYNTHETIC_BARS = 3000
+
+# yfinance 代碼格式對應的資產類型 (匯率為 XXX=X，加密貨幣為 幣種-報價幣別)，其餘視為股票
+ASSET_TYPE_SUFFIXES = {
+    '=X': 'Forex',
+    '-USD': 'Crypto', '-USDT': 'Crypto', '-USDC': 'Crypto', '-EUR': 'Crypto', '-BTC': 'Crypto', '-ETH': 'Crypto',
+}
+
+# 含指標數據的程序內快取：代碼 -> (內容鍵, 數據)，未命中時再查本機磁碟快取 (data_store.DERIVED_DIR)
+_INDICATOR_CACHE = {}
+_INDICATOR_LOCK = threading.Lock() # 背景載入器的執行緒也會寫入
+INDICATOR_CACHE_SIZE = 32
+
+#依代碼格式判斷資產類型 (Stock / Forex / Crypto)
+def asset_type_of(ticker: str) -> str:
+    ticker = ticker.upper()
+    return next((asset_type for suffix, asset_type in ASSET_TYPE_SUFFIXES.items() if ticker.endswith(suffix)), 'Stock')
+
 #計算RSI指標
 def calculate_rsi(data: pd.DataFrame, window: int = 14) -> pd.Series:
     delta = data['Close'].diff()
@@ -18,36 +45,138 @@ def calculate_rsi(data: pd.DataFrame, window: int = 14) -> pd.Series:
     rsi = 100 - (100 / (1 + rs))
     return rsi
 
-#主要數據抓取
-@st.cache_data(ttl=3600, show_spinner="📈 正在載入並計算指標 (MA, RSI)...")
-def fetch_historical_data(ticker: str = "TSLA") -> pd.DataFrame | None:
-    period = 'max'  # 抓取所有可用歷史數據
-
-    try:
-        data = yf.download(ticker.upper(), period=period, interval='1d', progress=False)
-        
-        if data.empty:
-            return None
-            
-        data = data[['Open', 'High', 'Low', 'Close', 'Volume']].reset_index()
-        data.columns = ['Date', 'Open', 'High', 'Low', 'Close', 'Volume']
-        data['Date'] = pd.to_datetime(data['Date'])
-        
-        # 計算指標
-        for p in MA_PERIODS:
-            data[f'MA{p}'] = data['Close'].rolling(window=p).mean()
-            
-        data['RSI'] = calculate_rsi(data, window=14)
-        
-        # 移除 NaN 並重設索引
-        data.dropna(inplace=True) 
-        data = data.reset_index(drop=True)
+#計算指標 (MA, RSI)，並移除指標尚未成形的前段數據
+def add_indicators(data: pd.DataFrame) -> pd.DataFrame:
+    for p in MA_PERIODS:
+        data[f'MA{p}'] = data['Close'].rolling(window=p).mean()
         
+    data['RSI'] = calculate_rsi(data, window=14)
+    
+    # 移除 NaN 並重設索引
+    data.dropna(inplace=True) 
+    data = data.reset_index(drop=True)
+    
+    return data
+
+#yfinance 下載結果轉為統一欄位 (Date, Open, High, Low, Close, Volume)
+def _normalize_download(data: pd.DataFrame) -> pd.DataFrame | None:
+    data = data.dropna(how='all')
+    if data.empty:
+        return None
+
+    data = data[['Open', 'High', 'Low', 'Close', 'Volume']].reset_index()
+    data.columns = ['Date', 'Open', 'High', 'Low', 'Close', 'Volume']
+    data['Date'] = pd.to_datetime(data['Date'])
+    return data
+
+#yfinance 下載結果中的除權息/分割事件 (Date, Dividends, Splits)，沒有事件欄位時為空表
+def _normalize_actions(data: pd.DataFrame) -> pd.DataFrame:
+    actions = pd.DataFrame(index=data.index)
+    actions['Dividends'] = data['Dividends'] if 'Dividends' in data.columns else 0.0
+    actions['Splits'] = data['Stock Splits'] if 'Stock Splits' in data.columns else 0.0
+    actions = actions.fillna(0.0).reset_index()
+    actions.columns = ['Date', 'Dividends', 'Splits']
+    actions['Date'] = pd.to_datetime(actions['Date'])
+    return actions[(actions['Dividends'] > 0) | (actions['Splits'] > 0)]
+
+#本機數據庫的原始價格乘上調整因子 (舊版因子重複調整分割，回傳 None 重新下載)
+def _load_adjusted(ticker: str) -> pd.DataFrame | None:
+    raw = load_prices(ticker)
+    if raw is None:
+        return None
+    factors = load_factors(ticker)
+    return adjust_prices(raw, factors) if is_current_factors(factors) else None
+
+#依數據來源下載還原後的 OHLCV (欄位: Date, Open, High, Low, Close, Volume)
+#yfinance 數據以原始價格與調整因子分開存入本機數據庫，未過期前直接讀取 (use_store=False 時強制重新下載)
+def download_price_history(ticker: str, period: str = 'max', use_store: bool = True) -> pd.DataFrame | None:
+    return download_price_histories([ticker], period, use_store)[ticker]
+
+#多個代碼一次下載 (本機數據庫沒有的代碼合併成一次 yfinance 請求)，回傳 代碼 -> 數據 (失敗為 None)
+def download_price_histories(tickers: list, period: str = 'max', use_store: bool = True) -> dict:
+    if DATA_SOURCE == 'synthetic':
+        # 以代碼決定亂數種子，同一代碼每次產生相同數據
+        return {t: generate_ohlcv(SYNTHETIC_BARS, seed=zlib.crc32(t.encode('utf-8'))) for t in tickers}
+
+    results = {t: _load_adjusted(t) if use_store else None for t in tickers}
+    missing = [t for t, data in results.items() if data is None]
+    if not missing:
+        return results
+
+    # yfinance 載入很慢，只在真的需要下載時才匯入
+    import yfinance as yf
+
+    # 固定下載未還原除息的價格與除權息/分割事件，不依賴 yfinance 預設的還原方式 (OHLCV 已經過分割調整)
+    raw = yf.download(missing, period=period, interval='1d', progress=False, group_by='ticker', threads=True, auto_adjust=False, actions=True)
+    for t in missing:
+        if raw is None or raw.empty:
+            continue
+        # group_by='ticker' 時欄位第一層為代碼
+        if isinstance(raw.columns, pd.MultiIndex) and t in raw.columns.get_level_values(0):
+            frame = raw[t]
+        elif len(missing) == 1:
+            frame = raw
+        else:
+            continue
+
+        data = _normalize_download(frame)
+        if data is not None:
+            save_prices(t, data)
+            # 除權息事件有新增或修正時才寫入調整因子，因子改變後該代碼的指標才會重新計算
+            factors, changed = update_factors(load_factors(t), data, _normalize_actions(frame))
+            if changed:
+                save_factors(t, factors)
+            data = adjust_prices(data, factors)
+        results[t] = data
+
+    return results
+
+#含指標數據的內容鍵：合成數據由代碼與長度決定；yfinance 為本機數據庫的內容雜湊 (過期需要重新確認時為 None)
+def data_key(ticker: str) -> str | None:
+    if DATA_SOURCE == 'synthetic':
+        return f"synthetic-{SYNTHETIC_BARS}-{zlib.crc32(ticker.encode('utf-8')):08x}"
+    return store_key(ticker)
+
+#依內容鍵查詢含指標數據 (程序內 → 本機磁碟)，未命中回傳 None
+def cached_indicators(ticker: str, key: str) -> pd.DataFrame | None:
+    hit = _INDICATOR_CACHE.get(ticker)
+    if hit is not None and hit[0] == key:
+        return hit[1]
+    data = load_derived(ticker, key)
+    if data is not None:
+        _remember(ticker, key, data)
+    return data
+
+#計算指標並寫入兩層快取
+def build_indicators(ticker: str, key: str, raw: pd.DataFrame) -> pd.DataFrame:
+    data = add_indicators(raw.copy())
+    save_derived(ticker, key, data)
+    _remember(ticker, key, data)
+    return data
+
+def _remember(ticker: str, key: str, data: pd.DataFrame):
+    with _INDICATOR_LOCK:
+        _INDICATOR_CACHE.pop(ticker, None)
+        if len(_INDICATOR_CACHE) >= INDICATOR_CACHE_SIZE:
+            _INDICATOR_CACHE.pop(next(iter(_INDICATOR_CACHE)))
+        _INDICATOR_CACHE[ticker] = (key, data)
+
+#載入含指標 (MA, RSI) 的完整數據：數據庫內容沒有改變時直接取用快取，不需讀取原始價格
+#回傳的 DataFrame 為共用物件，呼叫端需先複製再修改
+def load_with_indicators(ticker: str) -> pd.DataFrame | None:
+    ticker = ticker.upper()
+    key = data_key(ticker)
+    data = cached_indicators(ticker, key) if key else None
+    if data is not None:
         return data
 
-    except Exception as e:
+    raw = download_price_history(ticker)
+    if raw is None or raw.empty:
         return None
-    
+    key = data_key(ticker) or content_hash(raw)
+    data = cached_indicators(ticker, key)
+    return data if data is not None else build_indicators(ticker, key, raw)
+
 #隨機選取起始點
 def select_random_start_index(data: pd.DataFrame) -> tuple[int, int] | None:
     total_days = len(data)
@@ -0,0 +1,161 @@
+import glob
+import hashlib
+import json
+import os
+import re
+import time
+
+import numpy as np
+import pandas as pd
+
+# 本機價格數據庫：每個代碼一個檔案，保存下載後的原始 (未還原) OHLCV (Date, Open, High, Low, Close, Volume)
+# 除權息/分割另存為調整因子檔 (Date, Dividends, Splits, PriceFactor)，還原價格由兩者相乘得到
+# yfinance (auto_adjust=False) 的 OHLCV 已經過分割調整，因子只包含除息 (分割只留作紀錄)
+DATA_STORE_DIR = os.environ.get('KSIM_DATA_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), '.ksim_data'))
+# 超過此秒數的數據視為過期，需重新向上游確認 (內容沒有變動時不會改寫檔案，衍生數據的快取也不會失效)
+DATA_STORE_MAX_AGE = float(os.environ.get('KSIM_DATA_MAX_AGE', '3600'))
+# 衍生數據 (含指標的完整數據) 的本機快取，以 代碼 + 數據內容雜湊 為鍵，同一台機器的所有行程共用
+DERIVED_DIR = os.environ.get('KSIM_DERIVED_DIR', os.path.join(DATA_STORE_DIR, 'derived'))
+
+FACTOR_COLUMNS = ['Date', 'Dividends', 'Splits', 'PriceFactor']
+
+#代碼轉為安全的檔名 (例如 JPY=X、^GSPC)
+def _safe_name(ticker: str) -> str:
+    return re.sub(r'[^A-Za-z0-9._-]', lambda m: f"%{ord(m.group()):02X}", ticker.upper())
+
+def _store_path(ticker: str, suffix: str = '', ext: str = '.pkl') -> str:
+    return os.path.join(DATA_STORE_DIR, f"{_safe_name(ticker)}{suffix}{ext}")
+
+#數據內容的雜湊 (與檔案時間無關，內容相同即相同)
+def content_hash(data: pd.DataFrame) -> str:
+    return hashlib.sha1(pd.util.hash_pandas_object(data, index=False).to_numpy().tobytes()).hexdigest()[:16]
+
+#讀取本機數據 (不存在或已過期時回傳 None)
+def load_prices(ticker: str, max_age: float | None = DATA_STORE_MAX_AGE) -> pd.DataFrame | None:
+    path = _store_path(ticker)
+    try:
+        if max_age is not None and time.time() - os.path.getmtime(path) > max_age:
+            return None
+        return pd.read_pickle(path)
+    except (OSError, EOFError, ValueError):
+        return None
+
+#先寫暫存檔再取代，避免多個行程同時讀到寫一半的檔案
+def _write_atomic(path: str, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    if isinstance(data, pd.DataFrame):
+        data.to_pickle(tmp_path)
+    else:
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(data, f)
+    os.replace(tmp_path, path)
+
+#各代碼目前內容的雜湊 {'raw': 原始價格, 'dividends': 調整因子}
+#(舊版因子另含分割，雜湊記在 'factors'，不再使用，內容鍵因此改變)
+def _read_hashes(ticker: str) -> dict:
+    try:
+        with open(_store_path(ticker, ext='.key'), encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def _write_hash(ticker: str, part: str, value: str):
+    _write_atomic(_store_path(ticker, ext='.key'), {**_read_hashes(ticker), part: value})
+
+#寫入本機數據 (原始價格)；內容與現有檔案相同時只更新檔案時間 (標記為剛確認過)，不改變內容鍵
+def save_prices(ticker: str, data: pd.DataFrame):
+    path = _store_path(ticker)
+    digest = content_hash(data)
+    if os.path.exists(path) and _read_hashes(ticker).get('raw') == digest:
+        os.utime(path)
+        return
+    _write_atomic(path, data)
+    _write_hash(ticker, 'raw', digest)
+
+#本機數據的內容鍵 (原始價格 + 調整因子的雜湊)：只有數據真的改變時才會不同
+#數據不存在、過期需要重新確認，或是由舊版寫入 (沒有雜湊紀錄) 時回傳 None
+def store_key(ticker: str, max_age: float | None = DATA_STORE_MAX_AGE) -> str | None:
+    try:
+        if max_age is not None and time.time() - os.path.getmtime(_store_path(ticker)) > max_age:
+            return None
+    except OSError:
+        return None
+    hashes = _read_hashes(ticker)
+    if 'raw' not in hashes:
+        return None
+    return f"{hashes['raw']}-{hashes.get('dividends', '0')}"
+
+#讀取調整因子 (沒有紀錄時回傳 None，視為沒有除權息/分割；舊版格式可用 is_current_factors 判斷)
+def load_factors(ticker: str) -> pd.DataFrame | None:
+    try:
+        return pd.read_pickle(_store_path(ticker, '.factors'))
+    except (OSError, EOFError, ValueError):
+        return None
+
+#寫入調整因子 (只在因子改變時呼叫，內容鍵隨之改變，指標等衍生數據因此重新計算)
+def save_factors(ticker: str, factors: pd.DataFrame):
+    _write_atomic(_store_path(ticker, '.factors'), factors)
+    _write_hash(ticker, 'dividends', content_hash(factors))
+
+#因子是否為目前格式 (舊版因子含分割調整，與已分割調整的價格相乘會重複調整)
+def is_current_factors(factors: pd.DataFrame | None) -> bool:
+    return factors is None or list(factors.columns) == FACTOR_COLUMNS
+
+#由除權息事件重新計算調整因子：除息日之前的 K 棒乘上 1 - 股利/前一日收盤價 (原始價格不變)
+#事件以日期為鍵，actions 中的日期取代既有紀錄 (例如修正後的股利金額)，其餘沿用 old
+#old 為既有因子 (可為 None)，raw 為目前的原始價格，actions 為 (Date, Dividends, Splits)；回傳 (新因子, 是否有變動)
+def update_factors(old: pd.DataFrame | None, raw: pd.DataFrame, actions: pd.DataFrame) -> tuple[pd.DataFrame, bool]:
+    has_old = old is not None and not old.empty
+    events = pd.concat([old[['Date', 'Dividends', 'Splits']] if has_old else None, actions[['Date', 'Dividends', 'Splits']]])
+    events = events.drop_duplicates('Date', keep='last')
+    factors = pd.DataFrame({'Date': raw['Date'].to_numpy()}).merge(events, on='Date', how='left')
+    factors[['Dividends', 'Splits']] = factors[['Dividends', 'Splits']].fillna(0.0).astype(float)
+
+    close = raw['Close'].to_numpy(dtype=float)
+    prev_close = np.concatenate([[np.nan], close[:-1]])
+    dividends = factors['Dividends'].to_numpy()
+    with np.errstate(divide='ignore', invalid='ignore'):
+        div_factor = np.where(dividends > 0, 1.0 - dividends / prev_close, 1.0)
+    div_factor = np.where(np.isfinite(div_factor) & (div_factor > 0), div_factor, 1.0)
+    # 事件日之前的 K 棒乘上之後所有除息的因子 (由後往前累乘，再右移一根)
+    factors['PriceFactor'] = np.append(np.cumprod(div_factor[::-1])[::-1][1:], 1.0)
+    factors = factors[FACTOR_COLUMNS]
+
+    if not has_old:
+        return factors, bool((dividends > 0).any() or (factors['Splits'] > 0).any())
+    if not is_current_factors(old):
+        return factors, True
+    # 與既有因子比較 (新增的 K 棒在所有既有事件之後，舊因子視為 1)
+    previous = factors[['Date']].merge(old, on='Date', how='left').fillna({'Dividends': 0.0, 'Splits': 0.0, 'PriceFactor': 1.0})
+    changed = not np.allclose(previous[FACTOR_COLUMNS[1:]].to_numpy(dtype=float), factors[FACTOR_COLUMNS[1:]].to_numpy(dtype=float))
+    return factors, changed
+
+#原始價格乘上累積調整因子得到還原價格 (向量化；因子紀錄之後新增的 K 棒因子為 1，成交量已經過分割調整不需處理)
+def adjust_prices(raw: pd.DataFrame, factors: pd.DataFrame | None) -> pd.DataFrame:
+    if factors is None or factors.empty:
+        return raw
+    price_factor = factors.set_index('Date')['PriceFactor'].reindex(raw['Date']).fillna(1.0).to_numpy()
+    data = raw.copy()
+    for col in ('Open', 'High', 'Low', 'Close'):
+        data[col] = data[col].to_numpy(dtype=float) * price_factor
+    return data
+
+
+#讀取衍生數據快取 (鍵不符或不存在時回傳 None)
+def load_derived(ticker: str, key: str) -> pd.DataFrame | None:
+    try:
+        return pd.read_pickle(os.path.join(DERIVED_DIR, f"{_safe_name(ticker)}@{key}.pkl"))
+    except (OSError, EOFError, ValueError):
+        return None
+
+#寫入衍生數據快取，並移除同一代碼舊內容的快取檔
+def save_derived(ticker: str, key: str, data: pd.DataFrame):
+    path = os.path.join(DERIVED_DIR, f"{_safe_name(ticker)}@{key}.pkl")
+    _write_atomic(path, data)
+    for old in glob.glob(os.path.join(DERIVED_DIR, f"{glob.escape(_safe_name(ticker))}@*.pkl")):
+        if old != path:
+            try:
+                os.remove(old)
+            except OSError:
+                pass
@@ -0,0 +1,35 @@
+import os
+
+import numpy as np
+
+# 成交模型：理想成交 (舊版規則) 或依成交量限制並計算價差/衝擊成本
+FILL_MODELS = {
+    'ideal': '理想成交 (開盤價全數成交)',
+    'volume': '成交量限制 + 價差/衝擊成本',
+}
+DEFAULT_FILL_MODEL = os.environ.get('KSIM_FILL_MODEL', 'ideal')
+
+#單根 K 棒可成交數量上限 (成交量為 0 或缺值時視為不限制，例如匯率數據沒有成交量)
+def participation_caps(volume, max_participation: float) -> np.ndarray:
+    volume = np.asarray(volume, dtype=float)
+    return np.where(volume > 0, volume * max_participation, np.inf)
+
+#同一根 K 棒的多筆委託依先後順序分配該根的成交量上限
+def allocate(remaining, cap: float) -> np.ndarray:
+    remaining = np.asarray(remaining, dtype=float)
+    before = np.cumsum(remaining) - remaining
+    return np.clip(cap - before, 0.0, remaining)
+
+#依最小交易單位無條件捨去
+def round_down(qty, min_qty: float) -> np.ndarray:
+    return np.floor(np.asarray(qty, dtype=float) / min_qty + 1e-9) * min_qty
+
+#滑價比例 = 半價差 + 平方根衝擊 (衝擊係數 × K 棒振幅比例 × √成交量占比)
+def slippage_fraction(qty, volume, bar_range_pct, config: dict) -> np.ndarray:
+    qty, volume = np.asarray(qty, dtype=float), np.asarray(volume, dtype=float)
+    participation = np.where(volume > 0, qty / np.where(volume > 0, volume, 1.0), 0.0)
+    return config['half_spread_bps'] / 1e4 + config['impact_coef'] * np.asarray(bar_range_pct) * np.sqrt(participation)
+
+#成交價：買進往上加滑價，賣出往下減滑價 (side: +1 買 / -1 賣)
+def fill_prices(price, side, qty, volume, bar_range_pct, config: dict) -> np.ndarray:
+    return np.asarray(price, dtype=float) * (1.0 + np.asarray(side, dtype=float) * slippage_fraction(qty, volume, bar_range_pct, config))
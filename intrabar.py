@@ -0,0 +1,100 @@
+import os
+
+import numpy as np
+
+# 同一根 K 棒內停損/停利/強制平倉的觸發順序模型
+INTRABAR_MODELS = {
+    'conservative': '保守 (強平/停損優先，舊版規則)',
+    'open_first': '開盤跳空優先',
+    'ohlc': 'OHLC 路徑推估',
+    'bridge': '布朗橋路徑 (隨機)',
+}
+DEFAULT_INTRABAR_MODEL = os.environ.get('KSIM_INTRABAR_MODEL', 'conservative')
+BRIDGE_STEPS = 64 # 布朗橋路徑的取樣點數
+
+EVENT_NONE, EVENT_LIQ, EVENT_SL, EVENT_TP = 0, 1, 2, 3
+
+#OHLC 路徑推估：開盤較接近最高價時視為先漲後跌 (O→H→L→C)，否則先跌後漲 (O→L→H→C)
+#輸入為每根 K 棒的陣列，回傳 (K 棒數, 4) 的路徑
+def ohlc_paths(o, h, l, c) -> np.ndarray:
+    o, h, l, c = (np.asarray(x, dtype=float) for x in (o, h, l, c))
+    high_first = (h - o) < (o - l)
+    return np.stack([o, np.where(high_first, h, l), np.where(high_first, l, h), c], axis=-1)
+
+#布朗橋路徑：由開盤走到收盤的隨機路徑，再把高於/低於開收連線的部分分別縮放到剛好碰到最高/最低價
+#回傳 (K 棒數, steps + 1) 的路徑，同一個 rng 產生相同路徑
+def bridge_paths(o, h, l, c, rng: np.random.Generator, steps: int = BRIDGE_STEPS) -> np.ndarray:
+    o, h, l, c = (np.asarray(x, dtype=float)[:, None] for x in (o, h, l, c))
+    t = np.linspace(0.0, 1.0, steps + 1)
+    walk = np.zeros((len(o), steps + 1))
+    walk[:, 1:] = np.cumsum(rng.standard_normal((len(o), steps)), axis=1)
+    bridge = walk - t * walk[:, -1:]
+    line = o + (c - o) * t
+
+    up = np.maximum(bridge, 0.0)
+    down = np.maximum(-bridge, 0.0)
+    # 整條橋都在連線同一側時 (離散取樣下約 1/steps 的機率)，把最接近另一側的點拉成尖點，確保最高/最低價都會被碰到
+    rows = np.arange(len(o))
+    no_up = ~(up > 0).any(axis=1)
+    spike = bridge[no_up, 1:-1].argmax(axis=1) + 1
+    up[rows[no_up], spike], down[rows[no_up], spike] = 1.0, 0.0
+    no_down = ~(down > 0).any(axis=1)
+    spike = bridge[no_down, 1:-1].argmin(axis=1) + 1
+    down[rows[no_down], spike], up[rows[no_down], spike] = 1.0, 0.0
+    with np.errstate(divide='ignore', invalid='ignore'):
+        scale_up = np.min(np.where(up > 0, (h - line) / up, np.inf), axis=1, keepdims=True)
+        scale_down = np.min(np.where(down > 0, (line - l) / down, np.inf), axis=1, keepdims=True)
+    scale_up = np.where(np.isfinite(scale_up), np.maximum(scale_up, 0.0), 0.0)
+    scale_down = np.where(np.isfinite(scale_down), np.maximum(scale_down, 0.0), 0.0)
+    return line + scale_up * up - scale_down * down
+
+#依模型建立每根 K 棒的價格路徑 (保守/開盤跳空模型只需要 O→H→L→C 的範圍)
+def bar_paths(model: str, o, h, l, c, rng: np.random.Generator | None = None) -> np.ndarray:
+    if model == 'bridge':
+        return bridge_paths(o, h, l, c, rng if rng is not None else np.random.default_rng())
+    return ohlc_paths(o, h, l, c)
+
+#價位第一次被觸及的時間 (以路徑步數計，0 表示開盤即已越過)，沒有觸及或價位未設定 (<= 0) 為 inf
+#paths: (列數, 路徑點數)；direction = +1 表示價格 >= level 時觸發，-1 表示價格 <= level 時觸發
+def first_touch(paths: np.ndarray, level: np.ndarray, direction: np.ndarray) -> np.ndarray:
+    rows = np.arange(len(level))
+    crossed = direction[:, None] * (paths - level[:, None]) >= 0
+    k = crossed.argmax(axis=1)
+    hit = crossed[rows, k] & (level > 0)
+
+    prev = paths[rows, np.maximum(k - 1, 0)]
+    cur = paths[rows, k]
+    step = np.where(cur != prev, cur - prev, 1.0)
+    return np.where(hit, np.where(k > 0, k - 1 + (level - prev) / step, 0.0), np.inf)
+
+#判斷每個倉位在這段路徑中先觸發哪一個價位與成交價
+#paths: (倉位數, 路徑點數)，同一根 K 棒的倉位共用同一條路徑；side: +1 多頭 / -1 空頭；價位 0 表示未設定
+#回傳 (事件代碼, 成交價)；開盤即越過的價位以開盤價成交，其餘以該價位成交
+def resolve_triggers(model: str, paths: np.ndarray, side, liq, sl, tp) -> tuple[np.ndarray, np.ndarray]:
+    side = np.asarray(side, dtype=float)
+    n = len(side)
+    # 順序同時是同時觸發時的優先順序：停損 (使用者掛單) > 強制平倉 > 停利
+    levels = np.concatenate([np.asarray(sl, dtype=float), np.asarray(liq, dtype=float), np.asarray(tp, dtype=float)])
+    directions = np.concatenate([-side, -side, side])
+    # 三種價位一次計算 (路徑重複三次)
+    times = first_touch(np.concatenate([paths, paths, paths]), levels, directions).reshape(3, n)
+    levels = levels.reshape(3, n)
+    touched = np.isfinite(times)
+    gapped = times == 0
+
+    if model in ('ohlc', 'bridge'):
+        choice = times.argmin(axis=0)
+    else:
+        # 保守：不論路徑，強平 > 停損 > 停利
+        choice = _CONSERVATIVE_ORDER[touched[_CONSERVATIVE_ORDER].argmax(axis=0)]
+        if model == 'open_first':
+            choice = np.where(gapped.any(axis=0), gapped.argmax(axis=0), choice)
+
+    cols = np.arange(n)
+    event = np.where(touched[choice, cols], _EVENT_CODES[choice], EVENT_NONE)
+    fill_at_open = gapped[choice, cols] & (model != 'conservative')
+    price = np.where(fill_at_open, paths[:, 0], levels[choice, cols])
+    return event, np.where(event == EVENT_NONE, 0.0, price)
+
+_EVENT_CODES = np.array([EVENT_SL, EVENT_LIQ, EVENT_TP])
+_CONSERVATIVE_ORDER = np.array([1, 0, 2])
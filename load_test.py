@@ -0,0 +1,237 @@
+#Ksim 多 session 壓力測試 (離線，不需網路)
+#以 Streamlit 測試 API (AppTest) 模擬 N 個同時操作的使用者，每個 session 依序：
+#開始回測 -> 開倉 (現貨/槓桿) -> 下一天 ×K -> 修改 SL/TP -> 提早結算
+#    python load_test.py --sessions 8 --steps 20
+#    python load_test.py --sessions 32 --workers 4 --json load_result.json
+import argparse
+import json
+import logging
+import os
+import random
+import resource
+import statistics
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+# 壓力測試一律使用離線合成數據 (必須在匯入 app 相關模組前設定)
+os.environ.setdefault('KSIM_DATA_SOURCE', 'synthetic')
+
+from streamlit.testing.v1 import AppTest
+
+APP_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'app.py')
+DEFAULT_TICKERS = ['TSLA', 'AAPL', 'NVDA', 'BTC-USD', 'JPY=X']
+
+# AppTest 不是執行緒安全的 (共用的 Runtime 與腳本編譯)，同一行程內的重跑以鎖依序執行；
+# 與 Streamlit 伺服器受 GIL 限制的情況相近，等待鎖的時間計入延遲 (排隊)，持有鎖的時間為服務時間
+_RUN_LOCK = threading.Lock()
+
+#讀取目前行程的常駐記憶體 (MB)
+def _rss_mb() -> float:
+    try:
+        with open('/proc/self/status', encoding='utf-8') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    # 非 Linux：以峰值常駐記憶體近似 (macOS 單位為 bytes)
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss / (1024 * 1024) if os.uname().sysname == 'Darwin' else maxrss / 1024
+
+def _find_button(at, label):
+    for b in at.button:
+        if b.label == label:
+            return b
+    raise LookupError(f"找不到按鈕：{label}")
+
+#單一 session 的操作腳本，回傳每次重跑的耗時 (ms) 與最終狀態
+def run_session(session_no: int, steps: int, seed: int, timeout: float) -> dict:
+    rng = random.Random(seed + session_no)
+    latencies = []
+    service_times = []
+
+    def rerun(action):
+        t0 = time.perf_counter()
+        with _RUN_LOCK:
+            t1 = time.perf_counter()
+            action()
+        t2 = time.perf_counter()
+        latencies.append((t2 - t0) * 1000)
+        service_times.append((t2 - t1) * 1000)
+        if at.exception:
+            raise RuntimeError(f"session {session_no}: {at.exception[0].message}")
+
+    at = AppTest.from_file(APP_PATH, default_timeout=timeout)
+    rerun(at.run)
+
+    # 開始回測
+    at.sidebar.text_input[0].set_value(rng.choice(DEFAULT_TICKERS))
+    rerun(lambda: at.sidebar.button[0].click().run())
+    # 數據在背景載入，畫面以定時重跑顯示進度 (測試 API 不會自動觸發，改為輪詢)
+    deadline = time.perf_counter() + timeout
+    while not at.session_state.initialized and at.session_state.pending_load is not None:
+        if time.perf_counter() > deadline:
+            raise RuntimeError(f"session {session_no}: 數據載入逾時")
+        time.sleep(0.05)
+        rerun(at.run)
+    rerun(at.run)
+    if not at.session_state.initialized:
+        raise RuntimeError(f"session {session_no}: 回測初始化失敗")
+
+    # 開倉：現貨 + 槓桿多 (各以 20% 資金)
+    rerun(lambda: at.radio(key='qty_mode_open').set_value('Percentage').run())
+    rerun(lambda: at.slider(key='percent_qty_open_slider').set_value(20.0).run())
+    rerun(lambda: at.button(key='execute_trade_open').click().run())
+    rerun(lambda: at.radio(key='trade_mode_new').set_value('Margin_Long').run())
+    rerun(lambda: at.slider(key='leverage_slider').set_value(5.0).run())
+    rerun(lambda: at.button(key='execute_trade_open').click().run())
+
+    # 下一天 ×K
+    for _ in range(steps):
+        if not at.session_state.sim_active:
+            break
+        rerun(lambda: _find_button(at, '➡️ 下一天').click().run())
+
+    # 修改 SL/TP 後儲存 (測試 API 無法直接編輯 data_editor，改為修改倉位後按下儲存按鈕)
+    if at.session_state.sim_active and at.session_state.positions:
+        for pos in at.session_state.positions:
+            pos['sl'] = round(pos['cost'] * 0.8, 2)
+            pos['tp'] = round(pos['cost'] * 1.3, 2)
+        rerun(lambda: at.button(key='save_sltp_button').click().run())
+
+    # 提早結算
+    if at.session_state.sim_active:
+        rerun(lambda: _find_button(at, '🛑 **提早結算**').click().run())
+
+    return {'latencies': latencies, 'service_times': service_times, 'transactions': len(at.session_state.transactions), 'app': at}
+
+#在單一行程內以執行緒同時跑多個 session (模擬一台 Streamlit 伺服器)
+def run_worker(session_numbers: list, steps: int, seed: int, timeout: float) -> dict:
+    logging.disable(logging.WARNING)
+
+    rss_before = _rss_mb()
+    cpu_before = time.process_time()
+    t0 = time.perf_counter()
+
+    results = []
+    errors = []
+    lock = threading.Lock()
+
+    def task(n):
+        try:
+            r = run_session(n, steps, seed, timeout)
+            with lock:
+                results.append(r)
+        except Exception as e:
+            with lock:
+                errors.append(str(e))
+
+    with ThreadPoolExecutor(max_workers=len(session_numbers)) as pool:
+        list(pool.map(task, session_numbers))
+
+    wall = time.perf_counter() - t0
+    cpu = time.process_time() - cpu_before
+    # 在 session 仍存活時量測記憶體
+    rss_after = _rss_mb()
+
+    return {
+        'latencies': [x for r in results for x in r['latencies']],
+        'service_times': [x for r in results for x in r['service_times']],
+        'sessions': len(results),
+        'transactions': sum(r['transactions'] for r in results),
+        'errors': errors,
+        'wall_s': wall,
+        'cpu_s': cpu,
+        'rss_before_mb': rss_before,
+        'rss_after_mb': rss_after,
+    }
+
+def _percentile(values: list, pct: float) -> float:
+    ordered = sorted(values)
+    k = (len(ordered) - 1) * pct / 100
+    lo = int(k)
+    hi = min(lo + 1, len(ordered) - 1)
+    return ordered[lo] + (ordered[hi] - ordered[lo]) * (k - lo)
+
+def _distribution(values: list) -> dict:
+    if not values:
+        return {'mean': 0.0, 'p50': 0.0, 'p90': 0.0, 'p99': 0.0, 'max': 0.0}
+    return {
+        'mean': statistics.fmean(values),
+        'p50': _percentile(values, 50),
+        'p90': _percentile(values, 90),
+        'p99': _percentile(values, 99),
+        'max': max(values),
+    }
+
+def summarize(worker_results: list, wall_s: float) -> dict:
+    latencies = [x for w in worker_results for x in w['latencies']]
+    service_times = [x for w in worker_results for x in w['service_times']]
+    sessions = sum(w['sessions'] for w in worker_results)
+    cpu_s = sum(w['cpu_s'] for w in worker_results)
+    mem_delta = sum(w['rss_after_mb'] - w['rss_before_mb'] for w in worker_results)
+
+    return {
+        'sessions': sessions,
+        'errors': [e for w in worker_results for e in w['errors']],
+        'reruns': len(latencies),
+        'transactions': sum(w['transactions'] for w in worker_results),
+        'wall_s': wall_s,
+        'throughput_reruns_per_s': len(latencies) / wall_s if wall_s > 0 else 0.0,
+        'latency_ms': _distribution(latencies),
+        'service_ms': _distribution(service_times),
+        'cpu_s': cpu_s,
+        'cpu_utilization': cpu_s / wall_s if wall_s > 0 else 0.0, # 1.0 = 一顆核心滿載
+        'rss_mb_per_worker': [w['rss_after_mb'] for w in worker_results],
+        'rss_mb_per_session': mem_delta / sessions if sessions else 0.0,
+    }
+
+def print_report(summary: dict):
+    print(f"sessions: {summary['sessions']}  reruns: {summary['reruns']}  transactions: {summary['transactions']}  wall: {summary['wall_s']:.2f}s")
+    print(f"throughput: {summary['throughput_reruns_per_s']:.1f} reruns/s")
+    for label, key in [('rerun latency', 'latency_ms'), ('service time', 'service_ms')]:
+        d = summary[key]
+        print(f"{label + ' (ms):':<22}mean {d['mean']:.1f}  p50 {d['p50']:.1f}  p90 {d['p90']:.1f}  p99 {d['p99']:.1f}  max {d['max']:.1f}")
+    print(f"cpu: {summary['cpu_s']:.2f}s ({summary['cpu_utilization']:.2f} cores)")
+    print(f"rss per worker (MB): {', '.join(f'{x:.0f}' for x in summary['rss_mb_per_worker'])}  per session: {summary['rss_mb_per_session']:.1f} MB")
+    if summary['errors']:
+        print(f"⚠️ {len(summary['errors'])} 個 session 失敗：")
+        for e in summary['errors'][:5]:
+            print(f"  {e}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Ksim 多 session 壓力測試 (離線合成數據)")
+    parser.add_argument('--sessions', type=int, default=8, help="同時模擬的 session 數")
+    parser.add_argument('--workers', type=int, default=1, help="行程數 (每個行程模擬一台伺服器)")
+    parser.add_argument('--steps', type=int, default=20, help="每個 session 按下「下一天」的次數")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--timeout', type=float, default=120.0, help="單次重跑逾時秒數")
+    parser.add_argument('--json', help="另存結果為 JSON")
+    args = parser.parse_args()
+
+    logging.disable(logging.WARNING)
+
+    # session 平均分配到各行程
+    assignments = [list(range(i, args.sessions, args.workers)) for i in range(args.workers)]
+    assignments = [a for a in assignments if a]
+
+    t0 = time.perf_counter()
+    if len(assignments) == 1:
+        worker_results = [run_worker(assignments[0], args.steps, args.seed, args.timeout)]
+    else:
+        with ProcessPoolExecutor(max_workers=len(assignments)) as pool:
+            futures = [pool.submit(run_worker, a, args.steps, args.seed, args.timeout) for a in assignments]
+            worker_results = [f.result() for f in futures]
+    wall_s = time.perf_counter() - t0
+
+    summary = summarize(worker_results, wall_s)
+    print_report(summary)
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(summary, f, indent=2, ensure_ascii=False)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,124 @@
+import functools
+import json
+import os
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+import streamlit as st
+
+# 預設開啟方式：環境變數 KSIM_PROFILE=1，或在側邊欄勾選
+PROFILE_DEFAULT_ENABLED = os.environ.get('KSIM_PROFILE', '0') == '1'
+PROFILE_LOG_PATH = os.environ.get('KSIM_PROFILE_LOG', 'ksim_profile.jsonl')
+PROFILE_HISTORY_SIZE = 50 # session 內保留的重跑紀錄筆數
+
+#是否開啟效能分析
+def profiling_enabled() -> bool:
+    return st.session_state.get('profiling_enabled', PROFILE_DEFAULT_ENABLED)
+
+#每次重跑開始時呼叫，建立本次的計時紀錄
+#按鈕的 on_click 回呼會在腳本本體之前執行，因此回呼中已建立的紀錄會沿用到本次重跑
+def start_rerun():
+    if not profiling_enabled():
+        st.session_state['_perf_current'] = None
+        return
+    _current()
+
+def _current():
+    record = st.session_state.get('_perf_current')
+    if record is None and profiling_enabled():
+        record = {
+            'started': time.perf_counter(),
+            'sections': {}, # 區段 -> {'ms': 累計毫秒, 'calls': 次數}
+            'counters': {},
+        }
+        st.session_state['_perf_current'] = record
+    return record
+
+#計時區段 (未開啟時不做任何事)
+@contextmanager
+def timed(section: str):
+    record = _current()
+    if record is None:
+        yield
+        return
+
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        stats = record['sections'].setdefault(section, {'ms': 0.0, 'calls': 0})
+        stats['ms'] += (time.perf_counter() - t0) * 1000
+        stats['calls'] += 1
+
+#計數器 (例如快取命中/未命中)
+def count(name: str, n: int = 1):
+    record = _current()
+    if record is not None:
+        record['counters'][name] = record['counters'].get(name, 0) + n
+
+#函式計時裝飾器，呼叫次數記在同名區段
+def profiled(section: str):
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if _current() is None:
+                return func(*args, **kwargs)
+            with timed(section):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+#重跑結束時呼叫，整理本次紀錄並加入歷史
+def finish_rerun(context: dict | None = None) -> dict | None:
+    record = _current()
+    if record is None:
+        return None
+
+    result = {
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'total_ms': (time.perf_counter() - record['started']) * 1000,
+        'sections': record['sections'],
+        'counters': record['counters'],
+        **(context or {}),
+    }
+
+    history = st.session_state.setdefault('_perf_history', [])
+    history.append(result)
+    del history[:-PROFILE_HISTORY_SIZE]
+
+    st.session_state['_perf_current'] = None
+    return result
+
+#將紀錄附加到本機 JSON-lines 檔案 (供離線彙整)
+def append_jsonl(result: dict, path: str = PROFILE_LOG_PATH):
+    with open(path, 'a', encoding='utf-8') as f:
+        f.write(json.dumps(result, ensure_ascii=False) + '\n')
+
+#效能分析面板 (顯示本次重跑各區段耗時與計數器)
+def render_panel(result: dict | None):
+    if result is None:
+        return
+
+    import pandas as pd
+
+    with st.expander(f"🔧 效能分析：本次重跑 {result['total_ms']:,.1f} ms", expanded=False):
+        if result['sections']:
+            df_sections = pd.DataFrame.from_dict(result['sections'], orient='index')
+            df_sections['平均 ms'] = df_sections['ms'] / df_sections['calls']
+            df_sections = df_sections.sort_values('ms', ascending=False)
+            st.dataframe(df_sections.style.format({'ms': '{:,.2f}', '平均 ms': '{:,.3f}'}), use_container_width=True)
+
+        if result['counters']:
+            st.json(result['counters'])
+
+        if 'session_kb' in result:
+            server = result.get('server_sessions', {})
+            st.caption(f"本 session 約 {result['session_kb']:,.0f} KB；伺服器 {server.get('in_memory', 0)} 個 session 在記憶體、"
+                       f"{server.get('spilled', 0)} 個已移至磁碟，合計 {server.get('total_mb', 0):,.1f} / {server.get('budget_mb', 0):,.0f} MB。")
+
+        history = st.session_state.get('_perf_history', [])
+        if len(history) > 1:
+            st.line_chart(pd.Series([h['total_ms'] for h in history], name='重跑耗時 (ms)'))
+
+        st.caption(f"勾選「寫入 JSONL」後，每次重跑紀錄都會附加到 `{PROFILE_LOG_PATH}`。")
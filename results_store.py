@@ -0,0 +1,285 @@
+import json
+import logging
+import os
+import queue
+import sqlite3
+import threading
+import time
+import zlib
+from datetime import datetime
+
+import numpy as np
+import streamlit as st
+
+# 已結束回測的紀錄庫 (SQLite)，可用環境變數 KSIM_RESULTS_DB 指定路徑
+RESULTS_DB_PATH = os.environ.get('KSIM_RESULTS_DB', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'ksim_results.db'))
+WRITE_BATCH_SIZE = 200      # 每批最多寫入筆數
+WRITE_FLUSH_SECONDS = 1.0   # 佇列有資料時最久多久寫入一次
+WRITE_RETRIES = 5           # 寫入失敗 (例如資料庫被鎖定) 時的重試次數
+WRITE_RETRY_SECONDS = 0.5   # 重試間隔 (每次重試遞增)
+
+logger = logging.getLogger(__name__)
+
+# 交易紀錄以欄位方式保存 (每欄一個陣列，壓縮後存成 BLOB)
+LEDGER_COLUMNS = ['日期', '模式', '類型', '股數', '價格', '金額', '損益', '開倉總值', '手續費', 'leverage', 'pos_id', 'bar', '財務成本']
+
+# 統計彙總表的槓桿分組 (取不超過實際最大槓桿的最大分組)，以這些值查詢「槓桿 ≥ X」時不需掃描全部紀錄
+LEVERAGE_BUCKETS = [1.0, 2.0, 5.0, 10.0, 20.0]
+
+# 摘要欄位 (sessions 資料表中除 id 與 ledger 以外的欄位)
+SUMMARY_COLUMNS = [
+    'finished_at', 'ticker', 'asset_type', 'scenario_offset', 'start_idx', 'end_idx', 'start_date', 'end_date',
+    'final_equity', 'total_return_pct', 'buy_and_hold_pct', 'sharpe', 'max_drawdown_pct',
+    'n_trades', 'fees_total', 'max_leverage', 'liquidated', 'outcome',
+]
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions (
+    id INTEGER PRIMARY KEY,
+    finished_at TEXT NOT NULL,
+    ticker TEXT NOT NULL,
+    asset_type TEXT NOT NULL,
+    scenario_offset INTEGER,
+    start_idx INTEGER,
+    end_idx INTEGER,
+    start_date TEXT,
+    end_date TEXT,
+    final_equity REAL,
+    total_return_pct REAL,
+    buy_and_hold_pct REAL,
+    sharpe REAL,
+    max_drawdown_pct REAL,
+    n_trades INTEGER,
+    fees_total REAL,
+    max_leverage REAL,
+    liquidated INTEGER,
+    outcome TEXT,
+    ledger BLOB
+);
+CREATE INDEX IF NOT EXISTS idx_sessions_ticker ON sessions (ticker, asset_type, outcome, max_leverage);
+CREATE INDEX IF NOT EXISTS idx_sessions_asset_type ON sessions (asset_type, outcome);
+CREATE INDEX IF NOT EXISTS idx_sessions_outcome ON sessions (outcome);
+CREATE INDEX IF NOT EXISTS idx_sessions_return ON sessions (total_return_pct DESC);
+CREATE INDEX IF NOT EXISTS idx_sessions_ticker_return ON sessions (ticker, total_return_pct DESC);
+CREATE INDEX IF NOT EXISTS idx_sessions_asset_type_return ON sessions (asset_type, total_return_pct DESC);
+CREATE TABLE IF NOT EXISTS outcome_totals (
+    ticker TEXT NOT NULL,
+    asset_type TEXT NOT NULL,
+    outcome TEXT NOT NULL,
+    lev_bucket REAL NOT NULL,
+    n INTEGER NOT NULL,
+    sum_return_pct REAL NOT NULL,
+    sum_excess_pct REAL NOT NULL,
+    PRIMARY KEY (ticker, asset_type, outcome, lev_bucket)
+);
+"""
+
+def connect(path: str = RESULTS_DB_PATH) -> sqlite3.Connection:
+    conn = sqlite3.connect(path, check_same_thread=False)
+    # WAL：寫入時不阻擋查詢
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    conn.executescript(SCHEMA)
+    return conn
+
+#交易紀錄 (list of dict) 轉為欄位式並壓縮
+def pack_ledger(transactions: list) -> bytes:
+    columns = {col: [_json_value(tx.get(col)) for tx in transactions] for col in LEDGER_COLUMNS}
+    return zlib.compress(json.dumps(columns, ensure_ascii=False).encode('utf-8'), 6)
+
+def unpack_ledger(blob: bytes) -> dict:
+    return json.loads(zlib.decompress(blob).decode('utf-8'))
+
+def _json_value(v):
+    if isinstance(v, datetime):
+        return v.isoformat()
+    if isinstance(v, (np.floating, float)):
+        return None if np.isnan(v) else float(v)
+    if isinstance(v, np.integer):
+        return int(v)
+    return v
+
+#由結算報告建立一筆紀錄
+#結果依結束當下的狀態判斷：busted 為模擬因總資產歸零而結束 (而非結算)，final_equity 為結束時的總資產
+def build_record(report: dict, transactions: list, ticker: str, asset_type: str,
+                 scenario_offset: int, start_idx: int, end_idx: int, core_data, initial_capital: float,
+                 busted: bool = False) -> dict:
+    final_equity = report['final_equity']
+    liquidated = any(str(tx.get('類型', '')).startswith('強制平倉') for tx in transactions)
+    if busted or final_equity <= 0:
+        outcome = 'bust'
+    elif liquidated:
+        outcome = 'liquidated'
+    else:
+        outcome = 'profit' if final_equity >= initial_capital else 'loss'
+
+    leverages = [tx.get('leverage', 1.0) for tx in transactions]
+    end_idx = min(end_idx, len(core_data) - 1)
+    return {
+        'finished_at': datetime.now().isoformat(timespec='seconds'),
+        'ticker': ticker,
+        'asset_type': asset_type,
+        'scenario_offset': int(scenario_offset),
+        'start_idx': int(start_idx),
+        'end_idx': int(end_idx),
+        'start_date': core_data['Date'].iloc[start_idx].isoformat(),
+        'end_date': core_data['Date'].iloc[end_idx].isoformat(),
+        'final_equity': float(final_equity),
+        'total_return_pct': float(report['total_return_pct']),
+        'buy_and_hold_pct': float(report['buy_and_hold_pct']),
+        'sharpe': _json_value(report['sharpe']),
+        'max_drawdown_pct': _json_value(report['max_drawdown_pct']),
+        'n_trades': int(report['n_trades']),
+        'fees_total': float(report['fees_total']),
+        'max_leverage': float(max(leverages, default=1.0)),
+        'liquidated': int(liquidated),
+        'outcome': outcome,
+        'ledger': pack_ledger(transactions),
+    }
+
+def leverage_bucket(leverage: float) -> float:
+    return max((b for b in LEVERAGE_BUCKETS if b <= leverage), default=LEVERAGE_BUCKETS[0])
+
+#一次寫入多筆 (單一交易)，同時累加統計彙總表
+def insert_records(conn: sqlite3.Connection, records: list):
+    columns = SUMMARY_COLUMNS + ['ledger']
+    sql = f"INSERT INTO sessions ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})"
+    totals_sql = (
+        "INSERT INTO outcome_totals VALUES (?, ?, ?, ?, 1, ?, ?) "
+        "ON CONFLICT (ticker, asset_type, outcome, lev_bucket) DO UPDATE SET "
+        "n = n + 1, sum_return_pct = sum_return_pct + excluded.sum_return_pct, sum_excess_pct = sum_excess_pct + excluded.sum_excess_pct"
+    )
+    with conn:
+        conn.executemany(sql, [tuple(r[c] for c in columns) for r in records])
+        conn.executemany(totals_sql, [
+            (r['ticker'], r['asset_type'], r['outcome'], leverage_bucket(r['max_leverage']),
+             r['total_return_pct'], r['total_return_pct'] - r['buy_and_hold_pct'])
+            for r in records
+        ])
+
+
+#背景寫入器：紀錄放入佇列後立即返回，由背景執行緒分批寫入 (不佔用使用者的重跑時間)
+class ResultsWriter:
+    def __init__(self, path: str = RESULTS_DB_PATH):
+        self.path = path
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._run, name='ksim-results-writer', daemon=True)
+        self.thread.start()
+
+    def submit(self, record: dict):
+        self.queue.put(record)
+
+    def _run(self):
+        conn = None
+        while True:
+            batch = [self.queue.get()]
+            deadline = time.monotonic() + WRITE_FLUSH_SECONDS
+            while len(batch) < WRITE_BATCH_SIZE:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self.queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            conn = self._write(conn, batch)
+            for _ in batch:
+                self.queue.task_done()
+
+    #寫入一批紀錄：失敗時記錄錯誤、重新連線後重試；重試用盡仍失敗才逐筆寫入，只放棄無法寫入的紀錄
+    def _write(self, conn, batch: list):
+        for attempt in range(WRITE_RETRIES):
+            try:
+                if conn is None:
+                    conn = connect(self.path)
+                insert_records(conn, batch)
+                return conn
+            except sqlite3.Error:
+                logger.warning('寫入 %d 筆回測紀錄失敗 (第 %d 次)，稍後重試', len(batch), attempt + 1, exc_info=True)
+                if conn is not None:
+                    conn.close()
+                conn = None
+                time.sleep(WRITE_RETRY_SECONDS * (attempt + 1))
+        for record in batch:
+            try:
+                if conn is None:
+                    conn = connect(self.path)
+                insert_records(conn, [record])
+            except sqlite3.Error:
+                logger.exception('放棄寫入回測紀錄 (%s, %s)', record.get('ticker'), record.get('finished_at'))
+        return conn
+
+    #等待佇列中的紀錄全部寫入 (測試/離開前使用)
+    def flush(self):
+        self.queue.join()
+
+@st.cache_resource(show_spinner=False)
+def get_writer() -> ResultsWriter:
+    return ResultsWriter()
+
+#查詢用的唯讀連線 (每個執行緒一條)
+_local = threading.local()
+
+def _query_conn(path: str = RESULTS_DB_PATH) -> sqlite3.Connection:
+    conns = getattr(_local, 'conns', None)
+    if conns is None:
+        conns = _local.conns = {}
+    if path not in conns:
+        conns[path] = connect(path)
+    return conns[path]
+
+def _where(ticker: str | None, asset_type: str | None, min_leverage: float | None) -> tuple[str, list]:
+    clauses, params = [], []
+    if ticker:
+        clauses.append('ticker = ?')
+        params.append(ticker)
+    if asset_type:
+        clauses.append('asset_type = ?')
+        params.append(asset_type)
+    if min_leverage is not None:
+        clauses.append('max_leverage >= ?')
+        params.append(min_leverage)
+    return (' WHERE ' + ' AND '.join(clauses)) if clauses else '', params
+
+#排行榜 (依報酬率排序)
+def leaderboard(ticker: str | None = None, asset_type: str | None = None, limit: int = 20, path: str = RESULTS_DB_PATH) -> list:
+    where, params = _where(ticker, asset_type, None)
+    sql = (f"SELECT id, finished_at, ticker, asset_type, total_return_pct, final_equity, n_trades, max_leverage, outcome "
+           f"FROM sessions{where} ORDER BY total_return_pct DESC LIMIT ?")
+    cursor = _query_conn(path).execute(sql, params + [limit])
+    names = [d[0] for d in cursor.description]
+    return [dict(zip(names, row)) for row in cursor.fetchall()]
+
+#結果統計：各結果的場次與比例、平均報酬 (例如 BTC-USD 槓桿 ≥10 的爆倉比例)
+#槓桿門檻為分組值 (或不限) 時直接查彙總表，其餘情況掃描紀錄
+def outcome_stats(ticker: str | None = None, asset_type: str | None = None, min_leverage: float | None = None, path: str = RESULTS_DB_PATH) -> dict:
+    if min_leverage is None or min_leverage in LEVERAGE_BUCKETS:
+        where, params = _where(ticker, asset_type, None)
+        if min_leverage is not None:
+            where += (' AND' if where else ' WHERE') + ' lev_bucket >= ?'
+            params.append(min_leverage)
+        sql = (f"SELECT outcome, SUM(n), SUM(sum_return_pct) / SUM(n), SUM(sum_excess_pct) / SUM(n) "
+               f"FROM outcome_totals{where} GROUP BY outcome")
+    else:
+        where, params = _where(ticker, asset_type, min_leverage)
+        sql = (f"SELECT outcome, COUNT(*), AVG(total_return_pct), AVG(total_return_pct - buy_and_hold_pct) "
+               f"FROM sessions{where} GROUP BY outcome")
+    rows = _query_conn(path).execute(sql, params).fetchall()
+    total = sum(r[1] for r in rows)
+    return {
+        'sessions': total,
+        'outcomes': {
+            outcome: {'count': n, 'fraction': n / total, 'avg_return_pct': avg_ret, 'avg_excess_pct': avg_excess}
+            for outcome, n, avg_ret, avg_excess in rows
+        },
+    }
+
+#讀取單一場次 (含還原後的交易紀錄)
+def load_session(session_id: int, path: str = RESULTS_DB_PATH) -> dict | None:
+    cursor = _query_conn(path).execute('SELECT * FROM sessions WHERE id = ?', (session_id,))
+    row = cursor.fetchone()
+    if row is None:
+        return None
+    record = dict(zip([d[0] for d in cursor.description], row))
+    record['ledger'] = unpack_ledger(record['ledger'])
+    return record
@@ -0,0 +1,125 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+from data_manager import VIEW_DAYS
+from trade_engine import FEE_RATE, LEVERAGE_FEE_RATE
+
+# 歷史模擬 VaR/CVaR 的信賴水準 (可用環境變數 KSIM_VAR_CONFIDENCE 覆寫)
+VAR_CONFIDENCE = float(os.environ.get('KSIM_VAR_CONFIDENCE', '0.95'))
+
+# 假設價格損益表的價格點數，以及價格範圍 (倉位開倉價/強平價的最低與最高再各延伸的比例)
+PAYOFF_POINTS = 400
+PAYOFF_SPAN = 0.5
+
+#倉位簿的陣列形式 (每個倉位一欄)，倉位改變 (開平倉、加碼、強平價) 時才重建
+#所有倉位統一成 淨值 = margin + side·qty·(有效價格 - cost) - financing：現貨 margin = qty·cost、side = 1 即為市值
+#逐倉槓桿倉位的有效價格在強制平倉價截斷 (越過後倉位已以強平價平倉，淨值不再變動)
+#已計提持有成本每根 K 棒都會變動且與價格無關，每次另外讀取，不觸發重建
+def book_arrays(cache: dict, positions: list) -> dict:
+    sig = tuple((pos['id'], pos['qty'], pos['initial_cost'], pos.get('liquidation_price', 0.0)) for pos in positions)
+    if cache.get('sig') == sig:
+        book = cache['book']
+        book['financing'] = np.array([pos.get('financing', 0.0) for pos in positions], dtype=float)
+        return book
+
+    is_spot = np.array([pos['pos_mode'] == '現貨' for pos in positions], dtype=bool)
+    is_short = np.array([pos['pos_mode'] == '融券' for pos in positions], dtype=bool)
+    qty = np.array([pos['qty'] for pos in positions], dtype=float)
+    cost = np.array([pos['cost'] for pos in positions], dtype=float)
+    book = {
+        'sig': sig,
+        'ids': [pos['id'] for pos in positions],
+        'side': np.where(is_short, -1.0, 1.0),
+        'qty': qty,
+        'cost': cost,
+        'margin': np.array([pos['qty'] * pos['cost'] if pos['pos_mode'] == '現貨' else pos['initial_cost'] / pos['leverage'] for pos in positions], dtype=float),
+        'financing': np.array([pos.get('financing', 0.0) for pos in positions], dtype=float),
+        'liq': np.array([0.0 if pos['pos_mode'] == '現貨' else pos.get('liquidation_price', 0.0) for pos in positions], dtype=float),
+        'fee_rate': np.where(is_spot, FEE_RATE, LEVERAGE_FEE_RATE),
+    }
+    cache.clear()
+    cache.update(sig=sig, book=book)
+    return book
+
+#所有倉位在一組價格下的淨值，回傳 (價格數, 倉位數) 矩陣 (一次廣播計算)
+#fees=True 時扣除以該價格平倉的手續費 (即平倉後實際回到現金的金額)
+def lot_values(prices, book: dict, fees: bool = False) -> np.ndarray:
+    p = np.asarray(prices, dtype=float)[:, None]
+    liq, side = book['liq'], book['side']
+    # 多頭在強平價以下、空頭在強平價以上都以強平價計 (沒有強平價的倉位不截斷)
+    effective = np.where(liq > 0, np.where(side > 0, np.maximum(p, liq), np.minimum(p, liq)), p)
+    values = book['margin'] + side * book['qty'] * (effective - book['cost']) - book['financing']
+    if fees:
+        values = values - book['fee_rate'] * book['qty'] * effective
+    return values
+
+#投資組合風險：曝險與槓桿取自帳戶彙總 (O(1))，VaR/CVaR 以最近 VIEW_DAYS 根的單根報酬套用到目前倉位 (一次矩陣計算)
+#returns 為整段開盤價報酬 (只取視窗切片)、totals 為 st.session_state.margin_totals、account_liq 為全倉的 (價位, 方向) 或 None
+def portfolio_risk(cache: dict, positions: list, totals: dict, balance: float, price: float,
+                   returns: np.ndarray, idx: int, account_liq=None, confidence: float = VAR_CONFIDENCE) -> dict:
+    equity = balance + totals['const'] + totals['slope'] * price
+    gross = (totals.get('spot', 0.0) + totals['gross']) * price
+    risk = {
+        'equity': equity,
+        'gross_exposure': gross,
+        'net_exposure': totals['slope'] * price,
+        'leverage': gross / equity if equity > 0 else None, # 權益為負時無意義
+        'var': 0.0,
+        'cvar': 0.0,
+        'scenarios': 0,
+        'liquidations': [],
+    }
+    if not positions or price <= 0:
+        return risk
+
+    # 歷史模擬：情境價格 = 目前價格·(1 + 過去單根報酬)，倉位淨值加總後與目前淨值相減即為情境損益
+    window = returns[max(1, idx - VIEW_DAYS + 1):idx + 1]
+    window = window[np.isfinite(window)]
+    book = book_arrays(cache, positions)
+    if len(window):
+        scenario_prices = np.concatenate([[price], price * (1.0 + window)])
+        values = lot_values(scenario_prices, book).sum(axis=1)
+        pnl = values[1:] - values[0]
+        k = int(np.floor((1.0 - confidence) * len(pnl)))
+        tail = np.partition(pnl, k)[:k + 1]
+        risk.update(var=max(-tail[k], 0.0), cvar=max(-tail.mean(), 0.0), scenarios=len(pnl))
+
+    # 距離強制平倉價 (價格需變動的比例，正值為尚未觸發)
+    liquidations = [
+        {'倉位': pos_id[-4:], '強平價': liq, '距離 (%)': (price - liq) / price * side * 100}
+        for pos_id, liq, side in zip(book['ids'], book['liq'], book['side']) if liq > 0
+    ]
+    if account_liq is not None and np.isfinite(account_liq[0]):
+        level, direction = account_liq
+        liquidations.append({'倉位': '帳戶 (全倉)', '強平價': max(level, 0.0), '距離 (%)': (price - level) / price * direction * 100})
+    risk['liquidations'] = liquidations
+    return risk
+
+#假設價格損益表：所有倉位在 PAYOFF_POINTS 個價格上一次廣播計算 (含平倉手續費與強平截斷)
+#價格範圍只由倉位決定，網格與各價格的倉位淨值加總快取在 cache，倉位改變時才重算；持有成本與現金只是常數平移
+#回傳 {'價格', '平倉損益', '總資產'} 陣列：平倉損益 = 以該價格全部平倉的實現損益 (扣除手續費與已計提持有成本)
+def payoff_ladder(cache: dict, book: dict, balance: float) -> dict:
+    if cache.get('sig') != book['sig']:
+        anchors = np.concatenate([book['cost'], book['liq'][book['liq'] > 0]])
+        prices = np.linspace(anchors.min() * (1.0 - PAYOFF_SPAN), anchors.max() * (1.0 + PAYOFF_SPAN), PAYOFF_POINTS)
+        values = lot_values(prices, {**book, 'financing': 0.0}, fees=True).sum(axis=1)
+        cache.clear()
+        cache.update(sig=book['sig'], prices=prices, pnl=values - book['margin'].sum(), values=values)
+
+    financing = book['financing'].sum()
+    return {
+        '價格': cache['prices'],
+        '平倉損益': cache['pnl'] - financing,
+        '總資產': balance + cache['values'] - financing,
+    }
+
+#以單一假設價格全部平倉的損益與總資產 (與損益表相同的計算)
+def payoff_at(book: dict, balance: float, price: float) -> tuple[float, float]:
+    values = lot_values([price], book, fees=True)[0]
+    return float((values - book['margin']).sum()), float(balance + values.sum())
+
+#強制平倉距離表格 (由近到遠)
+def liquidation_table(risk: dict) -> pd.DataFrame:
+    return pd.DataFrame(risk['liquidations']).sort_values('距離 (%)') if risk['liquidations'] else pd.DataFrame()
@@ -0,0 +1,121 @@
+import bisect
+import random
+import string
+import threading
+import time
+
+import pandas as pd
+import streamlit as st
+
+from data_manager import VIEW_DAYS, MIN_SIMULATION_DAYS
+
+ROOM_CODE_LENGTH = 6
+ROOM_IDLE_SECONDS = 6 * 3600 # 超過此時間沒有任何玩家活動的房間會被移除
+# 房間固定的交易規則 (st.session_state 的鍵)：建立房間時取自房主的設定，加入的玩家一律套用，排行榜在相同規則下比較
+ROOM_RULE_KEYS = ['intrabar_model', 'intrabar_seed', 'fill_model', 'margin_mode']
+
+#對戰房間：所有玩家共用同一份唯讀的 K 棒與指標數據，各自只保存倉位與交易紀錄
+class Room:
+    def __init__(self, code: str, ticker: str, asset_type: str, offset: int, data: pd.DataFrame, host: str, rules: dict):
+        self.code = code
+        self.ticker = ticker
+        self.asset_type = asset_type
+        self.offset = offset   # 回測視窗在完整數據中的起點
+        self.data = data       # 已截取的回測視窗 (唯讀，所有玩家共用)
+        self.rules = rules     # 交易規則 (ROOM_RULE_KEYS -> 值)，所有玩家共用
+        self.host = host
+        self.created = time.time()
+        self.last_active = self.created
+        self.lock = threading.Lock()
+        # player_id -> {'name', 'equity', 'bar', 'finished'}
+        self.players = {}
+        # 依總資產由高到低排序的 (-總資產, player_id)，玩家更新時只移動自己的位置
+        self.ranking = []
+
+    def _key(self, player_id: str) -> tuple:
+        return (-self.players[player_id]['equity'], player_id)
+
+    def join(self, player_id: str, name: str, equity: float):
+        with self.lock:
+            if player_id in self.players:
+                self.players[player_id]['name'] = name
+                return
+            self.players[player_id] = {'name': name, 'equity': equity, 'bar': VIEW_DAYS, 'finished': False}
+            bisect.insort(self.ranking, self._key(player_id))
+            self.last_active = time.time()
+
+    #玩家回報自己的總資產 (O(log n) 找到位置後移動，不重算其他玩家)
+    def report(self, player_id: str, equity: float, bar: int, finished: bool):
+        with self.lock:
+            player = self.players.get(player_id)
+            if player is None:
+                return
+            self.last_active = time.time()
+            player['bar'] = bar
+            player['finished'] = finished
+            if player['equity'] == equity:
+                return
+            old_key = self._key(player_id)
+            del self.ranking[bisect.bisect_left(self.ranking, old_key)]
+            player['equity'] = equity
+            bisect.insort(self.ranking, self._key(player_id))
+
+    #前 N 名與指定玩家的名次 (1 起算)
+    def standings(self, limit: int = 10, player_id: str | None = None) -> tuple[list, int | None]:
+        with self.lock:
+            top = [
+                {'rank': i + 1, 'player_id': pid, **self.players[pid]}
+                for i, (_, pid) in enumerate(self.ranking[:limit])
+            ]
+            rank = None
+            if player_id in self.players:
+                rank = bisect.bisect_left(self.ranking, self._key(player_id)) + 1
+            return top, rank
+
+
+#伺服器層級的房間登記表
+class RoomRegistry:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.rooms = {}
+
+    def _new_code(self) -> str:
+        alphabet = string.ascii_uppercase + string.digits
+        while True:
+            code = ''.join(random.choices(alphabet, k=ROOM_CODE_LENGTH))
+            if code not in self.rooms:
+                return code
+
+    #建立房間：從完整數據截取回測視窗 (起點未指定時隨機)，之後所有玩家共用
+    #rules 為房間的交易規則 (ROOM_RULE_KEYS 的值，通常取自房主目前的設定)
+    #數據不足 VIEW_DAYS 根歷史 K 棒加上至少一根模擬 K 棒時丟出 ValueError (訊息可直接顯示給使用者)
+    def create(self, ticker: str, asset_type: str, full_data: pd.DataFrame, host: str, rules: dict, offset: int | None = None) -> Room:
+        if len(full_data) <= VIEW_DAYS:
+            raise ValueError(f"{ticker} 有效數據只有 {len(full_data)} 筆，不足建立房間所需的 {VIEW_DAYS + 1} 筆。")
+        required_days = VIEW_DAYS + MIN_SIMULATION_DAYS
+        max_offset = max(0, len(full_data) - required_days)
+        if offset is None:
+            offset = random.randint(0, max_offset)
+        offset = min(max(0, offset), max_offset)
+        data = full_data.iloc[offset:offset + required_days].reset_index(drop=True)
+
+        with self.lock:
+            self._drop_idle()
+            room = Room(self._new_code(), ticker, asset_type, offset, data, host, {k: rules[k] for k in ROOM_RULE_KEYS})
+            self.rooms[room.code] = room
+        return room
+
+    def get(self, code: str | None) -> Room | None:
+        if not code:
+            return None
+        with self.lock:
+            return self.rooms.get(code.strip().upper())
+
+    def _drop_idle(self):
+        now = time.time()
+        for code in [c for c, r in self.rooms.items() if now - r.last_active > ROOM_IDLE_SECONDS]:
+            del self.rooms[code]
+
+@st.cache_resource(show_spinner=False)
+def get_rooms() -> RoomRegistry:
+    return RoomRegistry()
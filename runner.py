@@ -0,0 +1,353 @@
+#Ksim 無介面批次回測 (不經過 streamlit run，以相同的交易規則全速執行腳本化情境)
+#    python runner.py specs.json                       # 執行並把結果寫到 runner_out/
+#    python runner.py specs.json --workers 4 --out nightly/
+#    python runner.py specs.json --format parquet      # 交易紀錄/權益曲線另存 Parquet (需安裝 pyarrow)
+#
+#情境檔為 JSON (單一物件、物件陣列，或每行一個物件的 JSON Lines)，欄位：
+#    name        輸出檔名 (預設 spec_<序號>)
+#    ticker      代碼 (依 KSIM_DATA_SOURCE 下載，或使用本機數據庫)；或 data_file 指定本機 CSV/Parquet (Date, Open, High, Low, Close, Volume)
+#    asset_type  ASSET_CONFIGS 之一 (預設 Stock)
+#    offset      回測視窗起點；未指定時以 seed 隨機選取 (與網頁版相同規則)
+#    script      [{"day": 0, "action": "open", "mode": "Spot_Buy", "percent": 50}, {"day": 30, "action": "close"}, ...]
+#                day 為模擬開始後第幾根 K 棒；action: open (qty 或 percent、leverage、sl、tp)、close (可指定 mode)、end
+#    strategy    {"name": "ma_cross", "fast": 20, "slow": 60, "percent": 90}，內建策略見 STRATEGIES
+#    days        最多模擬幾根 K 棒 (預設跑到視窗結束)
+#    intrabar_model / intrabar_seed   盤中觸發順序模型 (intrabar.INTRABAR_MODELS) 與布朗橋路徑的種子
+#    fill_model  成交模型 (fill_model.FILL_MODELS)，volume 時開倉受成交量限制並計算滑價
+#    margin_mode 保證金模式 (trade_engine.MARGIN_MODES)，cross 時以帳戶維持保證金判斷強制平倉
+#    expect      {"final_equity": 123456.7, "tolerance": 0.01}：與結果不符時結束代碼為 1 (回歸測試用)
+import argparse
+import json
+import logging
+import os
+import random
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+
+import numpy as np
+import pandas as pd
+import streamlit as st
+
+from data_manager import add_indicators, load_with_indicators, select_random_start_index, VIEW_DAYS
+from trade_engine import (
+    ASSET_CONFIGS,
+    TRADE_MODE_MAP,
+    INITIAL_CAPITAL,
+    FEE_RATE,
+    LEVERAGE_FEE_RATE,
+    MARGIN_MODES,
+    DEFAULT_MARGIN_MODE,
+    init_session_state,
+    reset_state,
+    start_scenario,
+    execute_trade,
+    close_position_lot,
+    settle_portfolio,
+    _advance_one_day,
+)
+from analytics import compute_report
+from intrabar import INTRABAR_MODELS, DEFAULT_INTRABAR_MODEL
+from fill_model import FILL_MODELS, DEFAULT_FILL_MODEL
+
+DEFAULT_OUT_DIR = 'runner_out'
+
+#讀取數據 (同一行程內相同代碼/檔案只載入一次)
+@lru_cache(maxsize=16)
+def load_data(ticker: str | None, data_file: str | None) -> pd.DataFrame:
+    if data_file:
+        if data_file.endswith('.parquet'):
+            raw = pd.read_parquet(data_file)
+        else:
+            raw = pd.read_csv(data_file, parse_dates=['Date'])
+        return add_indicators(raw[['Date', 'Open', 'High', 'Low', 'Close', 'Volume']].copy())
+    # 代碼數據的指標以內容鍵快取在本機磁碟，所有 worker 行程共用
+    data = load_with_indicators(ticker)
+    if data is None:
+        raise ValueError(f"無法載入 {ticker} 的數據")
+    return data
+
+#百分比開倉換算數量 (與網頁版開倉面板相同：以現金餘額 × 比例 × 槓桿，取最小單位的倍數)
+def percent_quantity(percent: float, price: float, leverage: float, asset_type: str) -> float:
+    min_qty = ASSET_CONFIGS[asset_type]['min_qty']
+    shares = st.session_state.balance * (percent / 100.0) / price * leverage if price > 0 else 0.0
+    if min_qty >= 1:
+        return float(int(shares / min_qty) * min_qty)
+    precision = len(str(min_qty).split('.')[-1])
+    return round(round(shares / min_qty) * min_qty, precision)
+
+
+# --- 內建策略：以「前一根 K 棒收盤為止」的數據決定，於當根開盤價成交 (不會看到未來) ---
+#每個策略回傳當根要執行的動作列表 (與 script 的動作格式相同)
+def strategy_buy_and_hold(data, idx, params):
+    if idx == VIEW_DAYS:
+        # 手續費先從現金扣除，100% 會因餘額不足被拒絕
+        return [{'action': 'open', 'mode': 'Spot_Buy', 'percent': params.get('percent', 99.0)}]
+    return []
+
+def strategy_ma_cross(data, idx, params):
+    fast, slow = data[f"MA{params.get('fast', 20)}"], data[f"MA{params.get('slow', 60)}"]
+    above_now = fast.iloc[idx - 1] > slow.iloc[idx - 1]
+    above_before = fast.iloc[idx - 2] > slow.iloc[idx - 2]
+    holding = bool(st.session_state.positions)
+    if above_now and (not above_before or idx == VIEW_DAYS) and not holding:
+        return [{'action': 'open', 'mode': params.get('mode', 'Spot_Buy'), 'percent': params.get('percent', 90.0), 'leverage': params.get('leverage', 1.0)}]
+    if not above_now and holding:
+        return [{'action': 'close'}]
+    return []
+
+def strategy_rsi(data, idx, params):
+    rsi = data['RSI'].iloc[idx - 1]
+    holding = bool(st.session_state.positions)
+    if rsi < params.get('buy_below', 30) and not holding:
+        return [{'action': 'open', 'mode': params.get('mode', 'Spot_Buy'), 'percent': params.get('percent', 90.0), 'leverage': params.get('leverage', 1.0)}]
+    if rsi > params.get('sell_above', 70) and holding:
+        return [{'action': 'close'}]
+    return []
+
+STRATEGIES = {
+    'buy_and_hold': strategy_buy_and_hold,
+    'ma_cross': strategy_ma_cross,
+    'rsi': strategy_rsi,
+}
+
+#執行一個動作，回傳是否被交易規則拒絕
+def apply_action(action: dict, asset_type: str) -> bool:
+    core_data = st.session_state.core_data
+    idx = st.session_state.current_sim_index
+    price = core_data['Open'].iloc[idx].item()
+    kind = action.get('action')
+
+    if kind == 'open':
+        mode = action.get('mode', 'Spot_Buy')
+        leverage = 1.0 if mode == 'Spot_Buy' else float(action.get('leverage', 1.0))
+        if 'percent' in action:
+            qty = percent_quantity(float(action['percent']), price, leverage, asset_type)
+        else:
+            qty = float(action.get('qty', ASSET_CONFIGS[asset_type]['default_qty']))
+        # SL/TP 交由交易引擎只套用在這筆交易建立的倉位 (成交量模型下每次成交都會套用)
+        result = execute_trade(mode, qty, price, leverage, float(action.get('sl', 0.0)), float(action.get('tp', 0.0)))
+        return result['status'] == 'rejected'
+
+    if kind == 'close':
+        pos_mode = TRADE_MODE_MAP[action['mode']]['pos_mode'] if 'mode' in action else None
+        lots = [p for p in st.session_state.positions if pos_mode is None or p['pos_mode'] == pos_mode]
+        for pos in lots:
+            trade_type = '手動賣出平倉' if pos['pos_mode'] in ['現貨', '融資'] else '手動買回平倉'
+            close_position_lot(pos['id'], pos['qty'], price, trade_type, pos['pos_mode'], mode='手動')
+        return False
+
+    if kind == 'end':
+        settle_portfolio(force_end=True)
+        return False
+
+    raise ValueError(f"未知的動作: {kind}")
+
+def _json_value(v):
+    if hasattr(v, 'isoformat'): # datetime / pd.Timestamp
+        return v.isoformat()
+    if isinstance(v, (np.floating, float)):
+        return None if np.isnan(v) else float(v)
+    if isinstance(v, np.integer):
+        return int(v)
+    return v
+
+#執行單一情境，回傳結果 (可 JSON 序列化)
+def run_spec(spec: dict) -> dict:
+    asset_type = spec.get('asset_type', 'Stock')
+    if asset_type not in ASSET_CONFIGS:
+        raise ValueError(f"未知的資產類型: {asset_type}")
+    if spec.get('intrabar_model', DEFAULT_INTRABAR_MODEL) not in INTRABAR_MODELS:
+        raise ValueError(f"未知的盤中觸發模型: {spec['intrabar_model']}")
+    if spec.get('fill_model', DEFAULT_FILL_MODEL) not in FILL_MODELS:
+        raise ValueError(f"未知的成交模型: {spec['fill_model']}")
+    if spec.get('margin_mode', DEFAULT_MARGIN_MODE) not in MARGIN_MODES:
+        raise ValueError(f"未知的保證金模式: {spec['margin_mode']}")
+    data = load_data(spec.get('ticker'), spec.get('data_file'))
+
+    offset = spec.get('offset')
+    if offset is None:
+        random.seed(spec.get('seed'))
+        start = select_random_start_index(data)
+        if start is None:
+            raise ValueError(f"數據只有 {len(data)} 筆，不足 {VIEW_DAYS} 根 K 棒")
+        offset = start[0]
+
+    st.session_state.clear()
+    init_session_state()
+    reset_state()
+    st.session_state.intrabar_model = spec.get('intrabar_model', DEFAULT_INTRABAR_MODEL)
+    st.session_state.intrabar_seed = int(spec.get('intrabar_seed', 0))
+    st.session_state.fill_model = spec.get('fill_model', DEFAULT_FILL_MODEL)
+    st.session_state.margin_mode = spec.get('margin_mode', DEFAULT_MARGIN_MODE)
+    st.session_state.ticker = spec.get('ticker') or os.path.basename(spec['data_file'])
+    start_scenario(data, int(offset), asset_type)
+    core_data = st.session_state.core_data
+
+    script = {}
+    for action in spec.get('script', []):
+        script.setdefault(VIEW_DAYS + int(action.get('day', 0)), []).append(action)
+    strategy = spec.get('strategy')
+    strategy_fn = STRATEGIES[strategy['name']] if strategy else None
+
+    last_idx = st.session_state.max_sim_index
+    if spec.get('days') is not None:
+        last_idx = min(last_idx, VIEW_DAYS + int(spec['days']))
+
+    rejected = 0
+    while st.session_state.sim_active:
+        idx = st.session_state.current_sim_index
+        actions = list(script.get(idx, []))
+        if strategy_fn is not None:
+            actions += strategy_fn(core_data, idx, strategy)
+        for action in actions:
+            if not st.session_state.sim_active:
+                break
+            rejected += apply_action(action, asset_type)
+        if not st.session_state.sim_active:
+            break
+        if idx >= last_idx:
+            settle_portfolio(force_end=True)
+            break
+        _advance_one_day()
+
+    end_idx = st.session_state.end_sim_index_on_settle
+    if end_idx is None:
+        end_idx = st.session_state.current_sim_index
+    report = compute_report(
+        core_data, st.session_state.transactions, st.session_state.equity_curve,
+        VIEW_DAYS, end_idx, INITIAL_CAPITAL, FEE_RATE, LEVERAGE_FEE_RATE, asset_type
+    )
+    excursions = report.pop('excursions')
+    metrics = {k: _json_value(v) for k, v in report.items()}
+    metrics['rejected_actions'] = rejected
+    metrics['final_balance'] = float(st.session_state.balance)
+
+    dates = core_data['Date'].iloc[VIEW_DAYS:VIEW_DAYS + len(st.session_state.equity_curve)]
+    return {
+        'scenario_offset': int(offset),
+        'start_date': _json_value(core_data['Date'].iloc[VIEW_DAYS]),
+        'end_date': _json_value(core_data['Date'].iloc[min(end_idx, len(core_data) - 1)]),
+        'metrics': metrics,
+        'ledger': [{k: _json_value(v) for k, v in tx.items()} for tx in st.session_state.transactions],
+        'equity_curve': {'date': [d.isoformat() for d in dates], 'equity': [float(e) for e in st.session_state.equity_curve]},
+        'excursions': excursions.to_dict(orient='list'),
+    }
+
+#比對 expect：回傳不符的項目
+def check_expectations(expect: dict, metrics: dict) -> list:
+    tolerance = expect.get('tolerance', 1e-6)
+    failures = []
+    for key, expected in expect.items():
+        if key == 'tolerance':
+            continue
+        actual = metrics.get(key)
+        if actual is None or abs(actual - expected) > tolerance * max(1.0, abs(expected)):
+            failures.append(f"{key}: 預期 {expected}，實際 {actual}")
+    return failures
+
+#寫出單一情境的結果
+def write_outputs(name: str, result: dict, out_dir: str, fmt: str):
+    if fmt == 'parquet':
+        pd.DataFrame(result['ledger']).to_parquet(os.path.join(out_dir, f'{name}.ledger.parquet'))
+        pd.DataFrame(result['equity_curve']).to_parquet(os.path.join(out_dir, f'{name}.equity.parquet'))
+        result = {k: v for k, v in result.items() if k not in ('ledger', 'equity_curve')}
+    with open(os.path.join(out_dir, f'{name}.json'), 'w', encoding='utf-8') as f:
+        json.dump(result, f, ensure_ascii=False, indent=1)
+
+#工作行程：依序執行分配到的情境 (例外只記錄在該情境，不影響其他情境)
+def run_worker(jobs: list, out_dir: str, fmt: str) -> list:
+    logging.disable(logging.WARNING)
+    summaries = []
+    for name, spec in jobs:
+        t0 = time.perf_counter()
+        summary = {'name': name, 'status': 'ok'}
+        try:
+            result = run_spec(spec)
+            result['spec'] = spec
+            write_outputs(name, result, out_dir, fmt)
+            metrics = result['metrics']
+            summary.update({
+                'final_equity': metrics['final_equity'],
+                'total_return_pct': metrics['total_return_pct'],
+                'n_trades': metrics['n_trades'],
+                'max_drawdown_pct': metrics['max_drawdown_pct'],
+            })
+            failures = check_expectations(spec.get('expect', {}), metrics)
+            if failures:
+                summary.update({'status': 'mismatch', 'errors': failures})
+        except Exception as e:
+            summary.update({'status': 'error', 'errors': [f"{type(e).__name__}: {e}"]})
+        summary['elapsed_ms'] = (time.perf_counter() - t0) * 1000
+        summaries.append(summary)
+    return summaries
+
+def load_specs(path: str) -> list:
+    with open(path, encoding='utf-8') as f:
+        text = f.read().strip()
+    if text.startswith('['):
+        specs = json.loads(text)
+    elif text.startswith('{') and '\n{' not in text:
+        specs = [json.loads(text)]
+    else:
+        specs = [json.loads(line) for line in text.splitlines() if line.strip()]
+    return [(spec.get('name') or f'spec_{i:04d}', spec) for i, spec in enumerate(specs)]
+
+def print_report(summaries: list, wall_s: float):
+    header = f"{'name':<24}{'status':>10}{'final equity':>16}{'return %':>10}{'trades':>8}{'ms':>10}"
+    print(header)
+    print('-' * len(header))
+    for s in summaries:
+        if s['status'] == 'error':
+            print(f"{s['name']:<24}{s['status']:>10}  {s['errors'][0]}")
+            continue
+        print(f"{s['name']:<24}{s['status']:>10}{s['final_equity']:>16,.2f}{s['total_return_pct']:>10.2f}{s['n_trades']:>8}{s['elapsed_ms']:>10.1f}")
+        for err in s.get('errors', []):
+            print(f"{'':<24}  {err}")
+    print(f"{len(summaries)} 個情境，耗時 {wall_s:.2f}s")
+
+def main():
+    parser = argparse.ArgumentParser(description="Ksim 無介面批次回測")
+    parser.add_argument('specs', help="情境檔 (JSON / JSON Lines)")
+    parser.add_argument('--out', default=DEFAULT_OUT_DIR, help="輸出資料夾")
+    parser.add_argument('--format', choices=['json', 'parquet'], default='json', help="交易紀錄與權益曲線的輸出格式")
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help="行程數")
+    args = parser.parse_args()
+
+    if args.format == 'parquet':
+        try:
+            import pyarrow  # noqa: F401
+        except ImportError:
+            sys.exit("--format parquet 需要安裝 pyarrow (pip install pyarrow)")
+
+    logging.disable(logging.WARNING)
+    jobs = load_specs(args.specs)
+    os.makedirs(args.out, exist_ok=True)
+
+    # 相同數據來源的情境分在同一個行程，數據只需載入一次
+    jobs.sort(key=lambda job: (job[1].get('ticker') or '', job[1].get('data_file') or ''))
+    n_workers = max(1, min(args.workers, len(jobs)))
+
+    t0 = time.perf_counter()
+    if n_workers == 1:
+        worker_results = [run_worker(jobs, args.out, args.format)]
+    else:
+        chunk = -(-len(jobs) // n_workers)
+        assignments = [jobs[i:i + chunk] for i in range(0, len(jobs), chunk)]
+        with ProcessPoolExecutor(max_workers=len(assignments)) as pool:
+            futures = [pool.submit(run_worker, a, args.out, args.format) for a in assignments]
+            worker_results = [f.result() for f in futures]
+    wall_s = time.perf_counter() - t0
+
+    summaries = sorted((s for r in worker_results for s in r), key=lambda s: s['name'])
+    print_report(summaries, wall_s)
+    with open(os.path.join(args.out, 'summary.json'), 'w', encoding='utf-8') as f:
+        json.dump({'wall_s': wall_s, 'specs': summaries}, f, ensure_ascii=False, indent=2)
+
+    if any(s['status'] != 'ok' for s in summaries):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,124 @@
+import os
+import threading
+
+import numpy as np
+import pandas as pd
+import streamlit as st
+
+from data_manager import VIEW_DAYS, MIN_SIMULATION_DAYS, data_key, asset_type_of
+from analytics import BARS_PER_YEAR
+
+# 市場掃描的預設代碼 (可用環境變數 KSIM_SCAN_UNIVERSE 覆寫，以逗號分隔)
+DEFAULT_SCAN_UNIVERSE = [
+    # 美股大型股
+    'AAPL', 'MSFT', 'NVDA', 'AMZN', 'GOOGL', 'META', 'TSLA', 'BRK-B', 'AVGO', 'LLY',
+    'JPM', 'V', 'UNH', 'XOM', 'MA', 'JNJ', 'PG', 'HD', 'COST', 'MRK',
+    'ABBV', 'CVX', 'ADBE', 'CRM', 'PEP', 'KO', 'AMD', 'NFLX', 'WMT', 'BAC',
+    'TMO', 'MCD', 'CSCO', 'ACN', 'ABT', 'LIN', 'ORCL', 'INTC', 'DIS', 'WFC',
+    'QCOM', 'TXN', 'VZ', 'CMCSA', 'PFE', 'NKE', 'IBM', 'INTU', 'AMAT', 'CAT',
+    'GE', 'BA', 'GS', 'MS', 'SBUX', 'PYPL', 'UBER', 'SHOP', 'PLTR', 'MU',
+    # ETF / 指數
+    'SPY', 'QQQ', 'DIA', 'IWM', 'TLT', 'GLD', 'SLV', 'USO', 'XLF', 'XLE',
+    '^GSPC', '^IXIC', '^DJI', '^N225', '^TWII',
+    # 台股
+    '2330.TW', '2317.TW', '2454.TW', '2308.TW', '2881.TW', '2882.TW', '2412.TW', '0050.TW',
+    # 匯率
+    'JPY=X', 'EURUSD=X', 'GBPUSD=X', 'AUDUSD=X', 'TWD=X', 'CNY=X', 'CHF=X', 'CAD=X',
+    # 加密貨幣
+    'BTC-USD', 'ETH-USD', 'SOL-USD', 'BNB-USD', 'XRP-USD', 'ADA-USD', 'DOGE-USD', 'AVAX-USD',
+]
+SCAN_UNIVERSE = [t for t in os.environ.get('KSIM_SCAN_UNIVERSE', ','.join(DEFAULT_SCAN_UNIVERSE)).split(',') if t]
+
+RSI_OVERBOUGHT, RSI_OVERSOLD = 70.0, 30.0
+CROSS_LOOKBACK = 5  # 最近幾根 K 棒內 MA5/MA20 交叉視為剛交叉
+VOL_WINDOW = 60     # 波動率使用的最近 K 棒數
+
+#單一代碼的指標快照 (只用到最後 VOL_WINDOW 根 K 棒)
+def indicator_snapshot(data: pd.DataFrame) -> dict:
+    tail = data.iloc[-(VOL_WINDOW + 1):]
+    close = tail['Close'].to_numpy(dtype=float)
+    rsi = float(tail['RSI'].iloc[-1])
+
+    # MA5 相對 MA20 的位置，最近 CROSS_LOOKBACK 根內改變方向即為交叉
+    above = (tail['MA5'].to_numpy() > tail['MA20'].to_numpy())[-(CROSS_LOOKBACK + 1):]
+    if above[-1] and not above.all():
+        cross = '黃金交叉'
+    elif not above[-1] and above.any():
+        cross = '死亡交叉'
+    else:
+        cross = '多頭排列' if above[-1] else '空頭排列'
+
+    log_returns = np.diff(np.log(close))
+    bars = len(data)
+    return {
+        '最新日期': pd.Timestamp(data['Date'].iloc[-1]).date(),
+        '收盤': float(close[-1]),
+        'RSI': rsi,
+        'RSI 狀態': '超買' if rsi >= RSI_OVERBOUGHT else '超賣' if rsi <= RSI_OVERSOLD else '',
+        'MA5/MA20': cross,
+        'log_vol': float(np.std(log_returns, ddof=1)) if len(log_returns) > 1 else np.nan,
+        'K 棒數': bars,
+        '可完整回測': bars >= VIEW_DAYS + MIN_SIMULATION_DAYS,
+    }
+
+#掃描結果快取 (伺服器層級，所有 session 共用)：代碼 -> {'key': 數據內容鍵, 'snapshot': 指標快照}
+#數據內容鍵沒有改變的代碼不會重新載入/計算，新 K 棒進入本機數據庫後只更新那些代碼
+class ScanCache:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.failed = set()
+
+    #需要 (重新) 載入的代碼：沒有快照，或本機數據庫內容已改變 (過期時 data_key 為 None，先沿用舊快照並重新確認)
+    def stale(self, tickers: list) -> list:
+        with self.lock:
+            entries = dict(self.entries)
+        stale = []
+        for ticker in tickers:
+            entry = entries.get(ticker)
+            key = data_key(ticker)
+            if entry is None or key is None or key != entry['key']:
+                stale.append(ticker)
+        return stale
+
+    #以載入結果更新快照 (載入失敗的代碼另外記錄)
+    def update(self, ticker: str, key: str | None, data: pd.DataFrame | None):
+        snapshot = indicator_snapshot(data) if data is not None and not data.empty else None
+        with self.lock:
+            if snapshot is None:
+                self.failed.add(ticker)
+                self.entries.pop(ticker, None)
+            else:
+                self.failed.discard(ticker)
+                self.entries[ticker] = {'key': key, 'snapshot': snapshot}
+
+    #依代碼順序組成結果表 (尚未載入的代碼不列出)
+    def table(self, tickers: list) -> pd.DataFrame:
+        with self.lock:
+            rows = [{'代碼': t, **self.entries[t]['snapshot']} for t in tickers if t in self.entries]
+        if not rows:
+            return pd.DataFrame()
+        table = pd.DataFrame(rows)
+        # 年化波動率依代碼的資產類型換算 (加密貨幣 365 天、其餘 252 天)
+        bars_per_year = np.array([BARS_PER_YEAR[asset_type_of(t)] for t in table['代碼']])
+        table.insert(table.columns.get_loc('log_vol'), '年化波動 (%)', table.pop('log_vol') * np.sqrt(bars_per_year) * 100)
+        return table
+
+#掃描一輪：要求背景載入器載入需要更新的代碼 (分批同時下載)，已完成的代碼更新快照
+#回傳仍在載入中的代碼數
+def refresh_scan(cache: ScanCache, loader, tickers: list) -> int:
+    stale = cache.stale(tickers)
+    if not stale:
+        return 0
+    jobs = loader.request(stale)
+    pending = 0
+    for ticker, job in jobs.items():
+        if not job['future'].done():
+            pending += 1
+            continue
+        cache.update(ticker, job.get('key'), job['future'].result())
+    return pending
+
+@st.cache_resource(show_spinner=False)
+def get_scan_cache() -> ScanCache:
+    return ScanCache()
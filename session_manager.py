@@ -0,0 +1,228 @@
+import os
+import pickle
+import sys
+import tempfile
+import threading
+import time
+import zlib
+
+import numpy as np
+import pandas as pd
+import streamlit as st
+from streamlit.runtime import Runtime
+from streamlit.runtime.scriptrunner import get_script_run_ctx
+
+from rooms import get_rooms
+
+# 每台伺服器所有 session 的記憶體預算 (MB)，超過時將最久未互動的 session 寫入磁碟
+SESSION_BUDGET_MB = float(os.environ.get('KSIM_SESSION_BUDGET_MB', '1024'))
+# 至少閒置多久 (秒) 才可被移出記憶體
+SESSION_IDLE_SECONDS = float(os.environ.get('KSIM_SESSION_IDLE_SECONDS', '120'))
+SPILL_DIR = os.environ.get('KSIM_SPILL_DIR', os.path.join(tempfile.gettempdir(), 'ksim_spill'))
+
+# 寫入檢查點的回測狀態 (其餘 session 狀態如 ticker、索引、餘額體積很小，留在記憶體)
+SPILL_KEYS = ['core_data', 'positions', 'transactions', 'equity_curve']
+# 可重建的快取：移出時直接丟棄，下次重跑自動重建
+DISPOSABLE_KEYS = ['chart_cache', 'chart_stream', 'tx_table_cache', 'positions_table_cache', 'risk_cache', 'payoff_cache', 'render_cache', 'settle_report', '_perf_history']
+SPILLED_MARKER = '_spilled_checkpoint'
+
+#估計物件佔用的記憶體 (bytes)，只計算主要的數據結構，不做完整的遞迴走訪
+def estimate_bytes(obj) -> int:
+    if obj is None:
+        return 0
+    if isinstance(obj, (pd.DataFrame, pd.Series)):
+        usage = obj.memory_usage(index=True)
+        return int(usage.sum() if isinstance(usage, pd.Series) else usage)
+    if isinstance(obj, np.ndarray):
+        return obj.nbytes
+    if isinstance(obj, dict):
+        return sys.getsizeof(obj) + sum(estimate_bytes(v) for v in obj.values())
+    if isinstance(obj, (list, tuple)):
+        if not obj:
+            return sys.getsizeof(obj)
+        # 倉位/交易紀錄的每筆結構相同，以前幾筆的平均估計整體
+        sample = obj[:20]
+        per_item = sum(estimate_bytes(v) for v in sample) / len(sample)
+        return sys.getsizeof(obj) + int(per_item * len(obj))
+    if hasattr(obj, 'data') and hasattr(obj, 'layout'): # plotly Figure：只計算軌跡中的數值陣列
+        total = 0
+        for trace in obj.data:
+            for attr in ('x', 'y', 'open', 'high', 'low', 'close'):
+                values = trace[attr] if attr in trace else None
+                if values is not None:
+                    total += values.nbytes if isinstance(values, np.ndarray) else len(values) * 8
+        return total
+    return sys.getsizeof(obj)
+
+#session 狀態中主要數據的估計大小 (bytes)
+def session_footprint(state) -> int:
+    return sum(estimate_bytes(state[key]) for key in SPILL_KEYS + DISPOSABLE_KEYS if key in state)
+
+
+#伺服器層級的 session 登記表 (所有 session 共用一份)
+class SessionRegistry:
+    def __init__(self):
+        self.lock = threading.Lock()
+        # session_id -> {'state': SessionState, 'last_active': 時間, 'bytes': 估計大小, 'lock': 鎖, 'checkpoint': 檢查點路徑}
+        self.entries = {}
+
+    #移除已關閉的 session (伺服器已不再保留)，釋放其狀態並刪除檢查點
+    def _drop_dead(self):
+        for session_id in [sid for sid in self.entries if not _session_alive(sid)]:
+            _remove_checkpoint(self.entries.pop(session_id).get('checkpoint'))
+
+    def stats(self) -> dict:
+        with self.lock:
+            self._drop_dead()
+            return {
+                'sessions': len(self.entries),
+                'in_memory': sum(1 for e in self.entries.values() if e.get('checkpoint') is None),
+                'spilled': sum(1 for e in self.entries.values() if e.get('checkpoint') is not None),
+                'total_mb': sum(e['bytes'] for e in self.entries.values()) / 2**20,
+                'budget_mb': SESSION_BUDGET_MB,
+            }
+
+@st.cache_resource(show_spinner=False)
+def get_registry() -> SessionRegistry:
+    return SessionRegistry()
+
+#session 是否仍由伺服器保留 (斷線重連期間仍算存活；測試/裸模式下沒有 Runtime，一律視為存活)
+def _session_alive(session_id: str) -> bool:
+    if not Runtime.exists():
+        return True
+    session_mgr = getattr(Runtime.instance(), '_session_mgr', None)
+    return session_mgr is None or session_mgr.get_session_info(session_id) is not None
+
+#取得目前 session 的 id 與底層 SessionState (裸模式下沒有 session，回傳 None)
+def _current_session():
+    ctx = get_script_run_ctx(suppress_warning=True)
+    if ctx is None:
+        return None, None
+    # SafeSessionState 每次重跑都會重新建立，登記表持有底層的 SessionState
+    return ctx.session_id, ctx.session_state._state
+
+def _checkpoint_path(session_id: str) -> str:
+    return os.path.join(SPILL_DIR, f"{session_id}.pkl.z")
+
+def _remove_checkpoint(path: str | None):
+    if path:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+#將 session 的回測數據寫入壓縮檢查點並從記憶體移除
+def _spill(session_id: str, state) -> str:
+    os.makedirs(SPILL_DIR, exist_ok=True)
+    path = _checkpoint_path(session_id)
+    payload = {key: state[key] for key in SPILL_KEYS if key in state}
+    # 對戰房間的回測視窗由房間共用，不寫入檢查點，還原時重新指向房間的數據
+    if 'room_code' in state and state['room_code'] and get_rooms().get(state['room_code']) is not None:
+        payload.pop('core_data', None)
+    with open(path, 'wb') as f:
+        f.write(zlib.compress(pickle.dumps(payload, protocol=pickle.HIGHEST_PROTOCOL), 1))
+
+    for key in SPILL_KEYS:
+        if key in state:
+            del state[key]
+    for key in DISPOSABLE_KEYS:
+        if key in state:
+            state[key] = [] if key == '_perf_history' else {}
+    state[SPILLED_MARKER] = path
+    return path
+
+#從檢查點還原 session 的回測數據 (檢查點遺失或損壞時回到初始畫面)
+def _rehydrate(state):
+    path = state[SPILLED_MARKER]
+    del state[SPILLED_MARKER]
+    try:
+        with open(path, 'rb') as f:
+            payload = pickle.loads(zlib.decompress(f.read()))
+    except (OSError, pickle.UnpicklingError, zlib.error, EOFError):
+        state['initialized'] = False
+        st.warning("⚠️ 閒置過久，回測狀態已無法還原，請重新開始回測。")
+        return
+    finally:
+        _remove_checkpoint(path)
+
+    for key, value in payload.items():
+        state[key] = value
+
+    if 'core_data' not in payload:
+        room = get_rooms().get(state['room_code'] if 'room_code' in state else None)
+        if room is None:
+            state['initialized'] = False
+            st.warning("⚠️ 對戰房間已關閉，請重新開始回測。")
+            return
+        state['core_data'] = room.data
+
+#每次重跑開始時呼叫 (需在 init_session_state 之前)：更新最後活動時間，必要時從檢查點還原
+def touch_session():
+    session_id, state = _current_session()
+    if session_id is None:
+        return
+
+    registry = get_registry()
+    with registry.lock:
+        entry = registry.entries.get(session_id)
+        if entry is None or entry['state'] is not state:
+            entry = {'state': state, 'bytes': 0, 'lock': threading.Lock(), 'checkpoint': None}
+            registry.entries[session_id] = entry
+        entry['last_active'] = time.monotonic()
+
+    with entry['lock']:
+        if SPILLED_MARKER in state:
+            _rehydrate(state)
+        entry['checkpoint'] = None
+
+#每次重跑結束時呼叫：記錄本 session 的記憶體用量，超過預算時依 LRU 移出閒置 session
+def account_session() -> int:
+    session_id, state = _current_session()
+    if session_id is None:
+        return 0
+
+    registry = get_registry()
+    footprint = session_footprint(state)
+    with registry.lock:
+        entry = registry.entries.get(session_id)
+        if entry is not None:
+            entry['bytes'] = footprint
+            entry['last_active'] = time.monotonic()
+    enforce_budget(registry)
+    return footprint
+
+#超過記憶體預算時，將最久未互動 (且閒置夠久) 的 session 寫入磁碟，直到回到預算內
+def enforce_budget(registry: SessionRegistry, budget_mb: float = SESSION_BUDGET_MB, idle_seconds: float = SESSION_IDLE_SECONDS) -> int:
+    budget = budget_mb * 2**20
+    now = time.monotonic()
+
+    with registry.lock:
+        registry._drop_dead()
+        total = sum(e['bytes'] for e in registry.entries.values())
+        if total <= budget:
+            return 0
+        candidates = sorted(
+            ((sid, e) for sid, e in registry.entries.items()
+             if e['checkpoint'] is None and e['bytes'] > 0 and now - e['last_active'] >= idle_seconds),
+            key=lambda item: item[1]['last_active'],
+        )
+
+    spilled = 0
+    for session_id, entry in candidates:
+        if total <= budget:
+            break
+        state = entry['state']
+        if not entry['lock'].acquire(blocking=False):
+            continue
+        try:
+            # 取得鎖之後再確認一次仍處於閒置 (避免與該 session 的重跑同時進行)
+            if time.monotonic() - entry['last_active'] < idle_seconds:
+                continue
+            entry['checkpoint'] = _spill(session_id, state)
+            total -= entry['bytes']
+            entry['bytes'] = 0
+            spilled += 1
+        finally:
+            entry['lock'].release()
+
+    return spilled
@@ -0,0 +1,50 @@
+import numpy as np
+import pandas as pd
+
+#合成 OHLCV 數據 (幾何布朗運動 + 跳躍)，相同 seed 產生相同數據，供離線測試與基準測試使用
+def generate_ohlcv(
+    n_bars: int = 1500,
+    seed: int = 0,
+    start_price: float = 100.0,
+    annual_drift: float = 0.08,
+    annual_vol: float = 0.35,
+    jump_intensity: float = 4.0,   # 每年平均跳躍次數
+    jump_mean: float = -0.02,      # 跳躍幅度 (對數報酬) 的平均
+    jump_std: float = 0.08,
+    bars_per_year: int = 252,
+    base_volume: float = 1_000_000.0,
+    start_date: str = '2000-01-03',
+) -> pd.DataFrame:
+    rng = np.random.default_rng(seed)
+    dt = 1.0 / bars_per_year
+
+    # 收盤價：對數報酬 = 漂移 + 擴散 + 複合卜瓦松跳躍
+    diffusion = (annual_drift - 0.5 * annual_vol ** 2) * dt + annual_vol * np.sqrt(dt) * rng.standard_normal(n_bars)
+    n_jumps = rng.poisson(jump_intensity * dt, n_bars)
+    jumps = n_jumps * jump_mean + np.sqrt(n_jumps) * jump_std * rng.standard_normal(n_bars)
+    log_returns = diffusion + jumps
+    close = start_price * np.exp(np.cumsum(log_returns))
+
+    # 開盤價：前一日收盤加上隔夜缺口 (跳躍主要發生在隔夜)
+    prev_close = np.concatenate([[start_price], close[:-1]])
+    gap = 0.25 * annual_vol * np.sqrt(dt) * rng.standard_normal(n_bars) + jumps
+    open_ = prev_close * np.exp(gap)
+
+    # 最高/最低：在開收盤之外加上日內波動
+    intraday = 0.5 * annual_vol * np.sqrt(dt)
+    high = np.maximum(open_, close) * np.exp(np.abs(rng.standard_normal(n_bars)) * intraday)
+    low = np.minimum(open_, close) * np.exp(-np.abs(rng.standard_normal(n_bars)) * intraday)
+
+    # 成交量：對數常態，波動越大量越大
+    volume = base_volume * np.exp(0.4 * rng.standard_normal(n_bars)) * (1.0 + 20.0 * np.abs(log_returns))
+
+    dates = pd.bdate_range(start=start_date, periods=n_bars)
+
+    return pd.DataFrame({
+        'Date': dates,
+        'Open': open_,
+        'High': high,
+        'Low': low,
+        'Close': close,
+        'Volume': np.round(volume),
+    })
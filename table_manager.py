@@ -0,0 +1,124 @@
+import numpy as np
+import pandas as pd
+
+TX_PAGE_SIZE = 50 # 交易紀錄每頁顯示筆數
+
+# 不顯示日期項目
+TX_DISPLAY_COLUMNS = ['模式', '類型', '股數', '價格', '金額', '損益', '損益 (%)', '手續費']
+
+#數字格式化 (缺值顯示空白)
+TX_FORMAT_MAPPING = {
+    '股數': '{:,.3f}', # 允許小數顯示
+    '價格': '${:,.2f}',
+    '金額': '${:,.2f}',
+    '損益': '{:+.2f}',
+    '損益 (%)': '{:+.2f}%',
+    '手續費': '-${:,.2f}'
+}
+
+#模式名稱客製化 (Req 4: 根據 asset_config 顯示)
+def _mode_display_map(asset_config: dict) -> dict:
+    return {
+        '現貨': asset_config['mode_long'],
+        '融資': asset_config['mode_margin_long'],
+        '融券': asset_config['mode_margin_short']
+    }
+
+#正負值顏色 (正值/負值對應的 CSS)
+def _sign_styles(values: pd.Series, positive: str, negative: str) -> np.ndarray:
+    return np.select([values > 0, values < 0], [positive, negative], default='')
+
+#將新增的交易紀錄轉成顯示用表格 (格式化字串) 與顏色表格，只處理新的列
+def _build_tx_rows(new_entries: list, asset_config: dict) -> tuple[pd.DataFrame, pd.DataFrame]:
+    df_tx = pd.DataFrame(new_entries).reindex(columns=TX_DISPLAY_COLUMNS + ['開倉總值', 'leverage'])
+
+    df_tx['模式'] = df_tx['模式'].replace(_mode_display_map(asset_config))
+
+    # 計算損益百分比 (槓桿交易以保證金為計算基礎)
+    initial_cost = df_tx['開倉總值'].fillna(0)
+    leverage = df_tx['leverage'].fillna(1.0)
+    margin_required = initial_cost / leverage
+
+    # PnL % = PnL / Margin_Required
+    valid_calc = (margin_required != 0) & df_tx['損益'].notna()
+    df_tx['損益 (%)'] = np.where(valid_calc, df_tx['損益'].fillna(0) / margin_required.where(valid_calc, 1.0) * 100, np.nan)
+
+    # 顏色欄位：金額 (負=買入/支出 紅, 正=回流 綠)、損益與損益 (%) (正綠負紅)
+    styles = pd.DataFrame('', index=df_tx.index, columns=TX_DISPLAY_COLUMNS)
+    styles['金額'] = _sign_styles(df_tx['金額'], 'color: green', 'color: red')
+    styles['損益'] = _sign_styles(df_tx['損益'], 'color: green', 'color: red')
+    styles['損益 (%)'] = _sign_styles(df_tx['損益 (%)'], 'color: green', 'color: red')
+
+    display = df_tx[TX_DISPLAY_COLUMNS].copy()
+    for col, fmt in TX_FORMAT_MAPPING.items():
+        values = display[col]
+        display[col] = [fmt.format(v) if pd.notna(v) else '' for v in values]
+
+    return display, styles
+
+#取得交易紀錄表格 (交易紀錄只會附加，快取已格式化的列，只處理新增的紀錄)
+def get_transactions_table(cache: dict, transactions: list, asset_config: dict) -> tuple[pd.DataFrame, pd.DataFrame]:
+    n_cached = cache.get('n_rows', 0)
+
+    # 紀錄被重置或資產類型改變時重建
+    if len(transactions) < n_cached or cache.get('asset_config') != asset_config:
+        cache.clear()
+        n_cached = 0
+
+    if n_cached == 0 or len(transactions) > n_cached:
+        new_display, new_styles = _build_tx_rows(transactions[n_cached:], asset_config)
+        if n_cached == 0:
+            cache['display'], cache['styles'] = new_display, new_styles
+        else:
+            cache['display'] = pd.concat([cache['display'], new_display], ignore_index=True)
+            cache['styles'] = pd.concat([cache['styles'], new_styles], ignore_index=True)
+        cache['n_rows'] = len(transactions)
+        cache['asset_config'] = asset_config
+
+    return cache['display'], cache['styles']
+
+#取出指定頁的表格與顏色，只對該頁套用 Styler
+def style_transactions_page(display: pd.DataFrame, styles: pd.DataFrame, page: int, page_size: int = TX_PAGE_SIZE):
+    start = (page - 1) * page_size
+    page_display = display.iloc[start:start + page_size]
+    page_styles = styles.iloc[start:start + page_size]
+    return page_display.style.apply(lambda _: page_styles, axis=None)
+
+#倉位簽章 (倉位內容有變動時才重建表格)
+def _positions_signature(positions: list) -> tuple:
+    return tuple(
+        (pos['id'], pos['pos_mode'], pos['qty'], pos['cost'], pos.get('leverage', 1.0),
+         pos.get('liquidation_price', np.nan), pos['sl'], pos['tp'])
+        for pos in positions
+    )
+
+#取得倉位表格：倉位不變時沿用快取，只以向量方式重算未實現損益
+def get_positions_table(cache: dict, positions: list, price: float, asset_config: dict) -> pd.DataFrame:
+    sig = _positions_signature(positions)
+
+    if cache.get('sig') != sig or cache.get('asset_config') != asset_config:
+        base = pd.DataFrame(sig, columns=['ID', 'pos_mode', '數量', '開倉價', 'leverage', '強制平倉價', 'SL', 'TP'])
+
+        base['模式'] = base['pos_mode'].replace(_mode_display_map(asset_config))
+        base['槓桿'] = np.where(base['leverage'] > 1.0, base['leverage'].map('{:.1f}x'.format), '現貨')
+        # 多頭 (現貨/融資) +1，空頭 (融券) -1
+        base['direction'] = np.where(base['pos_mode'] == '融券', -1.0, 1.0)
+
+        cache.clear()
+        cache['sig'] = sig
+        cache['asset_config'] = asset_config
+        cache['base'] = base.set_index('ID')
+        cache['price'] = None
+
+    if cache['price'] != price:
+        base = cache['base']
+        df_positions = base[['模式', '槓桿', '數量', '開倉價', '強制平倉價']].copy()
+        # PnL 計算 (多頭: 現價-成本，空頭: 成本-現價)
+        df_positions['未實現損益'] = base['direction'] * base['數量'] * (price - base['開倉價'])
+        df_positions['SL'] = base['SL']
+        df_positions['TP'] = base['TP']
+
+        cache['price'] = price
+        cache['table'] = df_positions
+
+    return cache['table']
@@ -0,0 +1,73 @@
+import sys
+import types
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import data_manager
+import data_store
+from data_store import update_factors, adjust_prices
+
+
+#yf.download(['TEST'], group_by='ticker', auto_adjust=False, actions=True) 的欄位形狀：
+#OHLC 與成交量已經過分割調整 (2:1 分割前的價格已減半、成交量已加倍)，Adj Close 另含除息調整
+def yfinance_frame():
+    dates = pd.DatetimeIndex(pd.date_range('2024-01-01', periods=10, freq='B'), name='Date')
+    close = np.array([100.0, 101.0, 102.0, 101.0, 103.0, 104.0, 105.0, 104.0, 106.0, 107.0])
+    splits = np.zeros(10)
+    splits[4] = 2.0
+    dividends = np.zeros(10)
+    dividends[7] = 1.04
+    # yfinance 的 Adj Close：除息日之前乘上 1 - 股利/除息前一日收盤價
+    adj_close = close * np.where(np.arange(10) < 7, 1.0 - 1.04 / close[6], 1.0)
+    fields = {
+        'Adj Close': adj_close,
+        'Close': close,
+        'Dividends': dividends,
+        'High': close + 1.0,
+        'Low': close - 1.0,
+        'Open': close - 0.5,
+        'Stock Splits': splits,
+        'Volume': np.full(10, 2_000_000.0),
+    }
+    frame = pd.DataFrame(fields, index=dates)
+    frame.columns = pd.MultiIndex.from_product([['TEST'], frame.columns], names=['Ticker', 'Price'])
+    return frame
+
+
+@pytest.fixture
+def store(tmp_path, monkeypatch):
+    monkeypatch.setattr(data_store, 'DATA_STORE_DIR', str(tmp_path))
+    monkeypatch.setattr(data_manager, 'DATA_SOURCE', 'yfinance')
+    frame = yfinance_frame()
+    monkeypatch.setitem(sys.modules, 'yfinance', types.SimpleNamespace(download=lambda *args, **kwargs: frame))
+    return frame
+
+
+def test_split_is_not_applied_twice(store):
+    data = data_manager.download_price_histories(['TEST'])['TEST']
+
+    expected = store['TEST']
+    # 還原收盤價與 yfinance 的 Adj Close 相同，分割前後沒有再被除以 2
+    np.testing.assert_allclose(data['Close'].to_numpy(), expected['Adj Close'].to_numpy())
+    np.testing.assert_allclose(data['Volume'].to_numpy(), expected['Volume'].to_numpy())
+    # 再次讀取走本機數據庫，結果相同
+    np.testing.assert_allclose(data_manager.download_price_histories(['TEST'])['TEST']['Close'].to_numpy(), data['Close'].to_numpy())
+
+
+def test_revised_dividend_replaces_old_amount(store):
+    raw = data_manager._normalize_download(store['TEST'])
+    actions = data_manager._normalize_actions(store['TEST'])
+    factors, changed = update_factors(None, raw, actions)
+    assert changed
+
+    revised = actions.assign(Dividends=np.where(actions['Dividends'] > 0, 0.52, 0.0))
+    factors, changed = update_factors(factors, raw, revised)
+    assert changed
+    assert factors['Dividends'].max() == 0.52
+    np.testing.assert_allclose(adjust_prices(raw, factors)['Close'].iloc[0], 100.0 * (1.0 - 0.52 / 105.0))
+
+    # 同樣的事件再次併入時沒有變動
+    _, changed = update_factors(factors, raw, revised)
+    assert not changed
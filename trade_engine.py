@@ -0,0 +1,1070 @@
+import streamlit as st
+import numpy as np 
+import uuid 
+import weakref
+import functools
+
+import os
+
+from data_manager import (
+    select_random_start_index, 
+    get_price_info_by_index, 
+    VIEW_DAYS,             
+    MIN_SIMULATION_DAYS
+)
+from perf_monitor import profiled
+from analytics import BARS_PER_YEAR
+from intrabar import bar_paths, resolve_triggers, DEFAULT_INTRABAR_MODEL, EVENT_NONE, EVENT_LIQ, EVENT_SL
+from fill_model import DEFAULT_FILL_MODEL, participation_caps, allocate, round_down, fill_prices
+
+#初始化狀態與常數
+DEFAULT_TICKER = "TSLA" 
+INITIAL_CAPITAL = 100000.0
+
+# --- 交易/槓桿常數 (Req 3: 修正手續費率) ---
+FEE_RATE = 0.005
+LEVERAGE_FEE_RATE = 0.01 
+MIN_MARGIN_RATE = 0.05 # 最小保證金比例 5% (全倉模式的維持保證金率，即最大槓桿 20倍)
+
+# --- 保證金模式：逐倉 (每個槓桿倉位各自的強制平倉價，舊版規則) 或全倉 (以帳戶權益對總維持保證金判斷) ---
+MARGIN_MODES = {
+    'isolated': '逐倉 (各倉位獨立強平)',
+    'cross': '全倉 (帳戶維持保證金)',
+}
+DEFAULT_MARGIN_MODE = os.environ.get('KSIM_MARGIN_MODE', 'isolated')
+
+# --- 資產類型與單位映射 ---
+ASSET_CONFIGS = {
+    'Stock': {'unit': '股', 'mode_long': '現貨買', 'mode_short': '現貨空', 'mode_margin_long': '融資多', 'mode_margin_short': '融券空', 'default_qty': 1000.0, 'min_qty': 1.0}, 
+    # Req: 匯率調整為 100 點
+    'Forex': {'unit': '點', 'mode_long': '現貨買', 'mode_short': '現貨空', 'mode_margin_long': '保證金多', 'mode_margin_short': '保證金空', 'default_qty': 100.0, 'min_qty': 100.0}, 
+    'Crypto': {'unit': '顆', 'mode_long': '現貨買', 'mode_short': '現貨空', 'mode_margin_long': '合約多', 'mode_margin_short': '合約空', 'default_qty': 1.0, 'min_qty': 0.001}
+}
+# --- 成交參數 (成交模型為 volume 時使用)：半價差 (bps)、衝擊係數、單根 K 棒最多占成交量的比例 ---
+FILL_CONFIGS = {
+    'Stock': {'half_spread_bps': 2.0, 'impact_coef': 0.5, 'max_participation': 0.10},
+    'Forex': {'half_spread_bps': 0.5, 'impact_coef': 0.2, 'max_participation': 0.20}, # 匯率數據通常沒有成交量，只計價差
+    'Crypto': {'half_spread_bps': 5.0, 'impact_coef': 0.8, 'max_participation': 0.05},
+}
+# --- 槓桿部位的持有成本 (年化，每推進一根 K 棒計提一次；正值為支付、負值為收取) ---
+# long_on_borrowed: 多頭只對借入的資金 (開倉總值 - 保證金) 計息；否則以持倉市值計算 (加密貨幣永續合約的資金費率)
+FINANCING_CONFIGS = {
+    'Stock': {'long_rate': 0.07, 'short_rate': 0.03, 'long_on_borrowed': True, 'label_long': '融資利息', 'label_short': '借券費'},
+    'Forex': {'long_rate': 0.02, 'short_rate': 0.02, 'long_on_borrowed': True, 'label_long': '隔夜利息', 'label_short': '隔夜利息'},
+    'Crypto': {'long_rate': 0.1095, 'short_rate': -0.1095, 'long_on_borrowed': False, 'label_long': '資金費用', 'label_short': '資金費用'}, # 每 8 小時 0.01%，多方支付空方
+}
+# --- 交易模式映射 ---
+TRADE_MODE_MAP = {
+    'Spot_Buy': {'mode_type': 'Spot', 'position_type': '多頭', 'trans_type': '現貨買入開倉', 'pos_mode': '現貨'},
+    'Margin_Long': {'mode_type': 'Margin', 'position_type': '多頭', 'trans_type': '槓桿買入開倉', 'pos_mode': '融資'},
+    'Margin_Short': {'mode_type': 'Margin', 'position_type': '空頭', 'trans_type': '槓桿賣出開倉', 'pos_mode': '融券'},
+}
+
+#Session State 初始化 (每次重跑由 app.py 呼叫)
+def init_session_state():
+    st.session_state.setdefault('ticker', DEFAULT_TICKER)
+    st.session_state.setdefault('asset_type', 'Stock') 
+    st.session_state.setdefault('intrabar_model', DEFAULT_INTRABAR_MODEL) # 同一根 K 棒內停損/停利/強平的觸發順序
+    st.session_state.setdefault('intrabar_seed', 0) # 布朗橋路徑的亂數種子
+    st.session_state.setdefault('fill_model', DEFAULT_FILL_MODEL) # 理想成交 / 成交量限制 + 滑價
+    st.session_state.setdefault('pending_orders', []) # 受成交量限制尚未成交的委託
+    st.session_state.setdefault('volume_used', (None, 0.0)) # (K 棒索引, 該根已用掉的成交量)
+    st.session_state.setdefault('margin_mode', DEFAULT_MARGIN_MODE)
+    st.session_state.setdefault('margin_totals', _empty_margin_totals()) # 全倉模式的帳戶彙總 (開平倉時增量更新)
+    st.session_state.setdefault('state_version', 0) # 模擬狀態版本 (引擎每次改變狀態後遞增)
+    st.session_state.setdefault('initialized', False)
+    st.session_state.setdefault('core_data', None)
+    st.session_state.setdefault('start_view_index', 0)
+    st.session_state.setdefault('current_sim_index', 0)
+    st.session_state.setdefault('max_sim_index', 0)
+    st.session_state.setdefault('sim_active', True)
+    st.session_state.setdefault('end_sim_index_on_settle', None) 
+    st.session_state.setdefault('balance', INITIAL_CAPITAL)
+    st.session_state.setdefault('positions', []) 
+    st.session_state.setdefault('transactions', [])
+    st.session_state.setdefault('start_date', None) 
+    st.session_state.setdefault('scenario_offset', 0)
+    st.session_state.setdefault('equity_curve', []) # 每根 K 棒的總資產 (回測結算報告使用)
+
+#遞增模擬狀態版本：畫面上由模擬狀態衍生的輸出 (指標、圖表、表格) 以版本快取，版本不變的重跑直接沿用
+def bump_state_version():
+    st.session_state.state_version = st.session_state.get('state_version', 0) + 1
+
+#改變模擬狀態的引擎函式 (推進、交易、平倉、重設) 結束後遞增狀態版本 (包含失敗或中途返回)
+def mutates(func):
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        try:
+            return func(*args, **kwargs)
+        finally:
+            bump_state_version()
+    return wrapper
+
+#計算當前總資產(現金+所有倉位的未實現市值/淨值)
+@profiled('get_current_asset_value')
+def get_current_asset_value(core_data, current_idx):
+    if st.session_state.core_data is None or st.session_state.core_data.empty:
+         return st.session_state.balance
+         
+    if st.session_state.sim_active and current_idx < len(core_data):
+        price = core_data['Open'].iloc[current_idx].item() if 'Open' in core_data.columns else 0.0
+    else:
+        # 模擬結束後，使用最後的現金餘額作為總資產
+        return st.session_state.balance
+    
+    # 總部位淨值計算
+    total_position_net_value = 0.0
+    
+    for pos in st.session_state.positions:
+        qty = pos['qty']
+        cost = pos['cost']
+        pos_mode = pos['pos_mode']
+        
+        # 現貨 (Spot): 市值 (Value)
+        if pos_mode == '現貨':
+             # 現貨部位的本金已從 balance 扣除，所以這裡計算市值來加入總資產
+             total_position_net_value += (qty * price)
+             
+        # 融資/融券 (Margin/Leveraged): 原始保證金 + 未實現損益
+        elif pos_mode in ['融資', '融券']:
+             # 原始保證金
+             initial_cost = pos['initial_cost'] 
+             leverage = pos['leverage']
+             margin_required = initial_cost / leverage
+             
+             # 未實現損益 (PnL)
+             if pos_mode == '融資':
+                 unrealized_pnl = (qty * price) - (qty * cost)
+             else: # 融券/合約空
+                 unrealized_pnl = (qty * cost) - (qty * price)
+                 
+             # 淨值 = 保證金 + 未實現損益 - 已計提未支付的持有成本
+             total_position_net_value += (margin_required + unrealized_pnl - pos.get('financing', 0.0))
+            
+    # 總資產 = 可用現金(餘額) + 所有部位的淨值
+    return st.session_state.balance + total_position_net_value
+
+#計算所有倉位的總未實現損益 (包含現貨與槓桿)
+def get_total_unrealized_pnl(price):
+    total_pnl = 0.0
+    for pos in st.session_state.positions:
+        qty = pos['qty']
+        cost = pos['cost']
+        
+        # 多頭 (現貨/融資)
+        if pos['pos_mode'] in ['現貨', '融資']:
+            total_pnl += (qty * price) - (qty * cost)
+        # 空頭 (融券)
+        elif pos['pos_mode'] in ['融券']:
+            total_pnl += (qty * cost) - (qty * price)
+            
+    return total_pnl
+
+# --- 現貨部位彙總 ---
+def get_spot_summary(core_data, current_idx):
+    if not st.session_state.sim_active or core_data is None or current_idx >= len(core_data):
+        return {'qty': 0.0, 'avg_cost': 0.0, 'unrealized_pnl': 0.0}
+
+    price = core_data['Open'].iloc[current_idx].item()
+    
+    spot_positions = [pos for pos in st.session_state.positions if pos['pos_mode'] == '現貨']
+    
+    if not spot_positions:
+        return {'qty': 0.0, 'avg_cost': 0.0, 'unrealized_pnl': 0.0}
+
+    # Aggregate quantities and total cost for average calculation
+    total_qty = sum(pos['qty'] for pos in spot_positions)
+    total_cost = sum(pos['qty'] * pos['cost'] for pos in spot_positions)
+    
+    avg_cost = total_cost / total_qty if total_qty > 0 else 0.0
+    
+    # Calculate unrealized PnL
+    unrealized_pnl = sum((pos['qty'] * price) - (pos['qty'] * pos['cost']) for pos in spot_positions)
+    
+    return {
+        'qty': total_qty, 
+        'avg_cost': avg_cost, 
+        'unrealized_pnl': unrealized_pnl
+    }
+
+#資產歸零或為負時，結束模擬 (結束當下的總資產記入 equity_curve 作為最終淨值)
+def check_and_end_simulation(asset_value):
+    if asset_value <= 0:
+        # 如果已經在結束狀態，就不重複報錯
+        if st.session_state.sim_active: 
+            st.session_state.sim_active = False
+            st.session_state.equity_curve.append(asset_value)
+            st.error("🚨風險控制警告！總資產已歸零或為負，模擬強制結束！")
+        return True
+    return False
+
+# --- 結算所有倉位 ---
+@mutates
+def settle_portfolio(force_end=False):
+    """
+    結算所有持倉部位。
+    如果 force_end=True (提早結算)，則結束模擬並使用收盤價結算。
+    如果 force_end=False (平倉所有倉位按鈕)，則繼續模擬並使用開盤價結算。
+    """
+    if not st.session_state.sim_active and not force_end:
+        return st.warning("模擬已結束。")
+
+    # 1. 決定結算價格
+    current_idx = st.session_state.current_sim_index
+    core_data = st.session_state.core_data
+
+    if core_data is None or core_data.empty:
+        return st.warning("無數據可供結算。")
+
+    if current_idx >= len(core_data):
+        # 處理索引超出範圍的情況 (例如 next_ten_days 跑到最後一天)
+        settle_price = core_data['Close'].iloc[-1].item() if not core_data.empty else 0.0
+    elif force_end:
+        # 提早結算，使用收盤價
+        settle_price = core_data['Close'].iloc[current_idx].item()
+    else:
+        # 手動平倉所有，使用開盤價
+        settle_price = core_data['Open'].iloc[current_idx].item()
+
+    if settle_price <= 0:
+        st.error("結算失敗：無法取得有效的結算價格。")
+        if force_end:
+             st.session_state.sim_active = False # 強制結束
+             st.session_state.end_sim_index_on_settle = current_idx
+        return
+
+    positions_to_close = list(st.session_state.positions) # 複製列表以迭代
+
+    if not positions_to_close:
+        if force_end:
+            st.info("模擬結束，沒有持倉部位需要結算。")
+    else:
+        if force_end:
+            st.info(f"開始結算 {len(positions_to_close)} 個持倉部位 (強制結束)，結算價格: ${settle_price:,.2f}")
+        else:
+             st.info(f"開始平倉 {len(positions_to_close)} 個持倉部位 (繼續模擬)，平倉價格: ${settle_price:,.2f}")
+             
+        for pos in positions_to_close:
+            # 必須檢查 pos 是否仍在 session_state.positions 內，
+            # 避免在迭代過程中被 close_position_lot 移除
+            if pos in st.session_state.positions: 
+                trade_type = '自動結算賣出平倉' if pos['pos_mode'] in ['現貨', '融資'] else '自動結算買回平倉'
+                
+                # close_position_lot 會更新 positions 列表
+                close_position_lot(pos['id'], pos['qty'], settle_price, trade_type, pos['pos_mode'], mode='自動結算')
+
+    # 2. 決定是否結束模擬狀態
+    if force_end:
+        cancel_pending_orders()
+        st.session_state.sim_active = False
+        st.session_state.end_sim_index_on_settle = current_idx
+        
+        final_asset = get_current_asset_value(core_data, current_idx)
+        st.session_state.equity_curve.append(final_asset)
+        
+        # 避免重複顯示 "總資產已歸零" 的錯誤
+        if final_asset > 0:
+            st.success(f"所有部位結算完成！最終總資產: ${final_asset:,.2f}")
+    
+#重新開始回測前初始化
+@mutates
+def reset_state():
+    st.session_state.initialized = False
+    st.session_state.core_data = None
+    st.session_state.start_view_index = 0
+    st.session_state.current_sim_index = 0
+    st.session_state.max_sim_index = 0
+    st.session_state.sim_active = True
+    st.session_state.balance = INITIAL_CAPITAL
+    st.session_state.transactions = []
+    st.session_state.start_date = None
+    st.session_state.scenario_offset = 0
+    st.session_state.equity_curve = []
+    st.session_state.end_sim_index_on_settle = None 
+    st.session_state.positions = []
+    st.session_state.pending_orders = []
+    st.session_state.volume_used = (None, 0.0)
+    st.session_state.margin_totals = _empty_margin_totals()
+    st.session_state.plot_layout = None # 重置圖表布局狀態
+    st.session_state.chart_cache = {} # 清除快取的圖表
+    st.session_state.chart_stream = {} # 輕量 K 線元件的傳送狀態 (前端會收到完整歷史)
+    st.session_state.tx_table_cache = {}
+    st.session_state.positions_table_cache = {}
+    st.session_state.render_cache = {}
+    st.session_state.settle_report = {}
+    st.session_state.result_saved = False
+    st.session_state.room_code = None
+
+#以已載入的數據 (含指標) 建立回測，data 為 None 表示載入失敗
+def start_with_data(data, asset_type):
+    if data is None: 
+        st.error(f"無法載入 {st.session_state.ticker} 的數據，請確認代碼是否正確。")
+        return
+        
+    st.session_state.core_data = data
+    
+    total_days = len(data)
+    required_days = VIEW_DAYS + MIN_SIMULATION_DAYS
+    
+    if total_days < required_days:
+        st.warning(f"注意：{st.session_state.ticker} 有效數據 ({total_days} 天) 少於回測所需最低天數 ({required_days} 天)。回測將從最早數據開始，且長度不足 720 根。")
+            
+    st.success(f"{st.session_state.ticker} 數據載入成功！共 {total_days} 筆有效數據。")
+
+    start_indices = select_random_start_index(st.session_state.core_data)
+    if start_indices is not None:
+        start_view_idx, _ = start_indices
+        start_scenario(data, start_view_idx, asset_type)
+
+        unit = ASSET_CONFIGS[asset_type]['unit']
+        st.success(f"回測已初始化！**{st.session_state.ticker}** 的日線模擬 ({unit}為單位)。")
+        st.info(f"💡 規則依據您選擇的 **{asset_type}** 類型執行。")
+
+#以完整數據與起始索引建立回測視窗 (VIEW_DAYS 歷史 + MIN_SIMULATION_DAYS 模擬)
+def start_scenario(data, start_view_idx, asset_type):
+    required_days = VIEW_DAYS + MIN_SIMULATION_DAYS
+    data_end_idx = start_view_idx + required_days
+    truncated_data = data.iloc[start_view_idx:data_end_idx].reset_index(drop=True)
+
+    start_window(truncated_data, start_view_idx, asset_type)
+
+#以已截取好的回測視窗開始 (對戰房間中多位玩家共用同一份視窗，不會修改 window)
+@mutates
+def start_window(window, offset, asset_type):
+    st.session_state.core_data = window
+    st.session_state.scenario_offset = offset # 回測視窗在完整數據中的起點
+    
+    st.session_state.start_view_index = 0
+    st.session_state.current_sim_index = VIEW_DAYS
+    st.session_state.max_sim_index = len(window) - 1
+    
+    st.session_state.initialized = True
+    st.session_state.sim_active = True
+    st.session_state.asset_type = asset_type
+    st.session_state.equity_curve = [st.session_state.balance] # 起始 K 棒的總資產
+    
+    date_ts = st.session_state.core_data['Date'].iloc[st.session_state.current_sim_index]
+    st.session_state.start_date = date_ts.to_pydatetime()
+
+
+#平倉記錄 
+@mutates
+def close_position_lot(pos_id: str, settle_qty: float, settle_price: float, trade_type: str, pos_mode: str, mode: str = '自動'):
+    pos_index = next((i for i, pos in enumerate(st.session_state.positions) if pos['id'] == pos_id), -1)
+    
+    if pos_index == -1: 
+        return False
+    
+    pos = st.session_state.positions[pos_index]
+    
+    # 數量檢查 (現在所有 qty 都是 float，直接比較)
+    if settle_qty <= 0 or settle_qty > pos['qty']: 
+        min_qty = ASSET_CONFIGS[st.session_state.asset_type]['min_qty']
+        st.error(f"平倉失敗：平倉股數 {settle_qty:,.3f} 無效或超過持有股數 {pos['qty']:,.3f}。")
+        return False
+
+    current_datetime, _, _ = get_price_info_by_index(st.session_state.core_data, st.session_state.current_sim_index)
+    
+    # 成交量模型下平倉同樣支付價差與衝擊成本 (平多 = 賣出，平空 = 買回)
+    settle_price = slipped_price(settle_price, -1.0 if pos_mode in ['現貨', '融資'] else 1.0, settle_qty)
+    # 逐倉強制平倉一律以強平價成交：覆蓋盤中模型的跳空開盤價成交，也不支付成交量模型的滑價
+    # (越過強平價的損失不由帳戶承擔，倉位最多損失保證金；全倉強平沒有個別強平價，不受影響)
+    liq = pos.get('liquidation_price', 0.0)
+    if trade_type.startswith('強制平倉') and liq > 0:
+        settle_price = max(settle_price, liq) if pos_mode == '融資' else min(settle_price, liq)
+    
+    # --- 1. 計算手續費並扣除 (依照模式區分手續費率) ---
+    is_leverage = pos_mode in ['融資', '融券']
+    fee_rate_used = LEVERAGE_FEE_RATE if is_leverage else FEE_RATE
+    
+    close_amount = settle_qty * settle_price
+    close_fee = close_amount * fee_rate_used
+    
+    # 2. 扣除平倉手續費
+    st.session_state.balance -= close_fee
+    
+    # 3. 處理平倉邏輯
+    is_fully_closed = (settle_qty == pos['qty'])
+    
+    # 計算應歸還的保證金比例
+    original_qty = pos['qty']
+    original_initial_cost = pos['initial_cost'] 
+    leverage = pos.get('leverage', 1.0)
+    original_margin = original_initial_cost / leverage 
+    
+    # 按比例歸還保證金或現貨成本
+    if pos_mode == '現貨':
+        return_margin_or_cost = settle_qty * settle_price # 現貨是直接回流資金 (成本+損益)
+        realized_pnl = settle_qty * (settle_price - pos['cost'])
+    
+    # 槓桿部位 (融資/融券)
+    elif pos_mode in ['融資', '融券']: 
+        
+        is_long = (pos_mode == '融資')
+        
+        # PnL 計算
+        if is_long:
+            realized_pnl = settle_qty * (settle_price - pos['cost'])
+        else: # 融券/合約空
+            realized_pnl = settle_qty * (pos['cost'] - settle_price)
+            
+        # 歸還的保證金 (只有槓桿部位需要)
+        return_margin_or_cost = original_margin * (settle_qty / original_qty)
+    
+    else:
+        return False
+
+    # 4. 將 PnL + 歸還的保證金/現貨成本 存入現金
+    if pos_mode == '現貨':
+        # 現貨: 現金回流 = 平倉總額 (包含損益)
+        st.session_state.balance += return_margin_or_cost
+    else:
+        # 槓桿: 現金回流 = 歸還的保證金 + 實現損益
+        st.session_state.balance += (return_margin_or_cost + realized_pnl)
+    
+    # 4-1. 支付平倉部分已計提的持有成本 (整段持有期間合併為一筆紀錄)
+    financing = pos.get('financing', 0.0) * (settle_qty / original_qty)
+    if financing != 0.0:
+        st.session_state.balance -= financing
+        st.session_state.margin_totals['const'] += financing # 由倉位淨值轉為現金，帳戶權益不變
+        pos['financing'] = pos['financing'] - financing
+        financing_config = FINANCING_CONFIGS[st.session_state.asset_type]
+        st.session_state.transactions.append({
+            '日期': current_datetime,
+            '模式': pos_mode,
+            '類型': financing_config['label_long'] if pos_mode == '融資' else financing_config['label_short'],
+            '股數': 0.0,
+            '價格': np.nan,
+            '金額': -financing,
+            '損益': np.nan,
+            '開倉總值': 0.0,
+            '手續費': 0.0,
+            'leverage': leverage,
+            'pos_id': pos_id,
+            'bar': st.session_state.current_sim_index,
+            '財務成本': financing
+        })
+    
+    # 5. 記錄交易紀錄
+    transactions_entry = {
+        '模式': pos_mode, 
+        '類型': trade_type, 
+        '股數': -settle_qty, # 平倉股數永遠是負的
+        '價格': settle_price, 
+        '金額': return_margin_or_cost, 
+        '損益': realized_pnl,
+        '開倉總值': settle_qty * pos['cost'], 
+        '手續費': close_fee,
+        '日期': current_datetime,
+        'leverage': leverage,
+        'pos_id': pos_id,
+        'bar': st.session_state.current_sim_index
+    }
+    st.session_state.transactions.append(transactions_entry)
+    
+    # 6. 更新倉位或移除
+    _update_margin_totals(pos, -1.0)
+    if is_fully_closed:
+        st.session_state.positions.pop(pos_index)
+        if not st.session_state.positions:
+            st.session_state.margin_totals = _empty_margin_totals() # 全部平倉後歸零，避免浮點誤差累積
+        st.info(f"倉位 ID {pos_id[-4:]} 已完全平倉 ({trade_type}) (實現損益: ${realized_pnl:,.2f})。")
+    else: 
+        new_qty = pos['qty'] - settle_qty
+        
+        # 按比例調整 pos 的 'initial_cost'，以計算剩餘部位的保證金
+        pos['initial_cost'] = pos['initial_cost'] * (new_qty / pos['qty'])
+        st.session_state.positions[pos_index]['qty'] = new_qty
+        _update_margin_totals(pos, 1.0)
+        
+        st.info(f"倉位 ID {pos_id[-4:]} 已部分平倉 {settle_qty:,.3f} {ASSET_CONFIGS[st.session_state.asset_type]['unit']} (剩餘 {new_qty:,.3f} {ASSET_CONFIGS[st.session_state.asset_type]['unit']})。")
+
+    # 7. 平倉後檢查風控
+    total_asset_new = get_current_asset_value(st.session_state.core_data, st.session_state.current_sim_index)
+    check_and_end_simulation(total_asset_new)
+    
+    return True
+    
+#回測視窗的 OHLCV 陣列 (以 DataFrame 本身為鍵快取，對戰房間的玩家共用同一份)，推進時只需取一列，不經過 pandas 索引
+_BAR_ARRAYS = {}
+BAR_CACHE_SIZE = 64
+
+def _bar_entry(core_data):
+    entry = _BAR_ARRAYS.get(id(core_data))
+    if entry is None or entry['ref']() is not core_data:
+        if len(_BAR_ARRAYS) >= BAR_CACHE_SIZE:
+            _BAR_ARRAYS.pop(next(iter(_BAR_ARRAYS)), None)
+        bars = core_data[['Open', 'High', 'Low', 'Close', 'Volume']].to_numpy(dtype=float)
+        entry = {
+            'ref': weakref.ref(core_data),
+            'bars': bars,
+            'open_prefix': np.concatenate([[0.0], np.cumsum(bars[:, 0])]), # 開盤價前綴和 (區間加總 O(1))
+            'open_returns': np.concatenate([[np.nan], bars[1:, 0] / bars[:-1, 0] - 1.0]), # 開盤價對開盤價的單根報酬
+        }
+        _BAR_ARRAYS[id(core_data)] = entry
+    return entry
+
+def _bar_arrays(core_data):
+    return _bar_entry(core_data)['bars']
+
+#開盤價的單根報酬 (第 i 根 = Open[i] / Open[i-1] - 1)，風險計算取其中的視窗切片，不必每根 K 棒重算
+def open_returns(core_data):
+    return _bar_entry(core_data)['open_returns']
+
+#槓桿倉位每根 K 棒的持有成本係數：區間 (start_idx, end_idx] 的成本 = per_bar·K 棒數 + per_open·區間開盤價加總
+def _financing_rates(lots):
+    asset_type = st.session_state.asset_type
+    config = FINANCING_CONFIGS[asset_type]
+    is_long = np.array([pos['pos_mode'] == '融資' for pos in lots])
+    qty = np.array([pos['qty'] for pos in lots])
+    initial_cost = np.array([pos['initial_cost'] for pos in lots])
+    leverage = np.array([pos['leverage'] for pos in lots])
+
+    rate = np.where(is_long, config['long_rate'], config['short_rate']) / BARS_PER_YEAR.get(asset_type, 252)
+    borrowed = initial_cost * (1.0 - 1.0 / leverage)
+    on_borrowed = is_long & config['long_on_borrowed']
+    return np.where(on_borrowed, rate * borrowed, 0.0), np.where(on_borrowed, 0.0, rate * qty)
+
+#計提槓桿倉位在 K 棒區間 (start_idx, end_idx] 的持有成本 (所有槓桿倉位一次向量化計算)
+#以開盤價前綴和得到區間加總的閉式解，快轉多根 K 棒時一次呼叫即可，成本累積在倉位上，平倉時才合併記入交易紀錄
+def accrue_financing(start_idx, end_idx):
+    lots = [pos for pos in st.session_state.positions if pos['pos_mode'] in ['融資', '融券']]
+    if not lots or end_idx <= start_idx: return
+
+    open_prefix = _bar_entry(st.session_state.core_data)['open_prefix']
+    open_sum = open_prefix[end_idx + 1] - open_prefix[start_idx + 1]
+    per_bar, per_open = _financing_rates(lots)
+    charges = per_bar * (end_idx - start_idx) + per_open * open_sum
+    for pos, charge in zip(lots, charges):
+        pos['financing'] = pos.get('financing', 0.0) + float(charge)
+        if pos.get('liquidation_price', 0.0) > 0:
+            pos['liquidation_price'] = isolated_liquidation_price(pos)
+    st.session_state.margin_totals['const'] -= float(charges.sum())
+
+#逐倉強制平倉價：倉位淨值 = 保證金 + 方向·數量·(p - 成本) - 已計提持有成本 = 0 的價格
+#沒有持有成本時即為 成本·(1 ∓ 1/槓桿)；持有成本累積後強平價向目前價格靠近 (financing 可由呼叫端指定，供快轉預先計算)
+def isolated_liquidation_price(pos, financing=None):
+    side = 1.0 if pos['pos_mode'] == '融資' else -1.0
+    financing = pos.get('financing', 0.0) if financing is None else financing
+    return pos['cost'] - side * (pos['initial_cost'] / pos['leverage'] - financing) / pos['qty']
+
+#全倉模式的帳戶彙總 (開平倉、加碼、計提持有成本時增量更新，每根 K 棒的檢查只需 O(1))
+#帳戶權益 E(p) = 現金 + const + slope·p，維持保證金 M(p) = MIN_MARGIN_RATE·gross·p
+#const = Σ 槓桿倉位 (保證金 - 方向·數量·成本 - 已計提持有成本)、slope = 現貨數量 + Σ 方向·槓桿數量、gross = Σ 槓桿數量
+#spot = 現貨數量 (風險面板的總曝險 = (spot + gross)·p、淨曝險 = slope·p)
+def _empty_margin_totals():
+    return {'const': 0.0, 'slope': 0.0, 'gross': 0.0, 'spot': 0.0}
+
+#把倉位目前的數量/成本加入 (sign=1) 或移出 (sign=-1) 帳戶彙總，修改倉位前後各呼叫一次
+def _update_margin_totals(pos, sign):
+    totals = st.session_state.margin_totals
+    if pos['pos_mode'] == '現貨':
+        totals['slope'] += sign * pos['qty']
+        totals['spot'] += sign * pos['qty']
+        return
+    side = 1.0 if pos['pos_mode'] == '融資' else -1.0
+    totals['const'] += sign * (pos['initial_cost'] / pos['leverage'] - side * pos['qty'] * pos['cost'])
+    totals['slope'] += sign * side * pos['qty']
+    totals['gross'] += sign * pos['qty']
+
+#全倉維持保證金 (以價格 price 計算)
+def maintenance_margin(price):
+    return MIN_MARGIN_RATE * st.session_state.margin_totals['gross'] * price
+
+#帳戶強制平倉價的閉式解：E(p) = M(p) → p* = -(現金 + const) / (slope - MIN_MARGIN_RATE·gross)
+#回傳 (價位, 方向)：方向 +1 為淨多，價格 <= p* 時觸發；-1 為淨空，價格 >= p* 時觸發；不會觸發時回傳 None
+def account_liquidation_price():
+    totals = st.session_state.margin_totals
+    if totals['gross'] <= 0: return None
+
+    equity_const = st.session_state.balance + totals['const']
+    k = totals['slope'] - MIN_MARGIN_RATE * totals['gross']
+    if k > 0:
+        return (-equity_const / k, 1.0) if equity_const < 0 else None
+    if k < 0:
+        return (equity_const / -k, -1.0) # p* <= 0 表示任何價格都已低於維持保證金
+    return (np.inf, 1.0) if equity_const < 0 else None
+
+#檢查所有獨立倉位的止損/止盈/強制平倉觸發
+#同一根 K 棒內先觸發哪個價位由 st.session_state.intrabar_model 決定 (所有倉位共用同一條盤中路徑，一次向量化計算)
+@profiled('check_sl_tp_trigger')
+def check_sl_tp_trigger(core_data, current_idx):
+    if not st.session_state.sim_active: return
+    if current_idx >= len(core_data): return
+
+    positions = [pos for pos in st.session_state.positions if pos['qty'] > 0]
+    if not positions: return
+
+    model = st.session_state.intrabar_model
+    bar = _bar_arrays(core_data)[current_idx, :4]
+    # 隨機路徑以 (種子, 在完整數據中的 K 棒位置) 決定，重播同一情境會得到相同結果
+    rng = np.random.default_rng([st.session_state.intrabar_seed, st.session_state.scenario_offset + current_idx]) if model == 'bridge' else None
+    path = bar_paths(model, *([x] for x in bar), rng=rng)[0]
+
+    side = [1.0 if pos['pos_mode'] in ['現貨', '融資'] else -1.0 for pos in positions]
+    liq = [pos.get('liquidation_price', 0.0) if pos['pos_mode'] in ['融資', '融券'] else 0.0 for pos in positions]
+    events, prices = resolve_triggers(
+        model, np.broadcast_to(path, (len(positions), len(path))), side,
+        liq, [pos['sl'] for pos in positions], [pos['tp'] for pos in positions]
+    )
+
+    positions_to_close_info = [] 
+    
+    for pos, event, settle_price in zip(positions, events, prices):
+        if event == EVENT_NONE or settle_price <= 0:
+            continue
+        is_long = pos['pos_mode'] in ['現貨', '融資']
+
+        if event == EVENT_LIQ:
+            close_type = '強制平倉多頭' if is_long else '強制平倉空頭'
+        else:
+            close_type = 'SL/TP 賣出平倉' if is_long else 'SL/TP 買回平倉'
+            if event == EVENT_SL and is_long:
+                st.warning(f"🛑 倉位 {pos['id'][-4:]} **多頭停損觸發** 於 ${settle_price:,.2f}！")
+            elif event == EVENT_SL:
+                st.error(f"❌ 倉位 {pos['id'][-4:]} **空頭停損觸發** 於 ${settle_price:,.2f}！")
+            else:
+                st.success(f"✅ 倉位 {pos['id'][-4:]} **{'多頭' if is_long else '空頭'}停利觸發** 於 ${settle_price:,.2f}！")
+
+        positions_to_close_info.append({
+            'id': pos['id'], 
+            'qty': pos['qty'], 
+            'price': float(settle_price),
+            'type': close_type,
+            'pos_mode': pos['pos_mode']
+        })
+
+    #處理所有觸發的平倉
+    for close_info in positions_to_close_info:
+        close_position_lot(close_info['id'], close_info['qty'], close_info['price'], close_info['type'], close_info['pos_mode'], mode='自動')
+
+#全倉模式：本根 K 棒的價格範圍觸及帳戶強制平倉價時追繳保證金，依序強制平倉槓桿倉位
+#以強平價計算虧損最大的倉位優先平倉，每平一個倉位就重新計算帳戶強平價，直到本根 K 棒不再觸及 (開盤即越過時以開盤價成交)
+@profiled('check_margin_call')
+def check_margin_call(core_data, current_idx):
+    if current_idx >= len(core_data): return
+
+    o, h, l = _bar_arrays(core_data)[current_idx, :3]
+    while st.session_state.sim_active:
+        liq = account_liquidation_price()
+        if liq is None: return
+        level, direction = liq
+        if (l > level) if direction > 0 else (h < level): return
+
+        lots = [pos for pos in st.session_state.positions if pos['pos_mode'] in ['融資', '融券']]
+        if not lots: return
+        price = float(min(o, level) if direction > 0 else max(o, level))
+        pnl = [(1.0 if pos['pos_mode'] == '融資' else -1.0) * pos['qty'] * (price - pos['cost']) for pos in lots]
+        pos = lots[int(np.argmin(pnl))]
+        is_long = pos['pos_mode'] == '融資'
+
+        st.error(f"🚨 全倉保證金不足 (帳戶強平價 ${level:,.2f})：倉位 {pos['id'][-4:]} 於 ${price:,.2f} 強制平倉！")
+        close_position_lot(pos['id'], pos['qty'], price, '強制平倉多頭 (全倉)' if is_long else '強制平倉空頭 (全倉)', pos['pos_mode'], mode='自動')
+
+#快轉：沒有停損/停利與未成交委託時，以閉式解一次找出下一根可能觸發強制平倉 (或總資產歸零) 的 K 棒
+#之前的 K 棒一次計提持有成本並寫入權益曲線，回傳略過的 K 棒數 (觸發的那根仍交給逐根推進處理)
+def _fast_forward(max_bars):
+    positions = st.session_state.positions
+    if st.session_state.pending_orders or any(pos['sl'] > 0 or pos['tp'] > 0 for pos in positions): return 0
+
+    start = st.session_state.current_sim_index
+    end = min(start + max_bars, st.session_state.max_sim_index)
+    if end <= start: return 0
+
+    entry = _bar_entry(st.session_state.core_data)
+    o, h, l = entry['bars'][start + 1:end + 1, :3].T
+    totals = st.session_state.margin_totals
+
+    # 每根 K 棒結束時累計的持有成本 (與 accrue_financing 相同的閉式解)
+    lots = [pos for pos in positions if pos['pos_mode'] in ['融資', '融券']]
+    equity_const = np.full(len(o), st.session_state.balance + totals['const'])
+    accrued = np.zeros((len(lots), len(o))) # 各倉位在每根 K 棒新增的累計持有成本
+    if lots:
+        per_bar, per_open = _financing_rates(lots)
+        open_sums = entry['open_prefix'][start + 2:end + 2] - entry['open_prefix'][start + 1]
+        accrued = per_bar[:, None] * np.arange(1, len(o) + 1) + per_open[:, None] * open_sums
+        equity_const -= accrued.sum(axis=0)
+    equity = equity_const + totals['slope'] * o
+    hit = equity <= 0
+
+    if st.session_state.margin_mode == 'cross' and totals['gross'] > 0:
+        # E(p) <= M(p) 在 K 棒範圍內的最不利價格 (淨多看最低價、淨空看最高價) 成立
+        k = totals['slope'] - MIN_MARGIN_RATE * totals['gross']
+        hit |= equity_const + k * (l if k > 0 else h) <= 0
+    for pos, pos_accrued in zip(lots, accrued):
+        if pos.get('liquidation_price', 0.0) > 0:
+            # 逐倉強平價隨持有成本累積逐根移動
+            liq = isolated_liquidation_price(pos, pos.get('financing', 0.0) + pos_accrued)
+            hit |= (l <= liq) if pos['pos_mode'] == '融資' else (h >= liq)
+
+    skip = int(hit.argmax()) if hit.any() else len(o)
+    if skip == 0: return 0
+    accrue_financing(start, start + skip)
+    st.session_state.current_sim_index = start + skip
+    st.session_state.equity_curve.extend(equity[:skip].tolist())
+    return skip
+
+#執行單一交易日的模擬推進邏輯
+def _advance_one_day():
+    if not st.session_state.sim_active: return False
+
+    if st.session_state.current_sim_index < st.session_state.max_sim_index:
+        st.session_state.current_sim_index += 1
+
+        # 持有過夜的槓桿倉位計提一根 K 棒的持有成本
+        accrue_financing(st.session_state.current_sim_index - 1, st.session_state.current_sim_index)
+
+        # 未成交的委託在新 K 棒開盤繼續成交
+        _fill_pending_orders()
+
+        #檢查SL/TP/Liq觸發
+        check_sl_tp_trigger(st.session_state.core_data, st.session_state.current_sim_index)
+        if st.session_state.margin_mode == 'cross':
+            check_margin_call(st.session_state.core_data, st.session_state.current_sim_index)
+        
+        # 檢查風控
+        total_asset_new = get_current_asset_value(st.session_state.core_data, st.session_state.current_sim_index)
+        if check_and_end_simulation(total_asset_new):
+            return False
+        st.session_state.equity_curve.append(total_asset_new)
+        return True
+    else:
+        # 如果是最後一天，且沒有手動結束，則自動結算
+        settle_portfolio(force_end=True)
+        return False
+
+#模擬進入下一天
+@mutates
+def next_day():
+    if not st.session_state.sim_active: 
+        return st.warning("模擬已結束。")
+    
+    total_asset = get_current_asset_value(st.session_state.core_data, st.session_state.current_sim_index)
+    if check_and_end_simulation(total_asset): 
+        return
+    
+    _advance_one_day()
+
+#模擬進入下十天
+@mutates
+def next_ten_days():
+    if not st.session_state.sim_active: 
+        return st.warning("模擬已結束。")
+    
+    total_asset = get_current_asset_value(st.session_state.core_data, st.session_state.current_sim_index)
+    if check_and_end_simulation(total_asset): 
+        return
+
+    days_to_advance = min(10, st.session_state.max_sim_index - st.session_state.current_sim_index)
+    
+    if days_to_advance <= 0:
+        settle_portfolio(force_end=True)
+        st.warning("回測結束：已到達最大模擬日數，已自動平倉。")
+        return
+
+    skipped = _fast_forward(days_to_advance)
+    for _ in range(days_to_advance - skipped):
+        if not _advance_one_day():
+            break
+
+    if st.session_state.sim_active and st.session_state.current_sim_index >= st.session_state.max_sim_index:
+        settle_portfolio(force_end=True)
+        actual_sim_days = MIN_SIMULATION_DAYS 
+        st.warning(f"回測結束：已到達最大模擬日數 (共 {actual_sim_days} 根 K 棒)，已自動平倉。")
+
+#買入、賣出、做空功能 
+@mutates
+def execute_trade(trade_mode_key, quantity, price, leverage=1.0, sl=0.0, tp=0.0):
+    if not st.session_state.sim_active:
+        st.error("模擬已結束，無法執行交易。")
+        return _trade_result('rejected')
+    if quantity <= 0: 
+        min_qty = ASSET_CONFIGS[st.session_state.asset_type]['min_qty']
+        st.error(f"交易數量必須大於或等於最小數量 {min_qty:,.3f}。")
+        return _trade_result('rejected')
+    if price <= 0:
+        st.error("價格必須大於0")
+        return _trade_result('rejected')
+
+    config = TRADE_MODE_MAP.get(trade_mode_key)
+    if not config:
+        st.error("無效的交易模式。")
+        return _trade_result('rejected')
+    
+    pos_mode_label = config['pos_mode']
+    
+    # 判斷是否為槓桿交易
+    is_leverage = trade_mode_key in ['Margin_Long', 'Margin_Short']
+    
+    # --- 1. 槓桿交易單向單倉位檢查 (尚未成交的委託也算) ---
+    if is_leverage:
+        # 檢查是否有同方向的槓桿倉位存在
+        existing_leverage_pos = [p for p in st.session_state.positions if p['pos_mode'] == pos_mode_label]
+        if existing_leverage_pos:
+            st.error(f"🚨 槓桿交易限制：您已持有一個 {pos_mode_label} 的倉位 (ID: {existing_leverage_pos[0]['id'][-4:]})，請先平倉後再開新倉。")
+            return _trade_result('rejected')
+        if any(o['trade_mode'] == trade_mode_key for o in st.session_state.pending_orders):
+            st.error(f"🚨 槓桿交易限制：您已有一筆 {pos_mode_label} 的委託尚未完全成交。")
+            return _trade_result('rejected')
+
+    if st.session_state.fill_model != 'volume':
+        pos = _open_position(trade_mode_key, quantity, price, leverage, sl, tp)
+        return _trade_result('filled', pos['id']) if pos is not None else _trade_result('rejected')
+
+    # --- 成交量限制：本根 K 棒只成交上限內的數量 (含滑價)，其餘轉為委託在之後的 K 棒開盤繼續成交 ---
+    # SL/TP 記在委託上，每次成交建立或加碼倉位時套用
+    order = {'id': str(uuid.uuid4())[:8], 'trade_mode': trade_mode_key, 'qty': quantity, 'remaining': quantity,
+             'leverage': leverage, 'sl': float(sl), 'tp': float(tp), 'pos_id': None, 'failed': False,
+             'placed_bar': st.session_state.current_sim_index}
+    st.session_state.pending_orders.append(order)
+    _fill_pending_orders([order])
+    if order['failed'] and order['pos_id'] is None:
+        st.session_state.pending_orders = [o for o in st.session_state.pending_orders if o is not order]
+        return _trade_result('rejected', order_id=order['id'])
+    if order['remaining'] > 0:
+        st.info(f"⏳ 受成交量限制，委託 {order['id'][-4:]} 尚有 {order['remaining']:,.3f} {ASSET_CONFIGS[st.session_state.asset_type]['unit']} 未成交，將於之後的 K 棒開盤繼續成交。")
+        return _trade_result('pending', order['pos_id'], order['id'])
+    return _trade_result('filled', order['pos_id'], order['id'])
+
+#交易結果：status 為 'filled' (已成交)、'pending' (部分或全部轉為委託，之後的 K 棒繼續成交) 或 'rejected' (被交易規則拒絕，沒有建立倉位)
+#pos_id 為成交建立的倉位 (尚未成交時為 None)，order_id 為成交量模型下的委託
+def _trade_result(status, pos_id=None, order_id=None):
+    return {'status': status, 'pos_id': pos_id, 'order_id': order_id}
+
+#本根 K 棒的成交量上限扣除已使用部分 (平倉不受限制，但開倉委託彼此共用上限)
+def volume_left(current_idx):
+    volume = _bar_arrays(st.session_state.core_data)[current_idx, 4]
+    cap = participation_caps(volume, FILL_CONFIGS[st.session_state.asset_type]['max_participation'])
+    used_bar, used = st.session_state.volume_used
+    return float(cap) - (used if used_bar == current_idx else 0.0)
+
+#含價差與衝擊成本的成交價 (side: +1 買 / -1 賣)；理想成交模型直接回傳原價
+def slipped_price(price, side, qty):
+    if st.session_state.fill_model != 'volume':
+        return price
+    o, h, l, _, volume = _bar_arrays(st.session_state.core_data)[st.session_state.current_sim_index]
+    return float(fill_prices(price, side, qty, volume, (h - l) / o if o > 0 else 0.0, FILL_CONFIGS[st.session_state.asset_type]))
+
+#以目前 K 棒開盤價成交委託 (依委託先後分配成交量上限，一次計算所有委託)
+#orders 未指定時處理所有未成交委託 (每根 K 棒推進後呼叫)
+def _fill_pending_orders(orders=None):
+    orders = st.session_state.pending_orders if orders is None else orders
+    if not orders or not st.session_state.sim_active: return
+
+    current_idx = st.session_state.current_sim_index
+    o, h, l, _, volume = _bar_arrays(st.session_state.core_data)[current_idx]
+    fill_config = FILL_CONFIGS[st.session_state.asset_type]
+    min_qty = ASSET_CONFIGS[st.session_state.asset_type]['min_qty']
+
+    fills = round_down(allocate([order['remaining'] for order in orders], max(0.0, volume_left(current_idx))), min_qty)
+    sides = [1.0 if order['trade_mode'] in ['Spot_Buy', 'Margin_Long'] else -1.0 for order in orders]
+    prices = fill_prices(o, sides, fills, volume, (h - l) / o if o > 0 else 0.0, fill_config)
+
+    used_bar, used = st.session_state.volume_used
+    st.session_state.volume_used = (current_idx, (used if used_bar == current_idx else 0.0) + float(fills.sum()))
+
+    for order, qty, price in zip(orders, fills, prices):
+        if qty <= 0: continue
+        sl, tp = order.get('sl', 0.0), order.get('tp', 0.0)
+        if order['pos_id'] is None:
+            pos = _open_position(order['trade_mode'], float(qty), float(price), order['leverage'], sl, tp)
+            if pos is not None:
+                order['pos_id'] = pos['id']
+        else:
+            pos = next((p for p in st.session_state.positions if p['id'] == order['pos_id']), None)
+            # 倉位已被平倉時剩餘委託取消
+            pos = _add_to_position(pos, float(qty), float(price), sl, tp) if pos is not None else None
+        if pos is None:
+            # 成交失敗 (餘額不足、模擬已結束或倉位已平倉)：剩餘委託取消
+            order['failed'] = True
+            order['remaining'] = 0.0
+            continue
+        order['remaining'] = order['remaining'] - float(qty)
+        if order['remaining'] < min_qty:
+            order['remaining'] = 0.0
+
+    st.session_state.pending_orders = [order for order in st.session_state.pending_orders if order['remaining'] > 0]
+
+#取消所有未成交委託
+@mutates
+def cancel_pending_orders():
+    st.session_state.pending_orders = []
+
+#委託的後續成交加入同一個倉位 (成本取加權平均，保證金與強制平倉價依新均價重新計算)
+#委託帶有 SL/TP (非 0) 時一併套用；成功回傳倉位，失敗回傳 None
+def _add_to_position(pos, quantity, price, sl=0.0, tp=0.0):
+    trade_mode_key = next(k for k, v in TRADE_MODE_MAP.items() if v['pos_mode'] == pos['pos_mode'])
+    is_leverage = pos['pos_mode'] in ['融資', '融券']
+    cost_amount = quantity * price
+    margin_required = cost_amount / pos['leverage']
+    fee = cost_amount * (LEVERAGE_FEE_RATE if is_leverage else FEE_RATE)
+
+    if st.session_state.balance < margin_required + fee:
+        st.error(f"[{pos['pos_mode']}] 委託後續成交失敗：現金餘額不足，剩餘委託已取消。")
+        return None
+
+    st.session_state.balance -= (margin_required + fee)
+    _update_margin_totals(pos, -1.0)
+    new_qty = pos['qty'] + quantity
+    pos['cost'] = (pos['qty'] * pos['cost'] + cost_amount) / new_qty
+    pos['qty'] = new_qty
+    pos['initial_cost'] += cost_amount
+    _update_margin_totals(pos, 1.0)
+    if st.session_state.margin_mode != 'cross' and is_leverage: # 全倉模式不設個別強平價
+        pos['liquidation_price'] = isolated_liquidation_price(pos)
+
+    current_datetime, _, _ = get_price_info_by_index(st.session_state.core_data, st.session_state.current_sim_index)
+    st.session_state.transactions.append({
+        '日期': current_datetime,
+        '模式': pos['pos_mode'], 
+        '類型': TRADE_MODE_MAP[trade_mode_key]['trans_type'], 
+        '股數': quantity if trade_mode_key != 'Margin_Short' else -quantity, 
+        '價格': price, 
+        '金額': -margin_required, 
+        '損益': np.nan,
+        '開倉總值': cost_amount, 
+        '手續費': fee,
+        'leverage': pos['leverage'],
+        'pos_id': pos['id'],
+        'bar': st.session_state.current_sim_index
+    })
+    if sl > 0: pos['sl'] = sl
+    if tp > 0: pos['tp'] = tp
+    return pos
+
+#開立新倉位 (扣除手續費與保證金、記錄交易)，成功回傳新倉位，失敗 (餘額不足或手續費使模擬結束) 回傳 None
+def _open_position(trade_mode_key, quantity, price, leverage, sl=0.0, tp=0.0):
+    config = TRADE_MODE_MAP[trade_mode_key]
+    pos_mode_label = config['pos_mode']
+    trans_type_label = config['trans_type']
+    
+    cost_amount = quantity * price
+    is_leverage = trade_mode_key in ['Margin_Long', 'Margin_Short']
+
+    # --- 2. 計算手續費並扣除 (依照模式區分手續費率) ---
+    fee_rate_used = LEVERAGE_FEE_RATE if is_leverage else FEE_RATE
+    fee = cost_amount * fee_rate_used
+    
+    st.session_state.balance -= fee
+    
+    if check_and_end_simulation(get_current_asset_value(st.session_state.core_data, st.session_state.current_sim_index)):
+        return None
+
+    current_datetime, _, _ = get_price_info_by_index(st.session_state.core_data, st.session_state.current_sim_index)
+    
+    
+    # 現貨買入 & 槓桿買入 (多頭部位，資金流出)
+    if trade_mode_key in ['Spot_Buy', 'Margin_Long']:
+        
+        if trade_mode_key == 'Spot_Buy':
+            leverage = 1.0
+            margin_required = cost_amount 
+            liquidation_price = 0.0 
+        else: # Margin_Long
+            margin_required = cost_amount / leverage
+            
+            # 強制平倉價 (Long: Liq Price = Open Price * (1 - (1 / Leverage)))；全倉模式不設個別強平價
+            liquidation_price = price * (1.0 - (1.0 / leverage)) if st.session_state.margin_mode != 'cross' else 0.0
+            
+        # 保證金檢查: 現金餘額必須覆蓋所需保證金
+        if st.session_state.balance < margin_required:
+             # 回補手續費，因為交易失敗
+             st.session_state.balance += fee
+             st.error(f"[{pos_mode_label}]買入：現金餘額 (${st.session_state.balance:,.2f}) 不足支付所需的保證金/成本 (${margin_required:,.2f})！(已退還手續費)")
+             return None
+        
+        unique_id = str(uuid.uuid4())[:8] 
+        
+        new_position = {
+            'id': unique_id,
+            'open_date': current_datetime,
+            'pos_mode': pos_mode_label, 
+            'qty': quantity, # float
+            'cost': price,
+            'initial_cost': cost_amount, 
+            'leverage': leverage,        
+            'liquidation_price': liquidation_price, 
+            'sl': float(sl),
+            'tp': float(tp)
+        }
+        
+        # 資金扣除: 扣除保證金/現貨成本
+        st.session_state.balance -= margin_required
+        
+        st.success(f"[{pos_mode_label}] 成功開多 {quantity:,.3f} {ASSET_CONFIGS[st.session_state.asset_type]['unit']} @ ${price:,.2f} (槓桿: {leverage}x, 保證金: ${margin_required:,.2f})。")
+            
+        st.session_state.transactions.append({
+            '日期': current_datetime,
+            '模式': pos_mode_label, 
+            '類型': trans_type_label, 
+            '股數': quantity, 
+            '價格': price, 
+            '金額': -margin_required, 
+            '損益': np.nan,
+            '開倉總值': cost_amount, 
+            '手續費': fee,
+            'leverage': leverage,
+            'pos_id': unique_id,
+            'bar': st.session_state.current_sim_index
+        })
+        
+        st.session_state.positions.append(new_position)
+        _update_margin_totals(new_position, 1.0)
+        
+    # 槓桿賣出 (空頭部位)
+    elif trade_mode_key == 'Margin_Short':
+        
+        margin_required = cost_amount / leverage
+        
+        # 強制平倉價 (Short: Liq Price = Open Price * (1 + (1 / Leverage)))；全倉模式不設個別強平價
+        liquidation_price = price * (1.0 + (1.0 / leverage)) if st.session_state.margin_mode != 'cross' else 0.0
+
+        # 保證金檢查
+        if st.session_state.balance < margin_required:
+             # 回補手續費
+             st.session_state.balance += fee
+             st.error(f"[{pos_mode_label}]賣出：現金餘額 (${st.session_state.balance:,.2f}) 不足支付所需的保證金 (${margin_required:,.2f})！(已退還手續費)")
+             return None
+
+        unique_id = str(uuid.uuid4())[:8] 
+        
+        new_position = {
+            'id': unique_id,
+            'open_date': current_datetime,
+            'pos_mode': pos_mode_label, 
+            'qty': quantity, # float
+            'cost': price,
+            'initial_cost': cost_amount, 
+            'leverage': leverage,        
+            'liquidation_price': liquidation_price, 
+            'sl': float(sl),
+            'tp': float(tp)
+        }
+        
+        # 資金處理: 扣除保證金
+        st.session_state.balance -= margin_required
+        
+        st.success(f"[{pos_mode_label}] 成功開空 {quantity:,.3f} {ASSET_CONFIGS[st.session_state.asset_type]['unit']} @ ${price:,.2f} (槓桿: {leverage}x, 保證金: ${margin_required:,.2f})。")
+
+        st.session_state.transactions.append({ 
+            '日期': current_datetime,
+            '模式': pos_mode_label, 
+            '類型': trans_type_label, 
+            '股數': -quantity, 
+            '價格': price, 
+            '金額': -margin_required, 
+            '損益': np.nan,
+            '開倉總值': cost_amount, 
+            '手續費': fee,
+            'leverage': leverage,
+            'pos_id': unique_id,
+            'bar': st.session_state.current_sim_index
+        })
+        
+        st.session_state.positions.append(new_position)
+        _update_margin_totals(new_position, 1.0)
+    
+    #交易後檢查風控
+    total_asset_new = get_current_asset_value(st.session_state.core_data, st.session_state.current_sim_index)
+    check_and_end_simulation(total_asset_new)
+    return new_position
@@ -0,0 +1,118 @@
+#Ksim 預熱 (在伺服器開始接受連線前執行)
+#量測各模組的匯入時間，並將熱門代碼預先下載到本機數據庫 (data_store)、計算一次指標並寫入衍生數據快取：
+#    python warmup.py                       # 預熱 WARMUP_TICKERS
+#    python warmup.py TSLA NVDA --force     # 忽略本機數據是否過期，重新下載
+#    python warmup.py --serve -- --server.port 8501   # 預熱完成後啟動 streamlit run app.py
+import argparse
+import importlib
+import json
+import logging
+import os
+import sys
+import time
+
+# 預設預熱的代碼 (可用環境變數 KSIM_WARMUP_TICKERS 覆寫，以逗號分隔)
+WARMUP_TICKERS = [t for t in os.environ.get('KSIM_WARMUP_TICKERS', 'TSLA,AAPL,NVDA,BTC-USD').split(',') if t]
+
+# 依 app.py 實際載入的順序量測 (後面的模組會沿用前面已載入的相依套件)
+IMPORT_MODULES = [
+    'numpy',
+    'pandas',
+    'streamlit',
+    'plotly.graph_objects',
+    'data_manager',
+    'trade_engine',
+    'chart_manager',
+    'table_manager',
+    'perf_monitor',
+    'session_manager',
+    'plotly.subplots',
+    'yfinance',
+]
+
+#依序匯入模組並記錄各自的耗時 (ms)
+def time_imports(modules: list) -> dict:
+    timings = {}
+    for name in modules:
+        t0 = time.perf_counter()
+        try:
+            importlib.import_module(name)
+        except ImportError:
+            timings[name] = None
+            continue
+        timings[name] = (time.perf_counter() - t0) * 1000
+    return timings
+
+#預熱單一代碼：下載 (或讀取本機數據) 並計算指標
+def warm_ticker(ticker: str, force: bool = False) -> dict:
+    from data_manager import download_price_history, data_key, cached_indicators, build_indicators
+    from data_store import content_hash
+
+    ticker = ticker.upper()
+    t0 = time.perf_counter()
+    raw = download_price_history(ticker, use_store=not force)
+    t1 = time.perf_counter()
+    if raw is None or raw.empty:
+        return {'ticker': ticker, 'ok': False, 'download_ms': (t1 - t0) * 1000}
+
+    # 指標寫入本機衍生數據快取，之後啟動的 worker 行程直接讀取 (內容沒變時沿用既有快取)
+    key = data_key(ticker) or content_hash(raw)
+    data = cached_indicators(ticker, key)
+    if data is None:
+        data = build_indicators(ticker, key, raw)
+    t2 = time.perf_counter()
+    return {
+        'ticker': ticker,
+        'ok': True,
+        'rows': len(data),
+        'download_ms': (t1 - t0) * 1000,
+        'indicators_ms': (t2 - t1) * 1000,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Ksim 預熱：匯入計時與熱門代碼預載")
+    parser.add_argument('tickers', nargs='*', default=WARMUP_TICKERS)
+    parser.add_argument('--force', action='store_true', help="忽略本機數據，重新下載")
+    parser.add_argument('--json', help="另存結果為 JSON")
+    parser.add_argument('--serve', action='store_true', help="預熱完成後以 streamlit run app.py 取代目前行程 (-- 之後的參數轉交 streamlit)")
+    argv = sys.argv[1:]
+    split = argv.index('--') if '--' in argv else len(argv)
+    args = parser.parse_args(argv[:split])
+    streamlit_args = argv[split + 1:]
+
+    t_start = time.perf_counter()
+    imports = time_imports(IMPORT_MODULES)
+    # 裸模式 (非 streamlit run) 下 st.cache_data 的警告沒有意義
+    logging.disable(logging.WARNING)
+    print(f"{'module':<24}{'import ms':>12}")
+    print('-' * 36)
+    for name, ms in imports.items():
+        print(f"{name:<24}{'missing' if ms is None else f'{ms:.1f}':>12}")
+
+    from data_manager import DATA_SOURCE
+    print(f"\n數據來源：{DATA_SOURCE}")
+    print(f"{'ticker':<12}{'rows':>8}{'download ms':>14}{'indicators ms':>16}")
+    print('-' * 50)
+    warmed = []
+    for ticker in args.tickers:
+        r = warm_ticker(ticker, args.force)
+        warmed.append(r)
+        if r['ok']:
+            print(f"{ticker:<12}{r['rows']:>8}{r['download_ms']:>14.1f}{r['indicators_ms']:>16.1f}")
+        else:
+            print(f"{ticker:<12}{'—':>8}{r['download_ms']:>14.1f}{'下載失敗':>16}")
+
+    total_ms = (time.perf_counter() - t_start) * 1000
+    print(f"\n預熱總耗時：{total_ms:,.1f} ms")
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump({'imports_ms': imports, 'tickers': warmed, 'total_ms': total_ms}, f, indent=2, ensure_ascii=False)
+
+    if args.serve:
+        app_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'app.py')
+        os.execvp(sys.executable, [sys.executable, '-m', 'streamlit', 'run', app_path, *streamlit_args])
+
+
+if __name__ == '__main__':
+    main()